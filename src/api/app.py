@@ -9,16 +9,31 @@ __status__ = 'MVP Complete'
 
 # Dependencies
 
+import functools
 import os
 import sys
 
-from flask import Flask, jsonify, request, make_response
+import numpy as np
+
+from flask import Flask, Response, json, jsonify, request, stream_with_context
 from flask_restful import Api, Resource
 
-from app_utils import similarity_jaccard, similarity_overlap
-from upload import api_insert
+from upload import api_insert, api_load, prune_genesets
+from stdout_capture import captureStdout
 from db_config import COLLECTION_NAME
-from db_utils import db, INDEX_LIST
+from db_utils import db, INDEX_LIST, INTERNAL_FIELDS, GENE_FIELDS, get_collection_version, bump_collection_version, fill_human_symbols
+from similarity_index import getIndex, getIndexIfLoaded, geneWeights
+from similarity_matrix import run_similarity_matrix, make_selection, DEFAULT_BLOCK_SIZE
+from app_utils import SIMILARITY_COUNT_METHODS, SIMILARITY_WEIGHTED_METHODS, enrichment_hypergeom, fdr_bh
+from jobs import submitJob, getJob
+from response_cache import cached, responseCache
+from gmtx_utils import iter_chunks
+from pagination import SORT_ORDER, parseLimit, encodeResumeToken, decodeResumeToken, makeResumeQuery, paginateRanked
+from read_db import readDb, SNAPSHOT_MODE, WRITES_ENABLED
+from gene_schema import gene_id_clauses, read_projection, decode_genesets
+
+# Documents fetched from MongoDB per round trip while streaming a response
+STREAM_BATCH_SIZE = 200
 
 
 # Code
@@ -27,21 +42,62 @@ app = Flask(__name__)
 api = Api(app, catch_all_404s=True)
 
 
+def writeEndpoint(method):
+	"""
+	Decorator of Resource methods that write to MongoDB: unavailable when
+	serving a snapshot without forwarding writes (see read_db.py)
+	"""
+	@functools.wraps(method)
+	def wrapper(*args, **kwargs):
+		if not WRITES_ENABLED:
+			return jsonify({"response": 404})
+		return method(*args, **kwargs)
+	return wrapper
+
+
+def badToken():
+	"""
+	:return: flask.Response - HTTP 400, for a malformed resume token
+	"""
+	response = jsonify({"response": 400})
+	response.status_code = 400
+	return response
+
+
 class Genesets(Resource):
 	def __init__(self):
 		self.returnParamNames = 'returnParams'
 		self.genesParam = 'genes'
 
 
-	def getOutput(self, query, returnParams, geneList):
+	def parsePage(self, data):
+		"""
+		Pop and validate the pagination parameters
+		
+		:param data: Dict - request parameters
+		:return: Dict or None - {'limit', 'after', 'resumeToken'}, None if not paginated
+		"""
+		limit = parseLimit(data.pop('limit', None))
+		token = data.pop('resumeToken', None)
+		if limit is None:
+			assert token is None
+			return None
+		after = decodeResumeToken(token, len(INDEX_LIST)) if token is not None else None
+		return {'limit': limit, 'after': after, 'resumeToken': None}
+
+
+	def iterOutput(self, query, returnParams, geneList, page=None):
 		"""
 		:param query: Dict
 		:param returnParams: List<String> or None
 		:param geneList: List<String> or None
-		:return: List
+		:param page: Dict or None - from 'parsePage'; receives the 'resumeToken' of the next page
+		:return: Generator<Dict> - matching documents, read lazily from the cursor
 		"""
 		if geneList is not None:
-			geneMatchList = [{'genes': {'$elemMatch': {'$elemMatch': {'$elemMatch': {'$in': [gene]}}}}} for gene in geneList]
+			# A gene matches any position of the gene arrays: one indexed flat field per position
+			# (IDs of schema v2 genesets are ints)
+			geneMatchList = [{'$or': [{field: gene} for field in GENE_FIELDS] + gene_id_clauses(gene)} for gene in geneList]
 			otherQueryList = [{k: v} for k, v in query.items()]
 			geneQuery = {'$and': geneMatchList + otherQueryList}
 			query = geneQuery
@@ -52,22 +108,107 @@ class Genesets(Resource):
 			queryJSON = {'$in':queryList}
 			query['setName'] = queryJSON
 		
-		output = []
-		q = db[COLLECTION_NAME].find(query)
-		for p in q:
-			if returnParams == None:
-				docReturn = {k: v for k, v in p.items() if k != '_id'}
+		projection = self.makeProjection(returnParams)
+		if page is not None:
+			# Keyset pagination: seek past the last key of the previous page, in unique index order
+			if page['after'] is not None:
+				query = {'$and': [query, makeResumeQuery(page['after'])]}
+			if returnParams is not None:
+				projection.update({k: 1 for k in INDEX_LIST})
+		# Genesets not yet flattened (see migrate.py) derive 'humanSymbols' from their 'genes'
+		fillSymbols = returnParams is not None and 'humanSymbols' in returnParams
+		if fillSymbols:
+			projection.update({k: 1 for k in INDEX_LIST})
+		
+		q = readDb[COLLECTION_NAME].find(query, read_projection(projection)).batch_size(STREAM_BATCH_SIZE)
+		if page is not None:
+			# One extra document tells whether there is a next page
+			q = q.sort(SORT_ORDER).limit(page['limit'] + 1)
+		# Genes of schema v2 genesets are decoded one batch at a time (see gene_schema.py)
+		decodedFields = None if returnParams is None else [param.split('.')[0] for param in returnParams]
+		chunks = iter_chunks(q, STREAM_BATCH_SIZE)
+		if fillSymbols:
+			chunks = (fill_human_symbols(readDb[COLLECTION_NAME], chunk) for chunk in chunks)
+		docs = (doc for chunk in chunks for doc in decode_genesets(chunk, decodedFields))
+		try:
+			for n, p in enumerate(docs):
+				if page is not None:
+					if n == page['limit']:
+						page['resumeToken'] = encodeResumeToken(lastKey)
+						break
+					lastKey = [p[k] for k in INDEX_LIST]
+				if returnParams == None:
+					docReturn = p
+				else:
+					docReturn = dict()
+					for param in returnParams:
+						if param in p:
+							docReturn[param] = p[param]
+						else:
+							docReturn[param] = ""
+				yield docReturn
+		finally:
+			q.close()
+
+
+	def makeProjection(self, returnParams):
+		"""
+		Only the requested fields are sent by MongoDB (missing fields are filled in by 'iterOutput')
+		
+		:param returnParams: List<String> or None
+		:return: Dict - MongoDB projection
+		"""
+		if returnParams == None:
+			projection = {field: 0 for field in INTERNAL_FIELDS}
+		else:
+			# Top-level fields only: 'meta' and 'meta.x' would collide
+			projection = {param.split('.')[0]: 1 for param in returnParams}
+		if '_id' not in projection:
+			projection['_id'] = 0
+		return projection
+
+
+	def streamJson(self, docs, page=None):
+		"""
+		Stream '{"response":[...]}' one document at a time
+		(paginated: '{"response":[...],"resumeToken":...}'), byte for byte as 'jsonify'
+		
+		:param docs: Iterable<Dict>
+		:param page: Dict or None - filled by 'docs' once exhausted
+		:return: flask.Response
+		"""
+		def generate():
+			yield '{"response":['
+			separator = ''
+			for doc in docs:
+				yield separator + json.dumps(doc, separators=(',', ':'))
+				separator = ','
+			if page is None:
+				yield ']}\n'
 			else:
-				docReturn = dict()
-				for param in returnParams:
-					if param in p:
-						docReturn[param] = p[param]
-					else:
-						docReturn[param] = ""
-			output.append(docReturn)
-		return output
+				yield '],"resumeToken":' + json.dumps(page['resumeToken'], separators=(',', ':')) + '}\n'
+		return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+	def streamGmt(self, docs):
+		"""
+		Stream the GMT file (tab-delimited setName-desc-genes) one line at a time
+		
+		:param docs: Iterable<Dict> - with 'setName', 'desc' and 'humanSymbols'
+		:return: flask.Response
+		"""
+		def generate():
+			separator = ''
+			for gs in docs:
+				name = [gs['setName']]
+				desc = [gs['desc']]
+				combined = name + desc + gs['humanSymbols']
+				yield separator + '\t'.join(combined)
+				separator = '\n'
+		return Response(stream_with_context(generate()), content_type='application/octet-stream')
 	
 
+	@cached('genesets')
 	def get(self):
 		parsedArgs = request.args
 		data = {k: v for k, v in parsedArgs.items()}
@@ -87,36 +228,37 @@ class Genesets(Resource):
 		else:
 			getGmt = False
 		
+		try:
+			page = self.parsePage(data)
+		except ValueError:
+			return badToken()
+		except Exception:
+			return jsonify({"response": 404})
+		
 		# Scrape data and present in established format
 		if len(data) == 0 and hasGenes is False:
 			# Error logic
 			output = 404
 			return jsonify({"response": output})
+		elif getGmt and page is not None:
+			# Output: GMT file, one page (the resume token has to be known before the body is sent)
+			gmtParams = ['setName', 'desc', 'humanSymbols']
+			docs = list(self.iterOutput(data, gmtParams, genes, page))
+			response = self.streamGmt(docs)
+			if page['resumeToken'] is not None:
+				response.headers['X-Resume-Token'] = page['resumeToken']
+			return response
 		elif getGmt:
-			gmtParams = ['setName', 'desc', 'genes']
-			output = self.getOutput(data, gmtParams, genes)
-			
-			# outputList: list of tab-delimited String (setName-desc-genes)
-			outputList = []
-			for gs in output:
-				name = [gs['setName']]
-				desc = [gs['desc']]
-				genes = [gene[0][2] for gene in gs['genes'] if gene[0][2] != '']
-				combined = name + desc + genes
-				combinedStr = '\t'.join(combined)
-				outputList.append(combinedStr)
-			
 			# Output: GMT file
-			tsv = '\n'.join(outputList)
-			response = make_response(tsv)
-			response.headers['content-type'] = 'application/octet-stream'	
-			return response
+			# Human symbols come from their flat field: the nested 'genes' array is not transferred
+			gmtParams = ['setName', 'desc', 'humanSymbols']
+			return self.streamGmt(self.iterOutput(data, gmtParams, genes))
 		else:
 			# Output: JSON
-			output = self.getOutput(data, params, genes)
-			return jsonify({"response": output})
+			return self.streamJson(self.iterOutput(data, params, genes, page), page)
 
 
+	@cached('genesets')
 	def post(self):
 		data = request.get_json()
 		hasGenes = False
@@ -125,18 +267,29 @@ class Genesets(Resource):
 		if genes is not None:
 			hasGenes = True
 		
+		try:
+			page = self.parsePage(data)
+		except ValueError:
+			return badToken()
+		except Exception:
+			return jsonify({"response": 404})
+		
 		if len(data) == 0 and hasGenes is False:
-			output = 404
-		else:
-			output = self.getOutput(data, params, genes)
-		return jsonify({"response": output})
+			return jsonify({"response": 404})
+		return self.streamJson(self.iterOutput(data, params, genes, page), page)
+
+
+# Maximum number of query genesets per POST /api/similar
+MAX_BATCH_QUERIES = 1000
+BATCH_QUERY_SIZE = 500
 
 
 class Similar(Resource):
 	def __init__(self):
 		self.requiredParams = {'setName', 'source', 'subtype', 'user', 'method', 'threshold'}
-		self.acceptedMethods = {'jaccard', 'overlap'}
-		self.getGeneSet = lambda l : {gene[0][2] for gene in l if gene[0][2] != ''}
+		self.optionalParams = {'topk', 'approximate', 'limit', 'resumeToken'}
+		self.acceptedMethods = {'jaccard', 'overlap'} | set(SIMILARITY_WEIGHTED_METHODS)
+		self.getGeneSet = lambda l : {gene for gene in l if gene != ''}
 
 
 	def getGeneMembers(self, inputDict):
@@ -145,13 +298,19 @@ class Similar(Resource):
 		:return: Set - Empty if invalid
 		"""
 		testParams = {x for x in inputDict.keys()}
-		findGeneset = db[COLLECTION_NAME].find_one({
+		findGeneset = readDb[COLLECTION_NAME].find_one({
 			'setName': inputDict['setName'],
 			'source': inputDict['source'],
 			'subtype': inputDict['subtype'],
 			'user': inputDict['user']
-		})
-		if testParams != self.requiredParams:
+		}, {**{k: 1 for k in INDEX_LIST}, 'humanSymbols': 1, '_id': 0})
+		if not self.requiredParams <= testParams <= self.requiredParams | self.optionalParams:
+			return set()
+		elif 'topk' in inputDict and not str(inputDict['topk']).isdigit():
+			return set()
+		elif 'limit' in inputDict and not (str(inputDict['limit']).isdigit() and int(inputDict['limit']) > 0):
+			return set()
+		elif 'resumeToken' in inputDict and 'limit' not in inputDict:
 			return set()
 		elif not inputDict['threshold'].replace('.', '').isdigit():
 			return set()
@@ -160,49 +319,307 @@ class Similar(Resource):
 		elif findGeneset is None:
 			return set()
 		else:
-			returnGenes = self.getGeneSet(findGeneset['genes'])
+			fill_human_symbols(readDb[COLLECTION_NAME], [findGeneset])
+			returnGenes = self.getGeneSet(findGeneset['humanSymbols'])
 			return returnGenes
 
 
+	def getGeneWeights(self, keys):
+		"""
+		Coefficients of stored genesets (weighted methods)
+		
+		:param keys: List<Dict> - INDEX_LIST keys
+		:return: Dict - {key: {human symbol: coefficient}}, for the keys found
+		"""
+		found = dict()
+		projection = read_projection({**{k: 1 for k in INDEX_LIST}, 'genes': 1, '_id': 0})
+		for chunk in iter_chunks(keys, BATCH_QUERY_SIZE):
+			docs = list(readDb[COLLECTION_NAME].find({'$or': chunk}, projection))
+			for doc in decode_genesets(docs):
+				found[tuple(doc[k] for k in INDEX_LIST)] = geneWeights(doc['genes'])
+		return found
+
+
+	@cached('similar')
 	def get(self):
 		parsedArgs = request.args
 		input = {k: v for k, v in parsedArgs.items()}
+		return self.answer(input)
+
+
+	def answer(self, input):
+		"""
+		Genesets similar to one stored geneset
 		
+		:param input: Dict<String> - request parameters
+		:return: flask.Response
+		"""
 		genes = self.getGeneMembers(input)
 		if len(genes) == 0:
-			output = 404
+			return jsonify({"response": 404})
+		
+		output = []
+		method = input['method']
+		threshold = float(input['threshold'])
+		topk = int(input['topk']) if 'topk' in input else None
+		limit = parseLimit(input.get('limit'))
+		
+		if input.get('approximate') in ['True', 'true']:
+			# MinHash/LSH: estimated coefficients with their standard errors
+			if method in SIMILARITY_WEIGHTED_METHODS:
+				return jsonify({"response": 404})
+			matches = getIndex().approximateQuery(genes, method, threshold, topk)
+		elif method in SIMILARITY_WEIGHTED_METHODS:
+			# Coefficient vectors of the genesets sharing genes with the query
+			key = {k: input[k] for k in INDEX_LIST}
+			weights = self.getGeneWeights([key]).get(tuple(key[k] for k in INDEX_LIST), dict())
+			matches = getIndex().weightedQuery(weights, method, threshold, topk)
 		else:
-			output = []
-			method = input['method']
-			threshold = float(input['threshold'])
-			
-			# Optimisation: ignore geneset with which the intersection will just be 0
-			allGenesets = db[COLLECTION_NAME].find({'genes': {'$elemMatch': {'$elemMatch': {'$elemMatch': {'$in': list(genes)}}}}})
-			for geneset in allGenesets:
-				compareGenes = self.getGeneSet(geneset['genes'])
-				if method == 'jaccard':
-					sim = similarity_jaccard(compareGenes, genes)
-				elif method == 'overlap':
-					sim = similarity_overlap(compareGenes, genes)
-				
-				if sim >= threshold:
-					output.append({'setName': geneset['setName'],
-									'source': geneset['source'],
-									'coeff': sim
-					})
-				
+			# Inverted index: only genesets sharing at least one gene are scored
+			matches = getIndex().query(genes, method, threshold, topk)
+		
+		page = dict()
+		if limit is not None:
+			# Pages of the ranking: decreasing coefficient, then geneset key
+			try:
+				matches, page['resumeToken'] = paginateRanked(matches, limit, input.get('resumeToken'))
+			except ValueError:
+				return badToken()
+			except Exception:
+				return jsonify({"response": 404})
+		
+		if input.get('approximate') in ['True', 'true']:
+			for key, sim, error in matches:
+				output.append({'setName': key[0],
+								'source': key[1],
+								'coeff': sim,
+								'error': error
+				})
+			estimatedError = max([x['error'] for x in output], default=0.0)
+			return jsonify({"response": output, "estimatedError": estimatedError, **page})
+		
+		for key, sim in matches:
+			output.append({'setName': key[0],
+							'source': key[1],
+							'coeff': sim
+			})
+		return jsonify({"response": output, **page})
+
+
+	def getQueryGenes(self, queries):
+		"""
+		Gene sets of the queries of a batch: stored genesets (fetched in one round trip) or gene lists
+		
+		:param queries: List<Dict> - INDEX_LIST keys, or {'genes': List<String>, 'name': optional}
+		:return: List<Set> - Empty if invalid
+		"""
+		stored = [q for q in queries if set(q.keys()) == set(INDEX_LIST)]
+		found = dict()
+		for chunk in iter_chunks(stored, BATCH_QUERY_SIZE):
+			projection = {**{k: 1 for k in INDEX_LIST}, 'humanSymbols': 1, '_id': 0}
+			docs = fill_human_symbols(readDb[COLLECTION_NAME], list(readDb[COLLECTION_NAME].find({'$or': chunk}, projection)))
+			for doc in docs:
+				found[tuple(doc[k] for k in INDEX_LIST)] = set(doc['humanSymbols'])
+		
+		geneSets = []
+		for q in queries:
+			if set(q.keys()) == set(INDEX_LIST):
+				geneSets.append(found.get(tuple(q[k] for k in INDEX_LIST), set()))
+			elif 'genes' in q and set(q.keys()) <= {'genes', 'name'} and isinstance(q['genes'], list):
+				geneSets.append({gene for gene in q['genes'] if gene != ''})
+			else:
+				geneSets.append(set())
+		return geneSets
+
+
+	@cached('similar')
+	def post(self):
+		data = request.get_json()
+		
+		if isinstance(data, dict) and 'queries' not in data:
+			# One stored geneset, as GET
+			return self.answer({k: str(v) for k, v in data.items()})
+		
+		try:
+			assert isinstance(data, dict)
+			assert {'queries', 'method', 'threshold'} <= set(data.keys()) <= {'queries', 'method', 'threshold', 'topk'}
+			queries = data['queries']
+			assert isinstance(queries, list) and 0 < len(queries) <= MAX_BATCH_QUERIES
+			assert all(isinstance(q, dict) for q in queries)
+			# Stored genesets by key: strings only (operators would reach the query)
+			assert all(all(isinstance(v, str) for v in q.values()) for q in queries if set(q.keys()) == set(INDEX_LIST))
+			method = data['method']
+			assert method in self.acceptedMethods
+			threshold = float(data['threshold'])
+			topk = int(data['topk']) if 'topk' in data else None
+			assert topk is None or topk > 0
+		except Exception:
+			return jsonify({"response": 404})
+		
+		geneSets = self.getQueryGenes(queries)
+		valid = [i for i, genes in enumerate(geneSets) if len(genes) > 0]
+		if method in SIMILARITY_WEIGHTED_METHODS:
+			# All queries in one sparse product; gene lists weigh 1.0 per gene
+			stored = self.getGeneWeights([queries[i] for i in valid if 'genes' not in queries[i]])
+			weights = [stored.get(tuple(queries[i][k] for k in INDEX_LIST), dict()) if 'genes' not in queries[i]
+						else dict.fromkeys(geneSets[i], 1.0) for i in valid]
+			matches = getIndex().weightedQueryMany(weights, method, threshold, topk)
+		else:
+			# All queries against all genesets in one sparse product
+			matches = getIndex().queryMany([geneSets[i] for i in valid], method, threshold, topk)
+		
+		# Queries are echoed by key or name (not gene list), with 404 if invalid
+		output = [{'query': {'name': q.get('name', '')} if 'genes' in q else q, 'response': 404} for q in queries]
+		for i, queryMatches in zip(valid, matches):
+			output[i]['response'] = [{'setName': key[0], 'source': key[1], 'coeff': sim} for key, sim in queryMatches]
 		return jsonify({"response": output})
 
 		
+class Enrich(Resource):
+	def __init__(self):
+		self.requiredParams = {'genes'}
+		self.optionalParams = {'background', 'source', 'subtype', 'taxId', 'maxFdr', 'topk'}
+		self.getGeneSet = lambda l : {gene for gene in l if gene != ''}
+
+
+	def parseGenes(self, genes):
+		"""
+		:param genes: List<String> or String - human gene symbols (comma-delimited String)
+		:return: Set<String>
+		"""
+		if isinstance(genes, str):
+			genes = genes.split(',')
+		assert isinstance(genes, list)
+		return self.getGeneSet(genes)
+
+
+	@cached('enrich')
+	def post(self):
+		data = request.get_json()
+		
+		try:
+			assert isinstance(data, dict)
+			assert self.requiredParams <= set(data.keys()) <= self.requiredParams | self.optionalParams
+			genes = self.parseGenes(data['genes'])
+			assert len(genes) > 0
+			background = self.parseGenes(data['background']) if 'background' in data else None
+			taxId = int(data['taxId']) if 'taxId' in data else None
+			maxFdr = float(data.get('maxFdr', 1.0))
+			topk = int(data['topk']) if 'topk' in data else None
+			assert topk is None or topk > 0
+		except Exception:
+			return jsonify({"response": 404})
+		
+		# Overlaps from the inverted index, all genesets tested at once
+		keys, overlap, setSize, querySize, universeSize, nTested = getIndex().enrichmentCounts(
+			genes, background, data.get('source'), data.get('subtype'), taxId)
+		pValues = enrichment_hypergeom(overlap, setSize, querySize, universeSize)
+		fdr = fdr_bh(pValues, nTested)
+		
+		ranked = [i for i in np.argsort(pValues, kind='stable') if fdr[i] <= maxFdr]
+		if topk is not None:
+			ranked = ranked[:topk]
+		
+		output = []
+		for i in ranked:
+			output.append({'setName': keys[i][0],
+							'source': keys[i][1],
+							'subtype': keys[i][2],
+							'user': keys[i][3],
+							'overlap': int(overlap[i]),
+							'size': int(setSize[i]),
+							'pValue': float(pValues[i]),
+							'fdr': float(fdr[i])
+			})
+		return jsonify({"response": output, "querySize": querySize, "universeSize": universeSize, "tested": nTested})
+
+
+def refreshIndex(params):
+	"""
+	Bring the similarity index (if built) up to date after an insert.
+	Only if this insert is the one write since the index was last synced;
+	otherwise the next query rebuilds it.
+	
+	:param params: Dict - 'api_insert' params
+	:return: VOID
+	"""
+	if SNAPSHOT_MODE:
+		# The index reflects the snapshot, which forwarded writes do not change
+		return
+	index = getIndexIfLoaded()
+	version = get_collection_version(db, COLLECTION_NAME)
+	if index is not None and index.version == version - 1:
+		index.refreshGroup(params['so'], params.get('st', ''), params['us'])
+		index.version = version
+
+
+def removeFromIndex(query=None, groups=None):
+	"""
+	Record a removal: bump the collection version and drop the genesets
+	from the similarity index (if built and otherwise up to date)
+	
+	:param query: Dict or None - filter delete: 'source', 'user' and optionally 'subtype'
+	:param groups: Dict or None - {(source, subtype, user): List<setName>}
+	:return: VOID
+	"""
+	version = bump_collection_version(db, COLLECTION_NAME)
+	if SNAPSHOT_MODE:
+		return
+	index = getIndexIfLoaded()
+	if index is not None and index.version == version - 1:
+		if query is not None:
+			for group in list(index.groups):
+				if group[0] == query['source'] and group[2] == query['user'] and query.get('subtype', group[1]) == group[1]:
+					index.removeGroup(*group)
+		else:
+			for (source, subtype, user), setNames in groups.items():
+				for setName in setNames:
+					index.remove((setName, source, subtype, user))
+		index.version = version
+
+
+def runInsertJob(job, headers, rawList, params):
+	"""
+	Background '/api/insert': progress counts go to the job, mapping errors to its result
+	
+	:param job: jobs.Job
+	:param headers: List<String>
+	:param rawList: List<List<String>>
+	:param params: Dict
+	:return: Dict - final counts and error messages
+	"""
+	job.update(total=len(rawList), mapped=0)
+	with captureStdout() as s:
+		def progress(**counts):
+			job.update(errors=s.getvalue().count('\n'), **counts)
+		totals = api_load(headers, rawList, params, progress=progress)
+	refreshIndex(params)
+	return {'counts': totals, 'errors': s.getvalue().splitlines()}
+
+
 class addGenesets(Resource):
+	@writeEndpoint
 	def post(self):
 		data = request.get_json()
 		
+		if data.get('async') is True and set(data.keys()) == {'headers', 'parsed', 'params', 'async'}:
+			# Queued: the request returns at once, progress is polled on /api/jobs/<jobId>
+			try:
+				params = data['params']
+				assert all(s in params for s in ['gf', 'so', 'ti', 'us'])
+				assert params['gf'] in [0, 1, 2, 3]
+				assert not (params.get('prune', False) and params['us'] == 'Public')
+				job = submitJob('insert', runInsertJob, data['headers'], data['parsed'], params)
+			except Exception:
+				return jsonify({"response": 404})
+			return jsonify({"response": 202, "jobId": job.id})
+		
 		if set(data.keys()) != {'headers', 'parsed', 'params'}:
 			output = 404
 		else:
 			try:
 				output = [200] + api_insert(data['headers'], data['parsed'], data['params'])
+				refreshIndex(data['params'])
 			except AssertionError:
 				output = 404
 			except Exception:
@@ -212,29 +629,125 @@ class addGenesets(Resource):
 		
 		
 class delGenesets(Resource):
+	def __init__(self):
+		self.filterParams = {'source', 'subtype', 'user'}
+
+
+	def validate(self, data):
+		"""
+		Check the whole request before anything is deleted
+		
+		:param data: Dict - {'genesets': List<Dict>} or {'filter': Dict}
+		:return: Dict - {(source, subtype, user): List<setName>}, or the filter
+		"""
+		assert isinstance(data, dict) and len(data) == 1
+		if 'filter' in data:
+			query = data['filter']
+			assert {'source', 'user'} <= set(query.keys()) <= self.filterParams
+			assert all(isinstance(v, str) for v in query.values())
+			assert query['user'] != 'Public'
+			return query
+		
+		groups = dict()
+		assert isinstance(data['genesets'], list)
+		for geneset in data['genesets']:
+			assert isinstance(geneset, dict) and set(geneset.keys()) == set(INDEX_LIST)
+			# Operators (e.g. {'$ne': 'Public'}) would reach delete_many
+			assert all(isinstance(v, str) for v in geneset.values())
+			assert geneset['user'] != 'Public'
+			groups.setdefault((geneset['source'], geneset['subtype'], geneset['user']), []).append(geneset['setName'])
+		return groups
+
+
+	@writeEndpoint
 	def post(self):
 		data = request.get_json()
 		
 		try:
-			assert 'genesets' in data
-			removeList = data['genesets']
-			for geneset in removeList:
-				assert set(geneset.keys()) == set(INDEX_LIST)
-				assert geneset['user'] != 'Public'
-				db[COLLECTION_NAME].remove(geneset)
+			toRemove = self.validate(data)
+		except Exception:
+			return jsonify({"response": 404, "deleted": 0})
+		
+		deleted = 0
+		try:
+			if 'filter' in data:
+				deleted = db[COLLECTION_NAME].delete_many(toRemove).deleted_count
+			else:
+				# One batched delete_many per source/subtype/user
+				for (source, subtype, user), setNames in toRemove.items():
+					deleted += prune_genesets(source, subtype, user, setNames)
 			output = 200
-		except AssertionError:
-			output = 404
 		except Exception:
 			output = 404
+		
+		if output == 404:
+			# Partly done: unknown which genesets are gone, the similarity index is rebuilt on the next query
+			bump_collection_version(db, COLLECTION_NAME)
+		elif deleted > 0 and 'filter' in data:
+			removeFromIndex(query=toRemove)
+		elif deleted > 0:
+			removeFromIndex(groups=toRemove)
 
-		return jsonify({"response": output})
+		return jsonify({"response": output, "deleted": deleted})
+
+
+class SimilarityMatrix(Resource):
+	def __init__(self):
+		self.selectionParams = {'source', 'subtype', 'user', 'taxId', 'domain'}
+
+
+	@writeEndpoint
+	def post(self):
+		data = request.get_json()
+		
+		try:
+			assert set(data.keys()) <= {'query', 'against', 'method', 'threshold', 'blockSize', 'processes'}
+			assert 'source' in data['query'] and set(data['query'].keys()) <= self.selectionParams
+			against = data.get('against')
+			if against is not None:
+				assert 'source' in against and set(against.keys()) <= self.selectionParams
+				against = make_selection(**against)
+			method = data.get('method', 'jaccard')
+			assert method in SIMILARITY_COUNT_METHODS
+			threshold = float(data.get('threshold', 0.5))
+			blockSize = int(data.get('blockSize', DEFAULT_BLOCK_SIZE))
+			processes = int(data.get('processes', 1))
+			assert blockSize > 0 and 0 < processes <= (os.cpu_count() or 1)
+			
+			# Pairs go to the similarity collection, tagged with the job ID
+			job = submitJob('similarity_matrix', lambda job: run_similarity_matrix(
+				make_selection(**data['query']), against, method, threshold, blockSize=blockSize, workers=processes, job=job))
+		except AssertionError:
+			return jsonify({"response": 404})
+		except Exception:
+			return jsonify({"response": 404})
+
+		return jsonify({"response": 202, "jobId": job.id})
+
+
+class CacheStats(Resource):
+	def get(self):
+		if responseCache is None:
+			return jsonify({"response": 404})
+		return jsonify({"response": responseCache.stats()})
+
+
+class Jobs(Resource):
+	def get(self, jobId):
+		job = getJob(jobId)
+		if job is None:
+			return jsonify({"response": 404})
+		return jsonify({"response": job.toDict()})
 
 
 api.add_resource(Genesets, "/api/genesets")
 api.add_resource(Similar, "/api/similar")
+api.add_resource(Enrich, "/api/enrich")
 api.add_resource(addGenesets, "/api/insert")
 api.add_resource(delGenesets, "/api/remove")
+api.add_resource(SimilarityMatrix, "/api/similarity_matrix")
+api.add_resource(Jobs, "/api/jobs/<string:jobId>")
+api.add_resource(CacheStats, "/api/cache")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,10 @@
+import math
+import zlib
+
+import numpy as np
+from scipy.stats import hypergeom
+
+
 def similarity_jaccard(a, b):
 	"""
 	Given two genesets, returns a similarity measure based on the
@@ -32,4 +39,281 @@ def similarity_overlap(a, b):
 		k = float(intersect / minimum)
 	except ZeroDivisionError:
 		k = 0
-	return k
\ No newline at end of file
+	return k
+
+def similarity_jaccard_counts(intersect, sizeA, sizeB):
+	"""
+	Vectorised 'similarity_jaccard' from intersection counts and set sizes
+	(NumPy arrays, broadcast against each other):
+	
+	k(a, b) = |a AND b| / (|a| + |b| - |a AND b|)
+	
+	:param intersect: ndarray<Int>
+	:param sizeA: ndarray<Int> or Int
+	:param sizeB: ndarray<Int> or Int
+	:return: ndarray<Float>
+	"""
+	intersect = np.asarray(intersect, dtype=np.float64)
+	union = sizeA + sizeB - intersect
+	with np.errstate(divide='ignore', invalid='ignore'):
+		k = np.where(union > 0, intersect / union, 0.0)
+	return k
+
+
+def similarity_overlap_counts(intersect, sizeA, sizeB):
+	"""
+	Vectorised 'similarity_overlap' from intersection counts and set sizes
+	(NumPy arrays, broadcast against each other):
+	
+	k(a, b) = |a AND b| / MIN(|a|, |b|)
+	
+	:param intersect: ndarray<Int>
+	:param sizeA: ndarray<Int> or Int
+	:param sizeB: ndarray<Int> or Int
+	:return: ndarray<Float>
+	"""
+	intersect = np.asarray(intersect, dtype=np.float64)
+	minimum = np.minimum(sizeA, sizeB)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		k = np.where(minimum > 0, intersect / minimum, 0.0)
+	return k
+
+
+SIMILARITY_COUNT_METHODS = {'jaccard': similarity_jaccard_counts,
+							'overlap': similarity_overlap_counts}
+
+
+# The sums below do not depend on the column order of 'A' (interned gene IDs, which follow the
+# order genesets were indexed in), so MongoDB and snapshot serving give bit-identical results
+
+def _rowSums(A, values):
+	"""
+	:param A: scipy.sparse.csr_matrix<Float>
+	:param values: ndarray<Float> - one per explicit entry of 'A'
+	:return: ndarray<Float> - per row, summed in stored entry order
+	"""
+	rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+	return np.bincount(rows, weights=values, minlength=A.shape[0])
+
+
+def _querySum(q, f, queryRows=None):
+	"""
+	:param q: ndarray<Float> or scipy.sparse.csr_matrix<Float> - see 'similarity_weighted_jaccard'
+	:param f: Function - applied to the query coefficients
+	:param queryRows: ndarray<Int> or None
+	:return: Float, or ndarray<Float> per row of 'A' with 'queryRows' - exact sum of f(query entries)
+	"""
+	if queryRows is None:
+		return math.fsum(f(q[~np.isnan(q)]).tolist())
+	sums = np.array([math.fsum(f(q.data[q.indptr[i]:q.indptr[i + 1]]).tolist()) for i in range(q.shape[0])], dtype=np.float64)
+	return sums[queryRows]
+
+
+def _sharedEntries(A, q, queryRows=None):
+	"""
+	Entries of 'A' in genes of the query
+
+	:param A: scipy.sparse.csr_matrix<Float> - geneset-by-gene coefficients (explicit entries are members)
+	:param q: ndarray<Float> - query coefficient per column of 'A', NaN if not in the query; or, with
+		'queryRows', a csr_matrix of queries (sorted indices, explicit entries are members)
+	:param queryRows: ndarray<Int> or None - query (row of 'q') of each row of 'A'
+	:return rows: ndarray<Int> - row of each shared entry
+	:return a: ndarray<Float> - coefficients of the genesets
+	:return b: ndarray<Float> - coefficients of the query
+	"""
+	rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+	if queryRows is None:
+		b = q[A.indices]
+	else:
+		# (query, column) keys of the explicit entries of 'q' are sorted: one search for all entries of 'A'
+		width = np.int64(q.shape[1])
+		queryKeys = np.repeat(np.arange(q.shape[0], dtype=np.int64), np.diff(q.indptr)) * width + q.indices
+		entryKeys = queryRows[rows].astype(np.int64) * width + A.indices
+		found = np.minimum(np.searchsorted(queryKeys, entryKeys), max(len(queryKeys) - 1, 0))
+		b = np.where(queryKeys[found] == entryKeys, q.data[found], np.nan) if len(queryKeys) > 0 else np.full(len(entryKeys), np.nan)
+	shared = ~np.isnan(b)
+	return rows[shared], A.data[shared], b[shared]
+
+
+def similarity_weighted_jaccard(A, q, queryRows=None):
+	"""
+	Weighted (Ruzicka) Jaccard coefficient of every row of 'A' with the query,
+	with the positive and negative parts of the coefficients as separate genes:
+	
+	k(a, b) = SUM min(a+, b+) + min(a-, b-) / SUM max(a+, b+) + max(a-, b-)
+	
+	Without coefficients (all 1.0) this is 'similarity_jaccard'.
+	
+	:param A: scipy.sparse.csr_matrix<Float> - geneset-by-gene coefficients
+	:param q: ndarray<Float> - query coefficient per column of 'A' (NaN if not in the query); values
+		past the columns of 'A' are query genes no geneset has. With 'queryRows': csr_matrix<Float>,
+		one row per query, sorted indices (columns past those of 'A' as above)
+	:param queryRows: ndarray<Int> or None - batches: row of 'q' each row of 'A' is scored against
+	:return: ndarray<Float> - per row of 'A'
+	"""
+	rows, a, b = _sharedEntries(A, q, queryRows)
+	minimum = np.where(np.sign(a) == np.sign(b), np.minimum(np.abs(a), np.abs(b)), 0.0)
+	intersect = np.bincount(rows, weights=minimum, minlength=A.shape[0])
+	sizeA = _rowSums(A, np.abs(A.data))
+	union = sizeA + _querySum(q, np.abs, queryRows) - intersect
+	with np.errstate(divide='ignore', invalid='ignore'):
+		k = np.where(union > 0, intersect / union, 0.0)
+	return k
+
+
+def similarity_cosine(A, q, queryRows=None):
+	"""
+	Cosine similarity of the coefficient vectors of every row of 'A' and the query
+	(genes missing from either side count as 0):
+	
+	k(a, b) = a . b / (|a| |b|)
+	
+	Without coefficients (all 1.0) this is the Otsuka-Ochiai coefficient.
+	
+	:param A: scipy.sparse.csr_matrix<Float>
+	:param q: ndarray<Float> or csr_matrix<Float> - see 'similarity_weighted_jaccard'
+	:param queryRows: ndarray<Int> or None
+	:return: ndarray<Float> - per row of 'A', in [-1, 1]
+	"""
+	rows, a, b = _sharedEntries(A, q, queryRows)
+	dot = np.bincount(rows, weights=a * b, minlength=A.shape[0])
+	normA = np.sqrt(_rowSums(A, A.data ** 2))
+	norms = normA * np.sqrt(_querySum(q, np.square, queryRows))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		k = np.where(norms > 0, dot / norms, 0.0)
+	return k
+
+
+def similarity_correlation(A, q, queryRows=None):
+	"""
+	Pearson correlation of the coefficients of the genes shared by every row
+	of 'A' and the query (signed: opposite regulation gives negative values).
+	0 with fewer than 2 shared genes or constant coefficients.
+	
+	:param A: scipy.sparse.csr_matrix<Float>
+	:param q: ndarray<Float> or csr_matrix<Float> - see 'similarity_weighted_jaccard'
+	:param queryRows: ndarray<Int> or None
+	:return: ndarray<Float> - per row of 'A', in [-1, 1]
+	"""
+	rows, a, b = _sharedEntries(A, q, queryRows)
+	count = lambda w: np.bincount(rows, weights=w, minlength=A.shape[0])
+	n = count(None)
+	sumA, sumB = count(a), count(b)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		cov = count(a * b) - sumA * sumB / n
+		varA = count(a * a) - sumA ** 2 / n
+		varB = count(b * b) - sumB ** 2 / n
+		denominator = np.sqrt(varA * varB)
+		# Cancellation leaves tiny non-zero variances for constant coefficients
+		valid = (n >= 2) & (varA > 1e-12 * count(a * a)) & (varB > 1e-12 * count(b * b))
+		k = np.where(valid, cov / denominator, 0.0)
+	return np.clip(k, -1.0, 1.0)
+
+
+# Similarity of coefficient vectors (e.g. CD signatures); genes without coefficient weigh 1.0
+SIMILARITY_WEIGHTED_METHODS = {'weighted_jaccard': similarity_weighted_jaccard,
+								'cosine': similarity_cosine,
+								'correlation': similarity_correlation}
+
+
+
+# MinHash (approximate Jaccard): MINHASH_SIZE universal hash functions, fixed seed so that
+# signatures stored in the database stay comparable across processes and releases
+MINHASH_SIZE = 128
+MINHASH_BANDS = 32		# LSH banding: MINHASH_SIZE / MINHASH_BANDS rows per band
+_MINHASH_PRIME = np.uint64(4294967311)
+_MINHASH_MAX = np.uint64(0xFFFFFFFF)
+_minhashRng = np.random.RandomState(20181029)
+_MINHASH_A = _minhashRng.randint(1, 2 ** 31, MINHASH_SIZE).astype(np.uint64)
+_MINHASH_B = _minhashRng.randint(0, 2 ** 31, MINHASH_SIZE).astype(np.uint64)
+_BAND_POWERS = np.uint64(0x9E3779B97F4A7C15) ** np.arange(MINHASH_SIZE // MINHASH_BANDS, dtype=np.uint64)
+
+
+def minhash_signature(genes):
+	"""
+	MinHash signature of a geneset
+	
+	:param genes: Iterable<String>
+	:return: ndarray<UInt32> - MINHASH_SIZE minimum hash values
+	"""
+	hashes = np.array(sorted({zlib.crc32(gene.encode('utf-8')) for gene in genes}), dtype=np.uint64)
+	if len(hashes) == 0:
+		return np.full(MINHASH_SIZE, _MINHASH_MAX, dtype=np.uint32)
+	permuted = ((np.outer(hashes, _MINHASH_A) + _MINHASH_B) % _MINHASH_PRIME) & _MINHASH_MAX
+	return permuted.min(axis=0).astype(np.uint32)
+
+
+def minhash_band_hashes(signatures):
+	"""
+	LSH banding: one 64-bit hash per band of each signature
+	
+	:param signatures: ndarray<UInt32> - shape (n, MINHASH_SIZE) or (MINHASH_SIZE,)
+	:return: ndarray<UInt64> - shape (n, MINHASH_BANDS) or (MINHASH_BANDS,)
+	"""
+	signatures = np.asarray(signatures, dtype=np.uint64)
+	bands = signatures.reshape(signatures.shape[:-1] + (MINHASH_BANDS, -1))
+	with np.errstate(over='ignore'):
+		return (bands * _BAND_POWERS).sum(axis=-1, dtype=np.uint64)
+
+
+def similarity_minhash(signatures, query, sizeA, sizeB, method):
+	"""
+	Estimate 'jaccard' or 'overlap' coefficients from MinHash signatures.
+	The Jaccard estimate J is the fraction of agreeing hash values, with
+	standard error sqrt(J(1 - J) / MINHASH_SIZE); the overlap estimate is
+	derived from J and the set sizes (|a AND b| = J (|a| + |b|) / (1 + J)).
+	
+	:param signatures: ndarray<UInt32> - shape (n, MINHASH_SIZE)
+	:param query: ndarray<UInt32> - shape (MINHASH_SIZE,)
+	:param sizeA: ndarray<Int> - shape (n,)
+	:param sizeB: Int
+	:param method: String - 'jaccard' or 'overlap'
+	:return k: ndarray<Float> - estimated coefficients
+	:return error: ndarray<Float> - standard errors of the estimates
+	"""
+	jaccard = (signatures == query).mean(axis=1)
+	error = np.sqrt(jaccard * (1 - jaccard) / MINHASH_SIZE)
+	if method == 'jaccard':
+		return jaccard, error
+	
+	minimum = np.minimum(sizeA, sizeB).astype(np.float64)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		scale = np.where(minimum > 0, (sizeA + sizeB) / minimum, 0.0)
+	k = np.minimum(scale * jaccard / (1 + jaccard), 1.0)
+	error = scale * error / (1 + jaccard) ** 2
+	return k, error
+
+
+
+def enrichment_hypergeom(overlap, setSize, querySize, universeSize):
+	"""
+	Over-representation p-values (one-sided hypergeometric test): the probability
+	of drawing at least 'overlap' geneset members in a query of 'querySize' genes
+	from a universe of 'universeSize' genes, 'setSize' of which are in the geneset
+	
+	:param overlap: ndarray<Int>
+	:param setSize: ndarray<Int>
+	:param querySize: Int
+	:param universeSize: Int
+	:return: ndarray<Float>
+	"""
+	return hypergeom.sf(np.asarray(overlap) - 1, universeSize, setSize, querySize)
+
+
+def fdr_bh(pValues, nTests=None):
+	"""
+	Benjamini-Hochberg adjusted p-values (FDR)
+	
+	:param pValues: ndarray<Float>
+	:param nTests: Int or None - number of tests, if more than len(pValues)
+		(the missing ones having p = 1)
+	:return: ndarray<Float> - in the order of 'pValues'
+	"""
+	pValues = np.asarray(pValues, dtype=np.float64)
+	m = len(pValues) if nTests is None else nTests
+	order = np.argsort(pValues)
+	ranked = pValues[order] * m / np.arange(1, len(pValues) + 1)
+	ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+	q = np.empty_like(pValues)
+	q[order] = np.minimum(ranked, 1.0)
+	return q
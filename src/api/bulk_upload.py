@@ -0,0 +1,284 @@
+"""
+=====================================================================
+bulk_upload.py: Import many GMTx files into the GeMS Database at once
+=====================================================================
+
+Replaces running 'upload.py' once per file. All files are read once to
+collect their genes, which are resolved in bulk into a single gene-mapping
+snapshot. A pool of worker processes, each seeded with that snapshot, then
+streams, maps and writes the files concurrently. A file that is missing
+or fails is reported in the final summary; the other files still load.
+
+The manifest is a tab-delimited file with the 'upload.py' argument names
+as its header; 'st' and 'do' are optional. Relative file locations are
+resolved against the manifest's directory.
+
+	fl	gf	so	ti	us	st	do
+	data/Reactome/ReactomePathways.gmtx	0	Reactome	9606	Public		pathway
+	data/MSigDB/H__Homo sapiens.gmtx	3	MSigDB	9606	Public	H
+
+Example:
+	[\\GeMS\\src\\api\\] python bulk_upload.py --mf ../../upload_manifest.tsv --np 16
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from contextlib import closing, redirect_stdout
+from io import StringIO
+
+from db_config import COLLECTION_NAME
+from db_utils import db, create_collection, bump_collection_version, FIELD_CONSTRAINTS, INDEX_LIST
+from gmtx_utils import stream_file, make_col_search_dict, split_genes, make_fingerprint_seed, make_default_json
+from map_utils import buildMappingSnapshot, loadMappingSnapshot
+from upload import upload_file, get_fingerprints, filter_changed_rows, prune_scope, prune_missing, DEFAULT_CHUNK_SIZE
+
+MANIFEST_HEADERS = ['fl', 'gf', 'so', 'ti', 'us', 'st', 'do']
+COUNT_KEYS = ['rows', 'inserted', 'matched', 'failed', 'skipped', 'deleted']
+REQUIRED_HEADERS = ['fl', 'gf', 'so', 'ti', 'us']
+
+
+def parse_manifest(fileLoc):
+	"""
+	Parse the tab-delimited upload manifest (listed files may be missing: see 'main')
+
+	:param fileLoc: String
+	:return: List<argparse.Namespace> - one per file, with the 'upload.py' arguments
+	"""
+	baseDir = os.path.dirname(os.path.abspath(fileLoc))
+	with open(fileLoc, 'r') as f:
+		headers = f.readline().strip('\n\r').split('\t')
+		assert all(h in headers for h in REQUIRED_HEADERS)
+		assert all(h in MANIFEST_HEADERS for h in headers)
+
+		entries = []
+		for line in f:
+			if line.strip() == '' or line.startswith('#'):
+				continue
+			values = dict(zip(headers, line.strip('\n\r').split('\t')))
+			entry = argparse.Namespace(**{h: values.get(h, '') for h in MANIFEST_HEADERS})
+			entry.gf = int(entry.gf)
+			entry.ti = int(entry.ti)
+			if not os.path.isabs(entry.fl):
+				entry.fl = os.path.join(baseDir, entry.fl)
+
+			assert entry.gf in [0, 1, 2, 3]
+			assert entry.so != '' and entry.us != ''
+			entries.append(entry)
+	return entries
+
+
+def collect_genes(entries, delta=False):
+	"""
+	Read every file once and group its genes by (taxId, gene format)
+
+	:param entries: List<argparse.Namespace>
+	:param delta: Boolean - ignore the rows of unchanged genesets
+	:return: Tuple<Dict, Dict> - {(taxId, geneFormat): Set<String>}, and {entry index: error} of the files that could not be read
+	"""
+	genesByMapping = dict()
+	errors = dict()
+	for i, entry in enumerate(entries):
+		try:
+			headers, rowIterator = stream_file(entry.fl)
+			with closing(rowIterator):
+				fingerprintSeed = make_fingerprint_seed(headers, vars(entry))
+				searchDict, _, _ = make_col_search_dict(headers, entry.gf)
+				genesSearch = searchDict['accepted']['genes']
+				rows = rowIterator
+				if delta:
+					stored = get_fingerprints(entry.so, entry.st, entry.us)
+					counts = {'seen': set(), 'skipped': 0}
+					rows = filter_changed_rows(rowIterator, searchDict['accepted']['setName'], fingerprintSeed, stored, counts)
+				genes = set()
+				for parsedLine in rows:
+					genes.update(gene for gene, _ in split_genes(parsedLine, genesSearch))
+		except Exception as e:
+			errors[i] = describeError(e)
+			continue
+		genesByMapping.setdefault((entry.ti, entry.gf), set()).update(genes)
+	return genesByMapping, errors
+
+
+def describeError(e):
+	"""
+	:param e: Exception
+	:return: String
+	"""
+	return type(e).__name__ + (': ' + str(e) if str(e) != '' else '')
+
+
+def emptyResult(entry, status, error=''):
+	"""
+	:param entry: argparse.Namespace
+	:param status: String - 'ok', 'missing' or 'error'
+	:param error: String
+	:return: Dict - see '_uploadEntry'
+	"""
+	result = {k: 0 for k in COUNT_KEYS}
+	result.update({'file': entry.fl, 'status': status, 'error': error, 'seen': set(), 'seconds': 0.0, 'messages': []})
+	return result
+
+
+def _initWorker(snapshot):
+	"""
+	Pool initializer: install the shared gene-mapping snapshot
+
+	:param snapshot: Dict
+	:return: VOID
+	"""
+	loadMappingSnapshot(snapshot)
+
+
+def _uploadEntry(task):
+	"""
+	Pool task: upload one manifest entry, collecting its standard output.
+	Errors are returned, not raised, so that one file does not stop the others.
+	Nothing is pruned here: see 'prune_entries'.
+
+	:param task: Tuple<Int, argparse.Namespace, Int, Boolean, Boolean>
+	:return: Tuple<Int, Dict> - entry index; counts, status, timing, messages and (delta mode) the set names of the file
+	"""
+	i, entry, chunkSize, ordered, delta = task
+	start = time.time()
+	s = StringIO()
+	seen = set()
+	try:
+		with redirect_stdout(s):
+			totals = upload_file(entry.fl, entry, chunkSize=chunkSize, ordered=ordered, delta=delta, seen=seen)
+		totals.update({'status': 'ok', 'error': ''})
+	except Exception as e:
+		totals = emptyResult(entry, 'error', describeError(e))
+		s.write(traceback.format_exc())
+	totals['seen'] = seen
+	totals['file'] = entry.fl
+	totals['seconds'] = time.time() - start
+	totals['messages'] = s.getvalue().splitlines()
+	return i, totals
+
+
+def prune_entries(entries, results):
+	"""
+	Delta mode '--pr', once every file is loaded: delete the stored genesets of each
+	prune scope (see 'upload.prune_scope') missing from all the files of that scope.
+	A scope with a missing or failed file is not pruned.
+
+	:param entries: List<argparse.Namespace>
+	:param results: List<Dict> - see '_uploadEntry', in the order of 'entries'
+	:return: Dict - {file: number of deleted genesets}, credited to the first file of each scope
+	"""
+	scopes = dict()
+	for entry, r in zip(entries, results):
+		scope = prune_scope(make_default_json(entry, False, None))
+		key = tuple(scope.values())
+		if key not in scopes:
+			scopes[key] = {'scope': scope, 'file': r['file'], 'seen': set(), 'complete': True}
+		scopes[key]['seen'].update(r['seen'])
+		scopes[key]['complete'] = scopes[key]['complete'] and r['status'] == 'ok'
+
+	deleted = dict()
+	for s in scopes.values():
+		if not s['complete']:
+			print('Not pruned (a file of the scope was not loaded): ' + str(s['scope']))
+			continue
+		deleted[s['file']] = prune_missing(s['scope'], s['seen'])
+	return deleted
+
+
+def main():
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--mf', type=str, help='Manifest: tab-delimited file with columns ' + ', '.join(MANIFEST_HEADERS))
+	parser.add_argument('--np', type=int, default=os.cpu_count(), help='Number of worker processes')
+	parser.add_argument('--cs', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size: genesets per bulk write')
+	parser.add_argument('--or', dest='ordered', action='store_true', help='Ordered bulk writes: stop a chunk at the first failing geneset')
+	parser.add_argument('--dl', dest='delta', action='store_true', help='Delta mode: only map and write new or changed genesets')
+	parser.add_argument('--pr', dest='prune', action='store_true', help='Delta mode: delete genesets of each source/subtype/user/taxId/domain missing from its files')
+	parser.add_argument('--lg', type=str, default=None, help='Log file for gene mapping and write errors')
+
+	# Input parameter constraints
+	args = parser.parse_args()
+	assert os.path.isfile(args.mf)
+	assert args.np > 0
+	assert args.cs > 0
+	assert args.delta or not args.prune
+
+	start = time.time()
+	entries = parse_manifest(args.mf)
+	assert len(entries) > 0
+
+	# Missing files are reported and skipped
+	results = [None] * len(entries)
+	for i, entry in enumerate(entries):
+		if not os.path.isfile(entry.fl):
+			results[i] = emptyResult(entry, 'missing', 'File not found')
+			print('Skipped (file not found): ' + entry.fl)
+	found = [i for i, r in enumerate(results) if r is None]
+
+	# Resolve every gene of every file once, in bulk
+	print('Building gene mapping snapshot...')
+	genesByMapping, errors = collect_genes([entries[i] for i in found], args.delta)
+	for j, error in errors.items():
+		results[found[j]] = emptyResult(entries[found[j]], 'error', error)
+		print('Skipped (unreadable): ' + entries[found[j]].fl + ' - ' + error)
+	snapshot = dict()
+	for (taxId, geneFormat), genes in genesByMapping.items():
+		snapshot.update(buildMappingSnapshot(genes, taxId, geneFormat))
+	print('{} genes resolved in {:.1f} s'.format(len(snapshot), time.time() - start))
+
+	# Create collection
+	if COLLECTION_NAME not in db.collection_names():
+		create_collection(db, COLLECTION_NAME, FIELD_CONSTRAINTS, INDEX_LIST)
+
+	# Map and write the files concurrently ('spawn': every worker opens its own MongoClient), reporting each as it finishes
+	tasks = [(i, entries[i], args.cs, args.ordered, args.delta) for i, r in enumerate(results) if r is None]
+	if len(tasks) > 0:
+		ctx = multiprocessing.get_context('spawn')
+		with ctx.Pool(processes=min(args.np, len(tasks)), initializer=_initWorker, initargs=(snapshot,)) as pool:
+			for i, r in pool.imap_unordered(_uploadEntry, tasks, chunksize=1):
+				results[i] = r
+				print('{}: {} ({:.1f} s)'.format(r['status'], os.path.basename(r['file']), r['seconds']))
+
+	# Prune after all files are written: files of a scope may be loaded by different workers
+	if args.prune:
+		deleted = prune_entries(entries, results)
+		for r in results:
+			r['deleted'] = deleted.get(r['file'], 0)
+		if sum(deleted.values()) > 0:
+			bump_collection_version(db, COLLECTION_NAME)
+
+	# Per-file summary, in manifest order
+	print('\n' + '\t'.join(['file', 'status', 'rows', 'inserted', 'matched', 'failed', 'unchanged', 'deleted', 'errors', 'seconds', 'rows/sec']))
+	for r in results:
+		print('\t'.join(str(x) for x in [
+			os.path.basename(r['file']), r['status'], r['rows'], r['inserted'], r['matched'], r['failed'], r['skipped'], r['deleted'],
+			len(r['messages']), '{:.1f}'.format(r['seconds']), '{:.1f}'.format(r['rows'] / max(r['seconds'], 1e-9))
+		]))
+
+	elapsed = time.time() - start
+	totalRows = sum(r['rows'] for r in results)
+	notLoaded = [r for r in results if r['status'] != 'ok']
+	print('\nTotal: {} files ({} loaded, {} not loaded), {} rows, {} failed in {:.1f} s ({:.1f} rows/sec)'.format(
+		len(results), len(results) - len(notLoaded), len(notLoaded), totalRows, sum(r['failed'] for r in results),
+		elapsed, totalRows / max(elapsed, 1e-9)))
+	if len(notLoaded) > 0:
+		print('\nNot loaded:')
+		for r in notLoaded:
+			print('\t'.join([r['status'], r['file'], r['error']]))
+
+	if args.lg is not None:
+		with open(args.lg, 'w') as f:
+			for r in results:
+				for msg in r['messages']:
+					f.write(r['file'] + '\t' + msg + '\n')
+
+	if len(notLoaded) > 0:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
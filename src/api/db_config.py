@@ -10,14 +10,40 @@ __status__ = "In progress"
 '''
 import os
 
-MONGODB_USERNAME=os.environ['MONGODB_USERNAME']
-MONGODB_PASSWORD=os.environ['MONGODB_PASSWORD']
-MONGODB_HOST=os.environ['MONGODB_HOST']
-MONGODB_PORT=os.environ['MONGODB_PORT']
-MONGODB_DB=os.environ['MONGODB_DB']
+# Optional when the REST-API serves a snapshot (SNAPSHOT_DIR) without forwarding writes
+MONGODB_USERNAME=os.environ.get('MONGODB_USERNAME')
+MONGODB_PASSWORD=os.environ.get('MONGODB_PASSWORD')
+MONGODB_HOST=os.environ.get('MONGODB_HOST')
+MONGODB_PORT=os.environ.get('MONGODB_PORT')
+MONGODB_DB=os.environ.get('MONGODB_DB')
 
 
 # Collection names
 COLLECTION_NAME = 'GeMS_genesets'
 GENE_COL = 'ncbi_gene_info'
 MAPPING_COL = 'ncbi_homologene'
+SIMILARITY_COL = 'GeMS_similarity'
+META_COL = 'GeMS_meta'
+
+
+# Layout of the genesets written by uploads: 1 (gene arrays of strings) or 2 (integer gene IDs, see gene_schema.py)
+SCHEMA_VERSION = int(os.environ.get('GEMS_SCHEMA_VERSION', 1))
+
+
+# Gene mapping cache (entries per lookup table in map_utils)
+MAPPING_CACHE_SIZE = int(os.environ.get('GEMS_MAPPING_CACHE_SIZE', 250000))
+# Seconds between checks for reloaded NCBI collections (the caches are then cleared)
+MAPPING_VERSION_CHECK = float(os.environ.get('GEMS_MAPPING_VERSION_CHECK', 30))
+
+
+# REST-API response cache: 'memory' (per worker), 'disk' (shared by the workers of a host;
+# the default directory is in shared memory on Linux) or 'off'
+RESPONSE_CACHE = os.environ.get('GEMS_RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_BYTES = int(os.environ.get('GEMS_RESPONSE_CACHE_BYTES', 256 * 1024 * 1024))
+RESPONSE_CACHE_DIR = os.environ.get('GEMS_RESPONSE_CACHE_DIR', '/dev/shm/gems_response_cache_{}'.format(os.getuid()))
+
+
+# Read-only serving: answer the read endpoints of the REST-API from a snapshot directory
+# (snapshot.py) instead of MongoDB. Write endpoints are 'disabled' or 'forward'ed to MongoDB
+SNAPSHOT_DIR = os.environ.get('GEMS_SNAPSHOT_DIR')
+SNAPSHOT_WRITES = os.environ.get('GEMS_SNAPSHOT_WRITES', 'disabled')
@@ -28,24 +28,35 @@ Test MV-input:
 import os
 import db_config as cf
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 
-client = MongoClient('mongodb://{}:{}@{}:{}/{}'.format(
-    cf.MONGODB_USERNAME,
-    cf.MONGODB_PASSWORD,
-    cf.MONGODB_HOST,
-    cf.MONGODB_PORT,
-    cf.MONGODB_DB
-))
-
-
-db = client[cf.MONGODB_DB]
+# No client without a configured host (read-only serving from a snapshot, see read_db.py)
+client = None
+db = None
+if cf.MONGODB_HOST is not None:
+    client = MongoClient('mongodb://{}:{}@{}:{}/{}'.format(
+        cf.MONGODB_USERNAME,
+        cf.MONGODB_PASSWORD,
+        cf.MONGODB_HOST,
+        cf.MONGODB_PORT,
+        cf.MONGODB_DB
+    ))
+    db = client[cf.MONGODB_DB]
 
 INDEX_LIST = ['setName', 'source', 'subtype', 'user']
 
 ACCEPTED_HEADERS = ['setName', 'genes', 'xref', 'setId', 'desc']
 ACCEPTED_COEFF_TYPE = ['CD', 'logFC', 'SAM', 'limma', 'gini', 'DESeq']
 
+# Denormalised copies of the 4 positions of the gene arrays in 'genes' (multikey indexed)
+GENE_FIELDS = ['nativeSymbols', 'nativeIds', 'humanSymbols', 'humanIds']
+
+# Integer-encoded genes of schema v2 genesets, in place of 'genes' (see gene_schema.py)
+V2_GENE_FIELDS = ['nativeGeneIds', 'humanGeneIds', 'coeffs', 'symbolOverrides']
+
+# Stored for internal use only: not returned by the REST-API unless explicitly requested
+INTERNAL_FIELDS = ['fingerprint', 'minhash'] + GENE_FIELDS + V2_GENE_FIELDS
+
 FIELD_CONSTRAINTS = {'$jsonSchema': {
 		'bsonType': "object",
 		'required': ['setName',
@@ -53,7 +64,6 @@ FIELD_CONSTRAINTS = {'$jsonSchema': {
 					'subtype',
 					'taxId',
 					'hasCoeff',
-					'genes',
 					'user',
 					'domain',
 					'hasQC', 
@@ -79,8 +89,21 @@ FIELD_CONSTRAINTS = {'$jsonSchema': {
 			'setId': {'bsonType': 'string'},
 			'desc': {'bsonType': 'string'},
 			'meta': {'bsonType': 'object'},
-			'coeffType': {'bsonType': 'string'}
-		}
+			'coeffType': {'bsonType': 'string'},
+			'fingerprint': {'bsonType': 'string'},
+			'nativeSymbols': {'bsonType': 'array', 'items': {'bsonType': 'string'}},
+			'nativeIds': {'bsonType': 'array', 'items': {'bsonType': 'string'}},
+			'humanSymbols': {'bsonType': 'array', 'items': {'bsonType': 'string'}},
+			'humanIds': {'bsonType': 'array', 'items': {'bsonType': 'string'}},
+			'minhash': {'bsonType': 'array'},
+			'nativeGeneIds': {'bsonType': 'array', 'items': {'bsonType': ['int', 'long']}},
+			'humanGeneIds': {'bsonType': 'array', 'items': {'bsonType': ['int', 'long']}},
+			'coeffs': {'bsonType': 'array'},
+			'symbolOverrides': {'bsonType': 'array', 'items': {'bsonType': 'array'}}
+		},
+		# Schema v1 ('genes') or v2 (integer-encoded genes)
+		'anyOf': [{'required': ['genes']},
+				{'required': ['nativeGeneIds', 'humanGeneIds', 'coeffs']}]
 	}
 }
 
@@ -106,5 +129,75 @@ def create_collection(db, name, constraints, indexAttrs):
 						unique=True, 
 						background=True,
 						name='geneset_uniqueness')
+	create_gene_indexes(db, name)
+
+
+def create_gene_indexes(db, name):
+	"""
+	Create the multikey indexes on the flat gene fields and the gene IDs of
+	schema v2 genesets (no-op if they exist)
+	
+	:param db: <class 'pymongo.database.Database'>
+	:param name: String
+	:return: VOID
+	"""
+	for field in GENE_FIELDS + V2_GENE_FIELDS[:2]:
+		db[name].create_index([(field, pymongo.ASCENDING)],
+							background=True,
+							name=field + '_multikey')
+
+
+def flatten_genes(genes):
+	"""
+	Denormalise a 'genes' array into the flat gene fields.
+	Gene order is kept; missing ('') entries are dropped.
 	
+	:param genes: List of [[nSym, nId, hSym, hId], coeff]
+	:return: Dict - {field: List<String>} for every field in GENE_FIELDS
+	"""
+	return {field: [gene[0][i] for gene in genes if gene[0][i] != ''] for i, field in enumerate(GENE_FIELDS)}
+
 
+def fill_human_symbols(collection, docs):
+	"""
+	Genesets uploaded before the flat gene fields have no 'humanSymbols' until
+	'migrate.py --op flatten' has run: derive it from their 'genes', fetched in
+	one query on the unique index
+	
+	:param collection: <class 'pymongo.collection.Collection'>
+	:param docs: List<Dict> - with the INDEX_LIST fields
+	:return: List<Dict> - 'docs', completed in place
+	"""
+	missing = {tuple(d[k] for k in INDEX_LIST): d for d in docs if 'humanSymbols' not in d}
+	if len(missing) > 0:
+		query = {'$or': [dict(zip(INDEX_LIST, key)) for key in missing]}
+		for doc in collection.find(query, {**{k: 1 for k in INDEX_LIST}, 'genes': 1, '_id': 0}):
+			missing[tuple(doc[k] for k in INDEX_LIST)]['humanSymbols'] = flatten_genes(doc.get('genes', []))['humanSymbols']
+		for d in missing.values():
+			d.setdefault('humanSymbols', [])
+	return docs
+	
+
+
+def get_collection_version(db, name):
+	"""
+	Version counter of a collection, increased by every write through the GeMS tools
+	(used to invalidate cached responses and similarity indexes)
+	
+	:param db: <class 'pymongo.database.Database'>
+	:param name: String
+	:return: Int - 0 if never written
+	"""
+	doc = db[cf.META_COL].find_one({'_id': name}, {'version': 1})
+	return 0 if doc is None else doc['version']
+
+
+def bump_collection_version(db, name):
+	"""
+	:param db: <class 'pymongo.database.Database'>
+	:param name: String
+	:return: Int - new version
+	"""
+	doc = db[cf.META_COL].find_one_and_update({'_id': name}, {'$inc': {'version': 1}},
+											upsert=True, return_document=ReturnDocument.AFTER)
+	return doc['version']
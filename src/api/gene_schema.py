@@ -0,0 +1,192 @@
+"""
+=================================================================
+gene_schema.py: Integer-encoded gene storage (genesets schema v2)
+=================================================================
+
+v1 genesets store every gene as an array of four strings plus a coefficient,
+with flat copies of each position (db_utils.GENE_FIELDS):
+
+	'genes': [[['Tubb2a', '498736', 'TUBB2A', '7280'], 1.5], ...]
+
+v2 genesets store the NCBI gene IDs as ints, in parallel with the
+coefficients, and no 'genes', 'nativeIds' or 'humanIds' fields:
+
+	'nativeGeneIds': [498736, ...]		0 if no ID
+	'humanGeneIds': [7280, ...]
+	'coeffs': [1.5, ...]
+	'symbolOverrides': [[0, 'Tubb2a', 'TUBB2A'], ...]	optional
+
+Symbols are resolved from the NCBI gene collection when a geneset is read
+('decode_genesets'); 'symbolOverrides' keeps the stored symbols of the
+positions where they differ (e.g. a synonym given at upload, or a gene
+without an ID). The indexed 'nativeSymbols' and 'humanSymbols' fields are
+kept, so symbol queries, GMT output and similarity are unchanged.
+
+A geneset is only written as v2 if it decodes back to exactly its v1
+'genes' ('encode_genesets'); other genesets stay v1. The REST-API reads
+both layouts and always returns v1 'genes'. After reloading the NCBI
+collections with changed symbols, run 'migrate.py --op v1' first.
+
+"""
+
+from db_utils import GENE_FIELDS, V2_GENE_FIELDS
+from map_utils import getSymbols
+
+# v1 fields that are rebuilt from the v2 fields when read
+DECODED_FIELDS = ['genes', 'nativeIds', 'humanIds']
+
+
+def is_v2(doc):
+	"""
+	:param doc: Dict - geneset
+	:return: Boolean
+	"""
+	return 'nativeGeneIds' in doc
+
+
+def _encodeId(geneId):
+	"""
+	:param geneId: String - '' or a gene ID
+	:return: Int or None - 0 for '', None if the string is not exactly str(int)
+	"""
+	if geneId == '':
+		return 0
+	if geneId.isdigit() and geneId[0] != '0':
+		return int(geneId)
+	return None
+
+
+def gene_id_clauses(gene):
+	"""
+	Query clauses matching a gene ID in the v2 fields
+
+	:param gene: String - query gene
+	:return: List<Dict> - empty if 'gene' is not a gene ID
+	"""
+	geneId = _encodeId(gene)
+	if not geneId:
+		return []
+	return [{'nativeGeneIds': geneId}, {'humanGeneIds': geneId}]
+
+
+def read_projection(projection):
+	"""
+	Extend a MongoDB projection by the v2 fields needed to rebuild its v1 gene fields
+
+	:param projection: Dict or None - exclusion or inclusion projection
+	:return: Dict or None
+	"""
+	if projection is None:
+		return None
+	fields = {k: v for k, v in projection.items() if k != '_id'}
+	projection = dict(projection)
+	if len(fields) > 0 and all(fields.values()):
+		if any(field in fields for field in DECODED_FIELDS):
+			projection.update({field: 1 for field in V2_GENE_FIELDS})
+	else:
+		for field in V2_GENE_FIELDS:
+			projection.pop(field, None)
+	return projection
+
+
+def _decodeGenes(doc, symbols):
+	"""
+	:param doc: Dict - v2 geneset
+	:param symbols: Dict - {geneId: symbol}
+	:return: List - v1 'genes'
+	"""
+	overrides = {i: (nSym, hSym) for i, nSym, hSym in doc.get('symbolOverrides', [])}
+	genes = []
+	for i, (nId, hId, coeff) in enumerate(zip(doc['nativeGeneIds'], doc['humanGeneIds'], doc['coeffs'])):
+		if i in overrides:
+			nSym, hSym = overrides[i]
+		else:
+			nSym, hSym = symbols.get(nId, ''), symbols.get(hId, '')
+		genes.append([[nSym, str(nId) if nId else '', hSym, str(hId) if hId else ''], coeff])
+	return genes
+
+
+def _symbolsOf(docs):
+	"""
+	:param docs: Iterable<Dict> - v2 genesets
+	:return: Dict - {geneId: symbol} for all their gene IDs
+	"""
+	ids = {geneId for doc in docs for geneId in doc['nativeGeneIds'] + doc['humanGeneIds'] if geneId}
+	return getSymbols(ids) if len(ids) > 0 else dict()
+
+
+def decode_genesets(docs, fields=None):
+	"""
+	Rewrite v2 genesets (in place) with their v1 gene fields; v1 genesets are left as they are
+
+	:param docs: List<Dict> - genesets, read with 'read_projection'
+	:param fields: Iterable<String> or None - v1 fields to rebuild (None: 'genes' only)
+	:return: List<Dict> - 'docs'
+	"""
+	fields = ['genes'] if fields is None else [f for f in DECODED_FIELDS if f in fields]
+	encoded = [doc for doc in docs if is_v2(doc)]
+	if len(encoded) == 0:
+		return docs
+	symbols = _symbolsOf(encoded)
+	for doc in encoded:
+		genes = _decodeGenes(doc, symbols)
+		for field in V2_GENE_FIELDS:
+			doc.pop(field, None)
+		if 'genes' in fields:
+			doc['genes'] = genes
+		for i, field in enumerate(GENE_FIELDS):
+			if field in fields:
+				doc[field] = [gene[0][i] for gene in genes if gene[0][i] != '']
+	return docs
+
+
+def encode_genes(genes, symbols):
+	"""
+	v2 gene fields of a v1 'genes' array
+
+	:param genes: List - [[nSym, nId, hSym, hId], coeff] per gene
+	:param symbols: Dict - {geneId: symbol}, covering the IDs of 'genes'
+	:return: Dict or None - None if 'genes' does not decode back exactly
+	"""
+	nativeIds, humanIds, coeffs, overrides = [], [], [], []
+	for i, ((nSym, nId, hSym, hId), coeff) in enumerate(genes):
+		nId, hId = _encodeId(nId), _encodeId(hId)
+		if nId is None or hId is None:
+			return None
+		if (nSym, hSym) != (symbols.get(nId, ''), symbols.get(hId, '')):
+			overrides.append([i, nSym, hSym])
+		nativeIds.append(nId)
+		humanIds.append(hId)
+		coeffs.append(coeff)
+	encoded = {'nativeGeneIds': nativeIds, 'humanGeneIds': humanIds, 'coeffs': coeffs}
+	if len(overrides) > 0:
+		encoded['symbolOverrides'] = overrides
+	if _decodeGenes(encoded, symbols) != genes:
+		return None
+	return encoded
+
+
+def encode_genesets(docs):
+	"""
+	v2 layout of a batch of v1 genesets (gene symbols looked up once for the batch)
+
+	:param docs: List<Dict> - v1 genesets with 'genes'
+	:return: List<Dict or None> - v2 gene fields per geneset, None for those that stay v1
+	"""
+	ids = set()
+	for doc in docs:
+		for (_, nId, _, hId), _ in doc['genes']:
+			ids.update(x for x in (_encodeId(nId), _encodeId(hId)) if x)
+	symbols = getSymbols(ids) if len(ids) > 0 else dict()
+	return [encode_genes(doc['genes'], symbols) for doc in docs]
+
+
+def to_v2(doc, encoded):
+	"""
+	:param doc: Dict - v1 geneset (unchanged)
+	:param encoded: Dict - from 'encode_genesets'
+	:return: Dict - v2 geneset
+	"""
+	v2 = {k: v for k, v in doc.items() if k not in DECODED_FIELDS}
+	v2.update(encoded)
+	return v2
@@ -10,30 +10,75 @@ __status__ = "In progress"
 """
 
 import datetime
+import hashlib
+from itertools import islice
 
-from db_utils import ACCEPTED_HEADERS, ACCEPTED_COEFF_TYPE
-from map_utils import getGeneArray
+from db_config import SCHEMA_VERSION
+from db_utils import ACCEPTED_HEADERS, ACCEPTED_COEFF_TYPE, flatten_genes
+from map_utils import getGeneArrays
+from app_utils import minhash_signature
+from gene_schema import encode_genesets, to_v2
 
+# Upload parameters that take part in a geneset's content fingerprint
+FINGERPRINT_PARAMS = ['gf', 'so', 'st', 'ti', 'us', 'do']
 
-def parse_file(file):
+
+def iter_chunks(iterable, size):
 	"""
-	Parse .GMTX tab-delimited file
+	Split any iterable into lists of at most 'size' elements
+	
+	:param iterable: Iterable
+	:param size: Int
+	:return: Generator<List>
+	"""
+	it = iter(iterable)
+	chunk = list(islice(it, size))
+	while chunk:
+		yield chunk
+		chunk = list(islice(it, size))
+
+
+def stream_file(file):
+	"""
+	Stream a .GMTX tab-delimited file: the header is read immediately,
+	the rows are parsed lazily. The file is closed once the rows are exhausted
+	or the row iterator is closed (e.g. with contextlib.closing, when the header
+	is rejected before any row is read)
 	
 	:param file: String
 	:return headerList: List<String>
-	:return rawDataList: List<String>
+	:return rowIterator: Generator<List<String>>
 	"""
-	l = []
 	try:
-		with open(file, "r") as f:
-			for line in f:
-				parsedLine = line.strip('\t\n\r').split('\t')
-				l.append(parsedLine)
+		f = open(file, "r")
 	except FileNotFoundError:
 		print("Place file in main directory or update filename in the script.")
 		raise
-	headerList = l[0]
-	rawDataList = l[1:]
+	rowIterator = _iter_rows(f)
+	headerList = next(rowIterator, [''])
+	return headerList, rowIterator
+
+
+def _iter_rows(f):
+	"""
+	:param f: <class '_io.TextIOWrapper'>
+	:return: Generator<List<String>> - the header, then the rows
+	"""
+	with f:
+		for line in f:
+			yield line.strip('\t\n\r').split('\t')
+
+
+def parse_file(file):
+	"""
+	Parse .GMTX tab-delimited file
+	
+	:param file: String
+	:return headerList: List<String>
+	:return rawDataList: List<String>
+	"""
+	headerList, rowIterator = stream_file(file)
+	rawDataList = list(rowIterator)
 	return headerList, rawDataList
 
 
@@ -133,6 +178,35 @@ def make_col_search_dict(headerList, geneFormat):
 	return searchDict, useCoeff, coeffType
 	
 
+def make_fingerprint_seed(headerList, params):
+	"""
+	Hash state shared by every row of an upload: the raw header line and the
+	upload parameters. Must be called before 'make_col_search_dict', which
+	rewrites the 'genes' header.
+	
+	:param headerList: List<String>
+	:param params: Dict - 'upload.py' arguments (gf, so, ti, us, st, do)
+	:return: <class '_hashlib.HASH'>
+	"""
+	seed = hashlib.sha1()
+	seed.update('\t'.join(headerList).encode('utf-8'))
+	seed.update(repr([params.get(k, '') for k in FINGERPRINT_PARAMS]).encode('utf-8'))
+	return seed
+	
+
+def make_fingerprint(seed, parsedLine):
+	"""
+	Content fingerprint of a raw GMTx row (plus header and upload parameters)
+	
+	:param seed: <class '_hashlib.HASH'> - from 'make_fingerprint_seed'
+	:param parsedLine: List<String>
+	:return: String - hex digest
+	"""
+	h = seed.copy()
+	h.update(('\n' + '\t'.join(parsedLine)).encode('utf-8'))
+	return h.hexdigest()
+	
+
 def genesQC(genesArray):
 	"""
 	If the gene array is full, return True. 
@@ -143,43 +217,50 @@ def genesQC(genesArray):
 	return all(all(x != '' for x in gene[0]) for gene in genesArray)
 	
 
-def make_batch_input(genesetList, searchDict, constantJSON):
+def split_genes(parsedLine, genesSearch):
+	"""
+	Extract the (gene, coefficient) pairs of a parsed row
+	
+	:param parsedLine: List<String>
+	:param genesSearch: Dict - searchDict['accepted']['genes']
+	:return: List<Tuple<String, Float or None>>
+	"""
+	rawGeneset = parsedLine[genesSearch['startCol']:]
+	
+	# Format 1: 'GENE'
+	if genesSearch['num'] == False:
+		return [(gene, None) for gene in rawGeneset]
+	
+	# Format 2: 'GENE | VALUE'
+	splitGeneset = [ent.split(' | ') for ent in rawGeneset]
+	return [(entry[0], float(entry[1])) for entry in splitGeneset]
+	
+
+def make_batch_input(genesetList, searchDict, constantJSON, fingerprintSeed=None):
 	"""	
+	All genes of the batch are resolved together with 'getGeneArrays', so
+	the number of mapping queries depends on the distinct genes, not the rows.
+	
 	:param genesetList: List<String>
 	:param searchDict: Dict
 	:param constantJSON: Dict
+	:param fingerprintSeed: <class '_hashlib.HASH'> or None - adds a 'fingerprint' field if given
 	:return: List<Dict>
 	"""
+	# Split gene columns and map every gene of the batch in one go
+	genesSearch = searchDict['accepted']['genes']
+	rawGenesets = [split_genes(parsedLine, genesSearch) for parsedLine in genesetList]
+	allGenes = [gene for rawGeneset in rawGenesets for gene, _ in rawGeneset]
+	geneArrays = iter(getGeneArrays(allGenes, constantJSON['taxId'], genesSearch['format']))
+	
 	outputList = []
-	for parsedLine in genesetList:
+	for parsedLine, rawGeneset in zip(genesetList, rawGenesets):
 		d = {}
 		
 		# Iterate over keys in searchDict['accepted']
 		for k, v in searchDict['accepted'].items():
 			if k == 'genes':
-				rawGeneset = parsedLine[v['startCol']:]
-				formatN = v['format']
-				
-				# Format 1: 'GENE'
-				if v['num'] == False:
-					orgGene = []
-					for gene in rawGeneset:
-						geneArray = getGeneArray(gene, constantJSON['taxId'], formatN)
-						# geneArray = [''] * 4
-						# geneArray[formatN] = gene
-						orgGene.append([geneArray, None])
-				
-				# Format 2: 'GENE | VALUE'
-				else:
-					splitGeneset = [ent.split(' | ') for ent in rawGeneset]
-					orgGene = []
-					for entry in splitGeneset:
-						geneArray = getGeneArray(entry[0], constantJSON['taxId'], formatN)
-						# geneArray = [''] * 4
-						# geneArray[formatN] = entry[0]
-						orgGene.append([geneArray, float(entry[1])])
-				
-				d['genes'] = orgGene
+				d['genes'] = [[next(geneArrays), coeff] for _, coeff in rawGeneset]
 			else:
 				d[k] = parsedLine[v]
 		
@@ -189,12 +270,40 @@ def make_batch_input(genesetList, searchDict, constantJSON):
 			for k, v in searchDict['meta'].items():
 				metaDict[k] = parsedLine[v]
 			d['meta'] = metaDict
+		
+		if fingerprintSeed is not None:
+			d['fingerprint'] = make_fingerprint(fingerprintSeed, parsedLine)
 	
 		outD = dict(list(d.items()) + list(constantJSON.items()))
 		
 		# Quality check gene format
 		outD['hasQC'] = genesQC(outD['genes'])
 		
+		# Indexed flat gene fields and MinHash signature (approximate similarity)
+		outD.update(flatten_genes(outD['genes']))
+		outD['minhash'] = minhash_signature(outD['humanSymbols']).tolist()
+		
 		# Append geneset to batch list
 		outputList.append(outD)
-	return outputList
\ No newline at end of file
+	
+	if SCHEMA_VERSION == 2:
+		# Integer-encoded genes, for the genesets that decode back exactly (the others stay v1)
+		encoded = encode_genesets(outputList)
+		outputList = [d if e is None else to_v2(d, e) for d, e in zip(outputList, encoded)]
+	return outputList
+
+
+def iter_batch_input(genesetIter, searchDict, constantJSON, windowSize, fingerprintSeed=None):
+	"""
+	Streaming 'make_batch_input': map genes and build documents one window
+	of 'windowSize' rows at a time, so memory depends on the window, not the file
+	
+	:param genesetIter: Iterable<List<String>>
+	:param searchDict: Dict
+	:param constantJSON: Dict
+	:param windowSize: Int
+	:param fingerprintSeed: <class '_hashlib.HASH'> or None
+	:return: Generator<Dict>
+	"""
+	for window in iter_chunks(genesetIter, windowSize):
+		yield from make_batch_input(window, searchDict, constantJSON, fingerprintSeed)
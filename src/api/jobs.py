@@ -0,0 +1,121 @@
+"""
+=======================================================
+jobs.py: In-process background jobs for the REST-API
+=======================================================
+
+Long-running work (e.g. similarity matrices) is queued on a small thread pool
+inside the API worker process; the request returns a job ID straight away and
+clients poll '/api/jobs/<jobId>' for progress and results. Job records live in
+the memory of the worker that accepted the job and are dropped JOB_TTL seconds
+after they finish.
+
+"""
+
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = 2
+JOB_TTL = 24 * 3600
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+_jobs = dict()
+_jobsLock = threading.Lock()
+
+
+class Job(object):
+	def __init__(self, kind):
+		self.id = uuid.uuid4().hex
+		self.kind = kind
+		self.status = 'queued'
+		self.progress = dict()
+		self.result = None
+		self.error = None
+		self.created = time.time()
+		self.finished = None
+		self.lock = threading.Lock()
+
+
+	def update(self, **progress):
+		"""
+		Record progress counters (e.g. rows written)
+
+		:return: VOID
+		"""
+		with self.lock:
+			self.progress.update(progress)
+
+
+	def toDict(self):
+		"""
+		:return: Dict - JSON-serialisable status of the job
+		"""
+		with self.lock:
+			return {'jobId': self.id,
+					'kind': self.kind,
+					'status': self.status,
+					'progress': dict(self.progress),
+					'result': self.result,
+					'error': self.error,
+					'created': self.created,
+					'finished': self.finished}
+
+
+def _run(job, fn, args, kwargs):
+	"""
+	:param job: Job
+	:param fn: Callable - called as fn(job, *args, **kwargs), returns the job result
+	:return: VOID
+	"""
+	job.status = 'running'
+	try:
+		result = fn(job, *args, **kwargs)
+		with job.lock:
+			job.result = result
+			job.status = 'done'
+	except Exception as e:
+		with job.lock:
+			job.error = '{}: {}'.format(type(e).__name__, e)
+			job.status = 'failed'
+		traceback.print_exc()
+	finally:
+		job.finished = time.time()
+
+
+def _expire():
+	"""
+	Forget jobs finished more than JOB_TTL seconds ago
+
+	:return: VOID
+	"""
+	now = time.time()
+	with _jobsLock:
+		for jobId in [k for k, v in _jobs.items() if v.finished is not None and now - v.finished > JOB_TTL]:
+			del _jobs[jobId]
+
+
+def submitJob(kind, fn, *args, **kwargs):
+	"""
+	Queue fn(job, *args, **kwargs) on the job pool
+
+	:param kind: String - job type, reported in the status
+	:param fn: Callable
+	:return: Job
+	"""
+	_expire()
+	job = Job(kind)
+	with _jobsLock:
+		_jobs[job.id] = job
+	_executor.submit(_run, job, fn, args, kwargs)
+	return job
+
+
+def getJob(jobId):
+	"""
+	:param jobId: String
+	:return: Job or None
+	"""
+	with _jobsLock:
+		return _jobs.get(jobId)
@@ -18,16 +18,207 @@ Positive tests:
 Negative tests:
 	> getFromNativeSymbol(nSym='X', taxId=10116)       => ['X', '', '', '']
 
+Caching:
+	All lookups are memoised in process-local LRU caches (see 'getMappingCacheStats'),
+	shared by the request and job threads. ncbi_gene_mapper/run.py bumps the version of
+	the NCBI collections (db_utils.get_collection_version) when it reloads them; the
+	caches are cleared once a lookup sees a new version (checked at most every
+	MAPPING_VERSION_CHECK seconds). 'clearMappingCache' clears them at once.
+
 '''
 
 import os
 import sys
+import threading
+import time
+from collections import OrderedDict
 
-from db_config import GENE_COL, MAPPING_COL
-from db_utils import db
+from db_config import GENE_COL, MAPPING_COL, MAPPING_CACHE_SIZE, MAPPING_VERSION_CHECK
+from db_utils import db, get_collection_version
+from stdout_capture import captureStdout
 
 HUMAN_TAX_ID = 9606
 
+# Maximum number of identifiers per '$in' query in the batched lookups
+BATCH_QUERY_SIZE = 10000
+
+
+class LRUCache(object):
+	"""
+	Size-bounded mapping with least-recently-used eviction and hit/miss counters.
+	Thread-safe: every access holds the cache's lock.
+	"""
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.hits = 0
+		self.misses = 0
+		self._store = OrderedDict()
+		self._lock = threading.Lock()
+
+
+	def get(self, key, default=None):
+		"""
+		:param key: Hashable
+		:param default: Any - returned (and counted as a miss) if key is not cached
+		:return: Any
+		"""
+		with self._lock:
+			try:
+				value = self._store[key]
+			except KeyError:
+				self.misses += 1
+				return default
+			self._store.move_to_end(key)
+			self.hits += 1
+			return value
+
+
+	def put(self, key, value):
+		"""
+		:param key: Hashable
+		:param value: Any
+		:return: VOID
+		"""
+		with self._lock:
+			self._store[key] = value
+			self._store.move_to_end(key)
+			while len(self._store) > self.maxSize:
+				self._store.popitem(last=False)
+
+
+	def peek(self, key, default=None):
+		"""
+		Read without touching the recency order or the counters
+		
+		:param key: Hashable
+		:param default: Any
+		:return: Any
+		"""
+		with self._lock:
+			return self._store.get(key, default)
+
+
+	def __contains__(self, key):
+		with self._lock:
+			return key in self._store
+
+
+	def __len__(self):
+		with self._lock:
+			return len(self._store)
+
+
+	def clear(self):
+		with self._lock:
+			self._store.clear()
+			self.hits = 0
+			self.misses = 0
+
+
+	def stats(self):
+		"""
+		:return: Dict
+		"""
+		with self._lock:
+			return {'size': len(self._store),
+					'maxSize': self.maxSize,
+					'hits': self.hits,
+					'misses': self.misses}
+
+
+# Sentinel for 'not cached' (None is a valid cached value: 'not found in the collection')
+_MISSING = object()
+
+_geneArrayCache = LRUCache(MAPPING_CACHE_SIZE)		# (gene, taxId, format) -> (geneArray, stdout)
+_symToIdCache = LRUCache(MAPPING_CACHE_SIZE)		# (symbol, taxId) -> geneId or None
+_idToSymCache = LRUCache(MAPPING_CACHE_SIZE)		# geneId -> symbol or None
+_homologCache = LRUCache(MAPPING_CACHE_SIZE)		# (geneId, taxId) -> List<geneId>
+
+_CACHES = {'geneArray': _geneArrayCache,
+			'symToId': _symToIdCache,
+			'idToSym': _idToSymCache,
+			'homolog': _homologCache}
+
+
+# (gene version, homologene version) the caches were filled from, and when it was last checked
+_mappingVersion = None
+_mappingVersionCheckedAt = 0.0
+_mappingVersionLock = threading.Lock()
+
+
+def clearMappingCache():
+	"""
+	Invalidation hook: drop every cached mapping.
+	
+	:return: VOID
+	"""
+	for cache in _CACHES.values():
+		cache.clear()
+
+
+def syncMappingCache():
+	"""
+	Clear the caches if the NCBI collections were reloaded since the last check.
+	Queries the versions at most once every MAPPING_VERSION_CHECK seconds.
+	
+	:return: VOID
+	"""
+	global _mappingVersion, _mappingVersionCheckedAt
+	if db is None or time.time() - _mappingVersionCheckedAt < MAPPING_VERSION_CHECK:
+		return
+	with _mappingVersionLock:
+		if time.time() - _mappingVersionCheckedAt < MAPPING_VERSION_CHECK:
+			return
+		version = (get_collection_version(db, GENE_COL), get_collection_version(db, MAPPING_COL))
+		if _mappingVersion is not None and version != _mappingVersion:
+			clearMappingCache()
+		_mappingVersion = version
+		_mappingVersionCheckedAt = time.time()
+
+
+def buildMappingSnapshot(genes, taxId, geneFormat):
+	"""
+	Resolve genes into a picklable snapshot of the gene array cache, which
+	'loadMappingSnapshot' installs in another process (e.g. upload workers).
+	Error messages are kept in the snapshot and replayed by the consumer.
+	
+	:param genes: Iterable<Int or String>
+	:param taxId: Int
+	:param geneFormat: Int
+	:return: Dict - {(gene, taxId, geneFormat): (geneArray, messages)}
+	"""
+	snapshot = dict()
+	distinct = list(dict.fromkeys(str(g) for g in genes))
+	for chunk in _chunks(distinct, BATCH_QUERY_SIZE):
+		with captureStdout():
+			getGeneArrays(chunk, taxId, geneFormat)
+		for gene in chunk:
+			key = (gene, taxId, geneFormat)
+			cached = _geneArrayCache.peek(key)
+			if cached is not None:
+				snapshot[key] = cached
+	return snapshot
+
+
+def loadMappingSnapshot(snapshot):
+	"""
+	Seed the gene array cache from 'buildMappingSnapshot' output.
+	The cache is enlarged if needed so that no snapshot entry is evicted.
+	
+	:param snapshot: Dict
+	:return: VOID
+	"""
+	_geneArrayCache.maxSize = max(_geneArrayCache.maxSize, len(_geneArrayCache) + len(snapshot))
+	for k, v in snapshot.items():
+		_geneArrayCache.put(k, v)
+
+
+def getMappingCacheStats():
+	"""
+	:return: Dict<Dict> - size, maxSize, hits and misses per lookup table
+	"""
+	return {k: v.stats() for k, v in _CACHES.items()}
+
 
 def _mapIdtoId(id, mapTo):
 	"""
@@ -39,6 +230,10 @@ def _mapIdtoId(id, mapTo):
 	:return: List<Int> - Gene ID (generally should only contain 1 gene ID)
 	"""
 	id = int(id)
+	mappedIds = _homologCache.get((id, mapTo), _MISSING)
+	if mappedIds is not _MISSING:
+		return mappedIds
+	
 	_match = {'$match': {"members.taxId": mapTo, "members.geneId": id}}
 	_project = {'$project': {
 			'members': {
@@ -53,6 +248,7 @@ def _mapIdtoId(id, mapTo):
 	filterLogic = [_match, _project]
 	mapQuery = db[MAPPING_COL].aggregate(filterLogic)
 	mappedIds = [x['geneId'] for l in mapQuery for x in l['members']]
+	_homologCache.put((id, mapTo), mappedIds)
 	return mappedIds
 
 
@@ -65,12 +261,15 @@ def _idToSym(id):
 	:return: String - Gene symbol
 	"""
 	id = int(id)
-	findDict = db[GENE_COL].find_one({'geneId': id})
-	if findDict == None:
+	geneSymbol = _idToSymCache.get(id, _MISSING)
+	if geneSymbol is _MISSING:
+		findDict = db[GENE_COL].find_one({'geneId': id})
+		geneSymbol = None if findDict == None else findDict['Symbol']
+		_idToSymCache.put(id, geneSymbol)
+	
+	if geneSymbol == None:
 		print("Error: Gene ID - " + str(id) + " is not valid.")
 		geneSymbol = ""
-	else:
-		geneSymbol = findDict['Symbol']
 	return geneSymbol
 	
 	
@@ -82,19 +281,26 @@ def _symToId(sym, taxId):
 	:param sym: String
 	:param taxId: Int or String<Empty>
 	"""
-	findDict = db[GENE_COL].find_one({'Symbol_official': sym, 'taxId': taxId})
-	if findDict == None:
-		findDict = db[GENE_COL].find_one({'Symbol': sym, 'taxId': taxId})
-	if findDict == None:
-		# Try synonym search before error
-		findSynonyms = db[GENE_COL].find({'Synonyms': sym, 'taxId': taxId})
-		if findSynonyms.count() == 1:
-			geneId = findSynonyms[0]['geneId']
+	geneId = _symToIdCache.get((sym, taxId), _MISSING)
+	if geneId is _MISSING:
+		findDict = db[GENE_COL].find_one({'Symbol_official': sym, 'taxId': taxId})
+		if findDict == None:
+			findDict = db[GENE_COL].find_one({'Symbol': sym, 'taxId': taxId})
+		if findDict == None:
+			# Try synonym search before error
+			# Two documents tell whether the synonym is unique (Cursor.count() was removed in pymongo 4)
+			findSynonyms = list(db[GENE_COL].find({'Synonyms': sym, 'taxId': taxId}, {'geneId': 1}, limit=2))
+			if len(findSynonyms) == 1:
+				geneId = findSynonyms[0]['geneId']
+			else:
+				geneId = None
 		else:
-			print("Error: " + sym + " (taxId  " + str(taxId) + ") is not valid.")
-			geneId = ""
-	else:
-		geneId = findDict['geneId']
+			geneId = findDict['geneId']
+		_symToIdCache.put((sym, taxId), geneId)
+	
+	if geneId == None:
+		print("Error: " + sym + " (taxId  " + str(taxId) + ") is not valid.")
+		geneId = ""
 	return geneId
 
 
@@ -221,11 +427,42 @@ def getGeneArray(inputGene, taxId, geneFormat):
 	2 -> Humanised gene symbol
 	3 -> Humanised gene ID
 	
+	Results are memoised on (gene, taxId, format). The error messages printed
+	while inferring a gene array are cached alongside it and replayed on every
+	hit, so callers capturing standard output (e.g. 'upload.api_insert') still
+	see one message per invalid gene.
+	
 	:param inputGene: Int or String
 	:param taxId: Int
 	:param geneFormat: Int
 	:return: List<String>
 	"""
+	syncMappingCache()
+	key = (str(inputGene), taxId, geneFormat)
+	cached = _geneArrayCache.get(key)
+	if cached is None:
+		with captureStdout() as s:
+			geneArray = _inferGeneArray(inputGene, taxId, geneFormat)
+		if geneArray is None:
+			return None
+		cached = (tuple(geneArray), s.getvalue())
+		_geneArrayCache.put(key, cached)
+	
+	geneArray, errorMsgs = cached
+	if errorMsgs != '':
+		print(errorMsgs, end='')
+	return list(geneArray)
+
+
+def _inferGeneArray(inputGene, taxId, geneFormat):
+	"""
+	Uncached dispatch for 'getGeneArray'
+	
+	:param inputGene: Int or String
+	:param taxId: Int
+	:param geneFormat: Int
+	:return: List<String> or None
+	"""
 	if geneFormat == 0:
 		return getFromNativeSymbol(inputGene, taxId)
 	elif geneFormat == 1:
@@ -235,3 +472,204 @@ def getGeneArray(inputGene, taxId, geneFormat):
 	elif geneFormat == 3:
 		return getFromHumanisedId(inputGene, taxId)
 
+
+
+
+# Batched lookups
+
+def _chunks(l, n):
+	"""
+	:param l: List
+	:param n: Int
+	:return: Generator<List>
+	"""
+	for i in range(0, len(l), n):
+		yield l[i:i + n]
+
+
+def _toInt(x):
+	"""
+	:param x: Int or String
+	:return: Int or None - None if not a valid integer
+	"""
+	try:
+		return int(x)
+	except (TypeError, ValueError):
+		return None
+
+
+def _prefetchSymToId(syms, taxId):
+	"""
+	Batched '_symToId': resolve symbols with '$in' queries and fill the cache.
+	Same fallback rules: official symbol, then symbol, then a synonym only if
+	exactly one gene carries it.
+	
+	:param syms: List<String>
+	:param taxId: Int
+	:return: Dict - {symbol: geneId or None}
+	"""
+	out = dict()
+	pending = []
+	for sym in dict.fromkeys(syms):
+		cached = _symToIdCache.peek((sym, taxId), _MISSING)
+		if cached is _MISSING:
+			pending.append(sym)
+		else:
+			out[sym] = cached
+	
+	resolved = dict()
+	for field in ['Symbol_official', 'Symbol']:
+		remaining = [sym for sym in pending if sym not in resolved]
+		for chunk in _chunks(remaining, BATCH_QUERY_SIZE):
+			findDocs = db[GENE_COL].find({field: {'$in': chunk}, 'taxId': taxId}, {field: 1, 'geneId': 1})
+			for doc in findDocs:
+				resolved.setdefault(doc[field], doc['geneId'])
+	
+	# Synonym search: only accept synonyms shared by a single gene
+	synonymHits = dict()
+	remaining = [sym for sym in pending if sym not in resolved]
+	for chunk in _chunks(remaining, BATCH_QUERY_SIZE):
+		chunkSet = set(chunk)
+		findDocs = db[GENE_COL].find({'Synonyms': {'$in': chunk}, 'taxId': taxId}, {'Synonyms': 1, 'geneId': 1})
+		for doc in findDocs:
+			for syn in chunkSet.intersection(doc['Synonyms']):
+				synonymHits.setdefault(syn, []).append(doc['geneId'])
+	
+	for sym in pending:
+		if sym in resolved:
+			geneId = resolved[sym]
+		elif len(synonymHits.get(sym, [])) == 1:
+			geneId = synonymHits[sym][0]
+		else:
+			geneId = None
+		_symToIdCache.put((sym, taxId), geneId)
+		out[sym] = geneId
+	return out
+
+
+def _prefetchIdToSym(ids):
+	"""
+	Batched '_idToSym'
+	
+	:param ids: List<Int>
+	:return: Dict - {geneId: symbol or None}
+	"""
+	out = dict()
+	pending = []
+	for id in dict.fromkeys(ids):
+		cached = _idToSymCache.peek(id, _MISSING)
+		if cached is _MISSING:
+			pending.append(id)
+		else:
+			out[id] = cached
+	
+	resolved = dict()
+	for chunk in _chunks(pending, BATCH_QUERY_SIZE):
+		findDocs = db[GENE_COL].find({'geneId': {'$in': chunk}}, {'geneId': 1, 'Symbol': 1})
+		for doc in findDocs:
+			resolved.setdefault(doc['geneId'], doc['Symbol'])
+	
+	for id in pending:
+		_idToSymCache.put(id, resolved.get(id))
+		out[id] = resolved.get(id)
+	return out
+
+
+def _prefetchHomologs(ids, mapTo):
+	"""
+	Batched '_mapIdtoId'
+	
+	:param ids: List<Int>
+	:param mapTo: Int - Taxonomy ID
+	:return: Dict - {geneId: List<Int>}
+	"""
+	out = dict()
+	pending = []
+	for id in dict.fromkeys(ids):
+		cached = _homologCache.peek((id, mapTo), _MISSING)
+		if cached is _MISSING:
+			pending.append(id)
+		else:
+			out[id] = cached
+	
+	mapped = {id: [] for id in pending}
+	for chunk in _chunks(pending, BATCH_QUERY_SIZE):
+		chunkSet = set(chunk)
+		findGroups = db[MAPPING_COL].find({'members.taxId': mapTo, 'members.geneId': {'$in': chunk}}, {'members': 1})
+		for group in findGroups:
+			targets = [x['geneId'] for x in group['members'] if x['taxId'] == mapTo]
+			for id in chunkSet.intersection(x['geneId'] for x in group['members']):
+				mapped[id].extend(targets)
+	
+	for id in pending:
+		_homologCache.put((id, mapTo), mapped[id])
+		out[id] = mapped[id]
+	return out
+
+
+def _prefetchHomologSymbols(ids, mapTo):
+	"""
+	Map gene IDs to 'mapTo' and look up the symbols of the unique homologs
+	
+	:param ids: List<Int>
+	:param mapTo: Int - Taxonomy ID
+	:return: VOID
+	"""
+	homologs = _prefetchHomologs(ids, mapTo)
+	_prefetchIdToSym([v[0] for v in homologs.values() if len(v) == 1])
+
+
+def getSymbols(ids):
+	"""
+	Gene symbols of a list of gene IDs, looked up in bulk (cached). Prints nothing.
+	
+	:param ids: Iterable<Int>
+	:return: Dict - {geneId: symbol}, '' for unknown IDs
+	"""
+	syncMappingCache()
+	return {id: '' if sym is None else sym for id, sym in _prefetchIdToSym(list(ids)).items()}
+
+
+def prefetchGeneArrays(genes, taxId, geneFormat):
+	"""
+	Warm the lookup caches for a list of genes with a handful of '$in' queries
+	per BATCH_QUERY_SIZE distinct identifiers. Prints nothing.
+	
+	:param genes: List<Int or String>
+	:param taxId: Int
+	:param geneFormat: Int
+	:return: VOID
+	"""
+	syncMappingCache()
+	distinct = [g for g in dict.fromkeys(genes) if (str(g), taxId, geneFormat) not in _geneArrayCache]
+	if len(distinct) == 0:
+		return
+	
+	if geneFormat in [0, 2]:
+		symTaxId = taxId if geneFormat == 0 else HUMAN_TAX_ID
+		mapTo = HUMAN_TAX_ID if geneFormat == 0 else taxId
+		symToId = _prefetchSymToId(distinct, symTaxId)
+		if taxId != HUMAN_TAX_ID:
+			_prefetchHomologSymbols([v for v in symToId.values() if v is not None], mapTo)
+	elif geneFormat in [1, 3]:
+		mapTo = HUMAN_TAX_ID if geneFormat == 1 else taxId
+		ids = [x for x in map(_toInt, distinct) if x is not None]
+		_prefetchIdToSym(ids)
+		if taxId != HUMAN_TAX_ID:
+			_prefetchHomologSymbols(ids, mapTo)
+
+
+def getGeneArrays(genes, taxId, geneFormat):
+	"""
+	Vectorised 'getGeneArray': resolve a whole geneset (or file) at once.
+	Distinct identifiers are looked up in bulk; the per-gene inference then
+	runs against the warmed caches, so fallback rules and error messages are
+	identical to calling 'getGeneArray' on each gene in turn.
+	
+	:param genes: List<Int or String>
+	:param taxId: Int
+	:param geneFormat: Int
+	:return: List<List<String>> - in input order
+	"""
+	prefetchGeneArrays(genes, taxId, geneFormat)
+	return [getGeneArray(gene, taxId, geneFormat) for gene in genes]
@@ -0,0 +1,177 @@
+"""
+=========================================================
+migrate.py: Schema migrations for the genesets collection
+=========================================================
+
+Operations (--op):
+	flatten		Backfill the indexed flat gene fields (db_utils.GENE_FIELDS)
+				of existing genesets and create their multikey indexes
+	minhash		Backfill the MinHash signatures used by approximate /api/similar
+				queries (requires 'flatten')
+	v2			Convert genesets to the integer-encoded gene layout (gene_schema.py),
+				only those that decode back exactly (requires 'flatten')
+	v1			Convert schema v2 genesets back to 'genes' arrays (e.g. before the
+				NCBI collections are reloaded)
+
+Example:
+	[\\GeMS\\src\\api\\] python migrate.py --op flatten
+
+"""
+
+import argparse
+import time
+
+from pymongo import UpdateOne
+
+from db_config import COLLECTION_NAME
+from app_utils import minhash_signature
+from db_utils import db, FIELD_CONSTRAINTS, INDEX_LIST, GENE_FIELDS, V2_GENE_FIELDS, create_gene_indexes, flatten_genes, fill_human_symbols, bump_collection_version
+from gene_schema import DECODED_FIELDS, encode_genesets, decode_genesets
+from gmtx_utils import iter_chunks
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def update_validator():
+	"""
+	Replace the collection validator with the current 'FIELD_CONSTRAINTS'
+
+	:return: VOID
+	"""
+	db.command('collMod', COLLECTION_NAME, validator=FIELD_CONSTRAINTS)
+
+
+def migrate_flatten(chunkSize, migrateAll=False):
+	"""
+	Backfill the flat gene fields and create their indexes
+
+	:param chunkSize: Int - documents per bulk write
+	:param migrateAll: Boolean - also rewrite documents that already have the fields
+	:return: Int - number of updated documents
+	"""
+	update_validator()
+
+	# Schema v2 genesets are flattened when written
+	query = {'genes': {'$exists': True}}
+	if not migrateAll:
+		query[GENE_FIELDS[0]] = {'$exists': False}
+	cursor = db[COLLECTION_NAME].find(query, {'genes': 1}, no_cursor_timeout=True)
+	updated = 0
+	try:
+		for chunk in iter_chunks(cursor, chunkSize):
+			requests = [UpdateOne({'_id': d['_id']}, {'$set': flatten_genes(d['genes'])}) for d in chunk]
+			updated += db[COLLECTION_NAME].bulk_write(requests, ordered=False).modified_count
+			print('{} genesets updated'.format(updated))
+	finally:
+		cursor.close()
+
+	create_gene_indexes(db, COLLECTION_NAME)
+	return updated
+
+
+def migrate_minhash(chunkSize, migrateAll=False):
+	"""
+	Backfill the MinHash signatures of the human gene symbols
+	
+	:param chunkSize: Int - documents per bulk write
+	:param migrateAll: Boolean - also rewrite documents that already have a signature
+	:return: Int - number of updated documents
+	"""
+	update_validator()
+	
+	query = {} if migrateAll else {'minhash': {'$exists': False}}
+	cursor = db[COLLECTION_NAME].find(query, {**{k: 1 for k in INDEX_LIST}, 'humanSymbols': 1}, no_cursor_timeout=True)
+	updated = 0
+	try:
+		for chunk in iter_chunks(cursor, chunkSize):
+			# Genesets not yet flattened get the signature of the symbols of their 'genes'
+			fill_human_symbols(db[COLLECTION_NAME], chunk)
+			requests = [UpdateOne({'_id': d['_id']}, {'$set': {'minhash': minhash_signature(d['humanSymbols']).tolist()}}) for d in chunk]
+			updated += db[COLLECTION_NAME].bulk_write(requests, ordered=False).modified_count
+			print('{} genesets updated'.format(updated))
+	finally:
+		cursor.close()
+	return updated
+
+
+def migrate_v2(chunkSize, migrateAll=False):
+	"""
+	Replace 'genes' (and the flat gene ID fields) by integer-encoded genes.
+	Genesets that would not decode back to exactly their 'genes' stay v1.
+	
+	:param chunkSize: Int - documents per bulk write
+	:param migrateAll: Boolean - unused: converted genesets have no 'genes' left
+	:return: Int - number of updated documents
+	"""
+	update_validator()
+	create_gene_indexes(db, COLLECTION_NAME)
+	
+	cursor = db[COLLECTION_NAME].find({'genes': {'$exists': True}}, {'genes': 1}, no_cursor_timeout=True)
+	updated = 0
+	kept = 0
+	try:
+		for chunk in iter_chunks(cursor, chunkSize):
+			requests = []
+			for d, encoded in zip(chunk, encode_genesets(chunk)):
+				if encoded is None:
+					kept += 1
+					continue
+				requests.append(UpdateOne({'_id': d['_id']}, {'$set': encoded, '$unset': {f: '' for f in DECODED_FIELDS}}))
+			if len(requests) > 0:
+				updated += db[COLLECTION_NAME].bulk_write(requests, ordered=False).modified_count
+			print('{} genesets updated, {} kept as v1'.format(updated, kept))
+	finally:
+		cursor.close()
+	return updated
+
+
+def migrate_v1(chunkSize, migrateAll=False):
+	"""
+	Rebuild 'genes' and the flat gene fields of schema v2 genesets
+	
+	:param chunkSize: Int - documents per bulk write
+	:param migrateAll: Boolean - unused
+	:return: Int - number of updated documents
+	"""
+	update_validator()
+	
+	projection = {field: 1 for field in V2_GENE_FIELDS}
+	cursor = db[COLLECTION_NAME].find({'nativeGeneIds': {'$exists': True}}, projection, no_cursor_timeout=True)
+	updated = 0
+	try:
+		for chunk in iter_chunks(cursor, chunkSize):
+			requests = []
+			for d in decode_genesets(chunk):
+				fields = {'genes': d['genes'], **flatten_genes(d['genes'])}
+				requests.append(UpdateOne({'_id': d['_id']}, {'$set': fields, '$unset': {f: '' for f in V2_GENE_FIELDS}}))
+			updated += db[COLLECTION_NAME].bulk_write(requests, ordered=False).modified_count
+			print('{} genesets updated'.format(updated))
+	finally:
+		cursor.close()
+	return updated
+
+
+OPERATIONS = {'flatten': migrate_flatten, 'minhash': migrate_minhash, 'v2': migrate_v2, 'v1': migrate_v1}
+
+
+def main():
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--op', type=str, help='Migration: ' + ', '.join(OPERATIONS))
+	parser.add_argument('--cs', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size: documents per bulk write')
+	parser.add_argument('--all', dest='migrateAll', action='store_true', help='Also rewrite already migrated documents')
+
+	# Input parameter constraints
+	args = parser.parse_args()
+	assert args.op in OPERATIONS
+	assert args.cs > 0
+
+	start = time.time()
+	updated = OPERATIONS[args.op](args.cs, args.migrateAll)
+	if updated > 0:
+		bump_collection_version(db, COLLECTION_NAME)
+	print('Done: {} genesets updated in {:.1f} s'.format(updated, time.time() - start))
+
+
+if __name__ == '__main__':
+	main()
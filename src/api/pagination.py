@@ -0,0 +1,96 @@
+"""
+=====================================================
+pagination.py: Keyset pagination for the REST-API
+=====================================================
+
+Pages are cut on the unique geneset key (setName, source, subtype, user),
+the order of the 'geneset_uniqueness' index: a page is the 'limit' genesets
+following the last key of the previous page, which clients pass back as an
+opaque resume token. Unlike skip(), every page costs one index seek and
+pages stay stable while genesets are added or removed elsewhere.
+
+Ranked results (e.g. /api/similar) are paginated the same way on
+(decreasing coefficient, key).
+
+"""
+
+import base64
+import json
+
+from db_utils import INDEX_LIST
+
+SORT_ORDER = [(k, 1) for k in INDEX_LIST]
+
+
+def parseLimit(limit):
+	"""
+	:param limit: String, Int or None - page size
+	:return: Int or None
+	"""
+	if limit is None:
+		return None
+	assert str(limit).isdecimal() and int(limit) > 0
+	return int(limit)
+
+
+def encodeResumeToken(values):
+	"""
+	:param values: List - sort key of the last item of a page
+	:return: String - URL-safe token
+	"""
+	return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decodeResumeToken(token, length):
+	"""
+	:param token: String
+	:param length: Int - expected number of values: a coefficient per extra value, then the key
+	:return: List
+	:raise ValueError: if the token was not made by 'encodeResumeToken' for this sort key
+	"""
+	values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+	nRanks = length - len(INDEX_LIST)
+	if not (isinstance(values, list) and len(values) == length
+			and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values[:nRanks])
+			and all(isinstance(v, str) for v in values[nRanks:])):
+		raise ValueError('Malformed resume token')
+	return values
+
+
+def makeResumeQuery(key):
+	"""
+	Genesets strictly after 'key' in INDEX_LIST order:
+	(a > a0) OR (a = a0 AND b > b0) OR ...
+
+	:param key: List<String> - (setName, source, subtype, user)
+	:return: Dict - MongoDB filter
+	"""
+	clauses = []
+	for i, field in enumerate(INDEX_LIST):
+		clause = {INDEX_LIST[j]: key[j] for j in range(i)}
+		clause[field] = {'$gt': key[i]}
+		clauses.append(clause)
+	return {'$or': clauses}
+
+
+def paginateRanked(matches, limit, token):
+	"""
+	One page of ranked matches, ordered by decreasing coefficient then key
+
+	:param matches: List<Tuple> - (key, coefficient, ...)
+	:param limit: Int
+	:param token: String or None - resume token of the previous page
+	:return page: List<Tuple>
+	:return nextToken: String or None - None on the last page
+	"""
+	rank = lambda m: (-m[1], m[0])
+	matches = sorted(matches, key=rank)
+	if token is not None:
+		values = decodeResumeToken(token, len(INDEX_LIST) + 1)
+		last = (-values[0], tuple(values[1:]))
+		matches = [m for m in matches if rank(m) > last]
+	page = matches[:limit]
+	nextToken = None
+	if len(matches) > limit:
+		nextToken = encodeResumeToken([page[-1][1]] + list(page[-1][0]))
+	return page, nextToken
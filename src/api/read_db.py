@@ -0,0 +1,30 @@
+"""
+=================================================================
+read_db.py: Database answering the read queries of the REST-API
+=================================================================
+
+'readDb' is MongoDB ('db_utils.db'), or, with db_config.SNAPSHOT_DIR set,
+a read-only 'snapshot.SnapshotDatabase' over a memory-mapped snapshot
+exported by snapshot.py. The snapshot arrays, lookup tables and metadata
+are mapped read-only and decoded on access, so all worker processes of a
+host share one copy in the OS page cache, and no MongoDB connection is
+needed unless writes are forwarded
+(db_config.SNAPSHOT_WRITES = 'forward').
+
+"""
+
+from db_config import SNAPSHOT_DIR, SNAPSHOT_WRITES
+from db_utils import db
+
+assert SNAPSHOT_WRITES in ('disabled', 'forward')
+
+SNAPSHOT_MODE = SNAPSHOT_DIR is not None
+
+if SNAPSHOT_MODE:
+	from snapshot import SnapshotDatabase, load_snapshot
+	readDb = SnapshotDatabase(load_snapshot(SNAPSHOT_DIR))
+else:
+	readDb = db
+
+# Whether the write endpoints are available
+WRITES_ENABLED = db is not None and (not SNAPSHOT_MODE or SNAPSHOT_WRITES == 'forward')
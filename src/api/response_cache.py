@@ -0,0 +1,345 @@
+"""
+========================================================
+response_cache.py: Response cache for the read endpoints
+========================================================
+
+Responses of /api/genesets and /api/similar are cached under a key built
+from the endpoint, the normalised request parameters (sorted keys; 'genes'
+and 'setName' split into sorted lists) and the version counter of the
+genesets collection. Every write through the GeMS tools increases that
+version ('db_utils.bump_collection_version'), so entries of older versions
+are never served again and age out of the cache.
+
+Backends (db_config.RESPONSE_CACHE):
+	memory	In-process LRU, bounded by RESPONSE_CACHE_BYTES (one per worker)
+	disk	One file per entry in RESPONSE_CACHE_DIR, shared by all workers of
+			the host; the least recently used files are deleted once the
+			directory exceeds RESPONSE_CACHE_BYTES. The directory must be
+			owned by the server user and not accessible to others (it is
+			created with mode 0700); entries are plain bytes, not pickles
+	off		No caching
+
+Hits and misses are counted by the backend: per worker with 'memory', for
+all workers of the host with 'disk' (each worker writes its own counter
+file next to the entries, and /cache adds them up).
+
+Streamed responses are cached as they are sent, unless they grow larger
+than MAX_ENTRY_FRACTION of the cache.
+
+"""
+
+import functools
+import hashlib
+import json
+import os
+import stat
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import Response, request
+
+from db_config import COLLECTION_NAME, RESPONSE_CACHE, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_DIR
+from db_utils import get_collection_version
+from read_db import readDb
+
+LIST_PARAMS = ['genes', 'setName']
+CACHED_HEADERS = ['Content-Type', 'X-Resume-Token']
+MAX_ENTRY_FRACTION = 0.125
+COUNTER_FORMAT = '<QQ'		# hits, misses
+
+
+class MemoryBackend(object):
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.entries = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+			return entry
+
+
+	def put(self, key, entry):
+		with self.lock:
+			if key in self.entries:
+				self.size -= len(self.entries.pop(key)[2])
+			self.entries[key] = entry
+			self.size += len(entry[2])
+			while self.size > self.capacity:
+				_, old = self.entries.popitem(last=False)
+				self.size -= len(old[2])
+
+
+	def count(self, hit):
+		with self.lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+
+	def stats(self):
+		with self.lock:
+			return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+
+class DiskBackend(object):
+	def __init__(self, capacity, directory):
+		self.capacity = capacity
+		self.directory = directory
+		os.makedirs(directory, mode=0o700, exist_ok=True)
+		st = os.lstat(directory)
+		assert stat.S_ISDIR(st.st_mode), 'Response cache: {} is not a directory'.format(directory)
+		assert st.st_uid == os.getuid(), 'Response cache: {} is owned by another user'.format(directory)
+		assert st.st_mode & 0o077 == 0, 'Response cache: {} is accessible to other users (expected mode 0700)'.format(directory)
+		self.counts = None		# [hits, misses] of this process, see 'count'
+		self.counterFile = None
+		self.counterPid = None
+		self.lock = threading.Lock()
+
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.entry')
+
+
+	def get(self, key):
+		"""
+		:param key: String
+		:return: Tuple<Int, List, Bytes> or None - (status, headers, body)
+		"""
+		try:
+			with open(self.path(key), 'rb') as f:
+				status, headers = json.loads(f.readline().decode('utf-8'))
+				body = f.read()
+			os.utime(self.path(key))
+			return status, [tuple(h) for h in headers], body
+		except (OSError, ValueError):
+			return None
+
+
+	def put(self, key, entry):
+		"""
+		An entry file is a JSON line [status, headers] followed by the body
+
+		:param key: String
+		:param entry: Tuple<Int, List, Bytes> - (status, headers, body)
+		:return: VOID
+		"""
+		status, headers, body = entry
+		# Written to a temporary file first: other workers only ever see complete entries
+		tmp = os.path.join(self.directory, uuid.uuid4().hex + '.tmp')
+		with open(tmp, 'wb') as f:
+			f.write(json.dumps([status, headers]).encode('utf-8') + b'\n')
+			f.write(body)
+		os.replace(tmp, self.path(key))
+		self.evict()
+
+
+	def listEntries(self):
+		"""
+		:return: List<Tuple<Float, Int, String>> - (last use, bytes, path) per entry
+		"""
+		entries = []
+		for e in os.scandir(self.directory):
+			if e.name.endswith('.entry'):
+				try:
+					st = e.stat()
+					entries.append((st.st_mtime, st.st_size, e.path))
+				except OSError:
+					pass
+		return entries
+
+
+	def evict(self):
+		entries = self.listEntries()
+		size = sum(e[1] for e in entries)
+		for _, entrySize, path in sorted(entries):
+			if size <= self.capacity:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			size -= entrySize
+
+
+	def count(self, hit):
+		"""
+		Count a lookup in the counter file of this process (one writer per file, so no locking
+		between workers; a forked worker starts its own file)
+
+		:param hit: Boolean
+		:return: VOID
+		"""
+		with self.lock:
+			if self.counterPid != os.getpid():
+				self.counterPid = os.getpid()
+				self.counts = [0, 0]
+				self.counterFile = open(os.path.join(self.directory, 'worker-{}.counts'.format(self.counterPid)), 'wb', buffering=0)
+			self.counts[0 if hit else 1] += 1
+			self.counterFile.seek(0)
+			self.counterFile.write(struct.pack(COUNTER_FORMAT, *self.counts))
+
+
+	def readCounts(self):
+		"""
+		:return: Tuple<Int, Int> - hits and misses of all workers that used the directory
+		"""
+		hits, misses = 0, 0
+		size = struct.calcsize(COUNTER_FORMAT)
+		for e in os.scandir(self.directory):
+			if e.name.endswith('.counts'):
+				try:
+					with open(e.path, 'rb') as f:
+						data = f.read(size)
+				except OSError:
+					continue
+				if len(data) == size:
+					workerHits, workerMisses = struct.unpack(COUNTER_FORMAT, data)
+					hits += workerHits
+					misses += workerMisses
+		return hits, misses
+
+
+	def stats(self):
+		entries = self.listEntries()
+		hits, misses = self.readCounts()
+		return {'entries': len(entries), 'bytes': sum(e[1] for e in entries), 'hits': hits, 'misses': misses}
+
+
+	def clear(self):
+		for _, _, path in self.listEntries():
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+class ResponseCache(object):
+	def __init__(self, backend, capacity):
+		self.backend = backend
+		self.capacity = capacity
+
+
+	def makeKey(self, endpoint, params, version):
+		"""
+		:param endpoint: String
+		:param params: Dict - request parameters
+		:param version: Int - collection version
+		:return: String
+		"""
+		normalised = dict()
+		for k, v in params.items():
+			if k in LIST_PARAMS:
+				v = sorted(v.split(',') if isinstance(v, str) else v)
+			normalised[k] = v
+		raw = json.dumps([endpoint, version, normalised], sort_keys=True, default=str)
+		return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+	def store(self, key, response):
+		"""
+		Cache a response (a streamed one as it is being sent)
+
+		:param key: String
+		:param response: flask.Response
+		:return: flask.Response - to be returned to the client
+		"""
+		headers = [(h, response.headers[h]) for h in CACHED_HEADERS if h in response.headers]
+		status = response.status_code
+		if not response.is_streamed:
+			self.backend.put(key, (status, headers, response.get_data()))
+			return response
+
+		maxSize = self.capacity * MAX_ENTRY_FRACTION
+		chunks = response.response
+
+		def tee():
+			parts = []
+			size = 0
+			for chunk in chunks:
+				yield chunk
+				if parts is not None:
+					data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+					size += len(data)
+					parts.append(data)
+					if size > maxSize:
+						parts = None
+			if parts is not None:
+				self.backend.put(key, (status, headers, b''.join(parts)))
+
+		response.response = tee()
+		return response
+
+
+	def stats(self):
+		"""
+		:return: Dict - size, hits and misses of the backend (of this worker with 'memory',
+			of all workers of the host with 'disk')
+		"""
+		stats = {'backend': RESPONSE_CACHE, 'capacity': self.capacity}
+		stats.update(self.backend.stats())
+		lookups = stats['hits'] + stats['misses']
+		stats['hitRatio'] = stats['hits'] / lookups if lookups > 0 else 0.0
+		return stats
+
+
+def makeCache():
+	"""
+	:return: ResponseCache or None - None if caching is off
+	"""
+	if RESPONSE_CACHE == 'memory':
+		return ResponseCache(MemoryBackend(RESPONSE_CACHE_BYTES), RESPONSE_CACHE_BYTES)
+	elif RESPONSE_CACHE == 'disk':
+		return ResponseCache(DiskBackend(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_DIR), RESPONSE_CACHE_BYTES)
+	assert RESPONSE_CACHE == 'off'
+	return None
+
+
+responseCache = makeCache()
+
+
+def cached(endpoint):
+	"""
+	Decorator of Resource methods: serve the response from the cache if the
+	same request was answered at the current collection version
+
+	:param endpoint: String - cache namespace
+	:return: Decorator
+	"""
+	def decorator(method):
+		@functools.wraps(method)
+		def wrapper(*args, **kwargs):
+			if responseCache is None:
+				return method(*args, **kwargs)
+			if request.method == 'GET':
+				params = request.args.to_dict()
+			else:
+				params = request.get_json()
+				if not isinstance(params, dict):
+					return method(*args, **kwargs)
+			key = responseCache.makeKey(endpoint + ':' + request.method, params,
+										get_collection_version(readDb, COLLECTION_NAME))
+			entry = responseCache.backend.get(key)
+			responseCache.backend.count(entry is not None)
+			if entry is not None:
+				status, headers, body = entry
+				return Response(body, status=status, headers=headers)
+			return responseCache.store(key, method(*args, **kwargs))
+		return wrapper
+	return decorator
@@ -0,0 +1,756 @@
+"""
+==================================================================
+similarity_index.py: In-memory inverted index for /api/similar
+==================================================================
+
+Every geneset is assigned an integer slot and every human gene symbol an
+interned integer ID. Each gene ID owns a compact posting list (int32 array)
+of the slots that contain it, and a size array holds the number of distinct
+genes per slot. Intersection counts of a query against every geneset then
+come from a single counting pass over the query genes' postings, and the
+similarity coefficients follow from the sizes without fetching documents.
+
+Batches of queries are answered together from a sparse gene-by-slot
+incidence matrix assembled from the postings ('incidence'), rebuilt lazily
+after the index changes.
+
+For approximate queries every slot also keeps its MinHash signature and the
+LSH band hashes of that signature: candidates are the genesets sharing at
+least one band with the query, scored from signature agreement only.
+
+Weighted queries (app_utils.SIMILARITY_WEIGHTED_METHODS) score the candidates
+from a slot-by-gene coefficient matrix ('weights'). Coefficients are not
+part of the postings: they are loaded per slot on the first weighted query
+and kept until the slot changes.
+
+The index is built lazily from MongoDB on first use ('getIndex') and kept
+up to date by the write endpoints ('refreshGroup', 'remove'). Removed slots are tombstoned and
+compacted away once they dominate the index.
+Writes from elsewhere (other API workers, upload scripts) are detected
+through the collection version counter: the index is rebuilt when it falls
+behind.
+
+When a snapshot is served (see read_db.py), 'SnapshotGenesetIndex' reads the
+postings, sizes, keys and MinHash signatures from the memory-mapped snapshot
+instead: only the batch incidence matrix and the coefficient matrix are
+built per process, on first use.
+
+"""
+
+import heapq
+import threading
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+from app_utils import SIMILARITY_COUNT_METHODS, SIMILARITY_WEIGHTED_METHODS, MINHASH_SIZE, MINHASH_BANDS
+from app_utils import minhash_signature, minhash_band_hashes, similarity_minhash
+from db_config import COLLECTION_NAME
+from db_utils import INDEX_LIST, get_collection_version, fill_human_symbols
+from read_db import readDb, SNAPSHOT_MODE
+from gene_schema import read_projection, decode_genesets
+from gmtx_utils import iter_chunks
+
+# Compact once tombstoned slots outnumber live ones (and there are at least this many)
+COMPACT_MIN_DEAD = 1000
+
+INDEX_PROJECTION = {**{k: 1 for k in INDEX_LIST}, 'taxId': 1, 'humanSymbols': 1, 'minhash': 1, '_id': 0}
+WEIGHT_PROJECTION = {**{k: 1 for k in INDEX_LIST}, 'genes': 1, '_id': 0}
+
+# Genesets per query when loading coefficients
+WEIGHT_QUERY_SIZE = 500
+# Genesets per batch when building the index (see 'db_utils.fill_human_symbols')
+BUILD_CHUNK_SIZE = 500
+
+
+def genesetKey(doc):
+	"""
+	:param doc: Dict - geneset document
+	:return: Tuple<String> - (setName, source, subtype, user)
+	"""
+	return tuple(doc[k] for k in INDEX_LIST)
+
+
+def geneWeights(genes):
+	"""
+	:param genes: List - 'genes' array of a geneset
+	:return: Dict - {human symbol: coefficient}, 1.0 without coefficient, averaged over repeated symbols
+	"""
+	sums = dict()
+	counts = dict()
+	for geneArray, coeff in genes:
+		symbol = geneArray[2]
+		if symbol != '':
+			sums[symbol] = sums.get(symbol, 0.0) + (1.0 if coeff is None else float(coeff))
+			counts[symbol] = counts.get(symbol, 0) + 1
+	return {symbol: total / counts[symbol] for symbol, total in sums.items()}
+
+
+class GenesetIndex(object):
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.version = None		# collection version the index reflects
+		self.generation = 0		# increased by every change (invalidates 'incidence')
+		self._incidence = None
+		self._incidenceGeneration = None
+		self._weights = None
+		self._weightsGeneration = None
+		self.clear()
+
+
+	def clear(self):
+		self.geneIds = dict()		# gene symbol -> interned gene ID
+		self.postings = []			# gene ID -> array('i') of slots
+		self.sizes = array('i')		# slot -> number of distinct genes (0 once removed)
+		self.taxIds = array('i')		# slot -> NCBI taxonomic ID
+		self.keys = []				# slot -> key (None once removed)
+		self.slots = dict()			# key -> slot
+		self.groups = dict()		# (source, subtype, user) -> Set<slot>
+		self.signatures = array('I')	# slot -> MINHASH_SIZE MinHash values (flattened)
+		self.bandHashes = array('Q')	# slot -> MINHASH_BANDS LSH band hashes (flattened)
+		self.weightRows = dict()	# slot -> (gene IDs, coefficients), loaded by weighted queries
+		self.dead = 0
+		self.generation += 1
+
+
+	def __len__(self):
+		return len(self.slots)
+
+
+	def internGenes(self, genes):
+		"""
+		:param genes: Iterable<String>
+		:return: List<Int> - interned gene IDs (new genes are added)
+		"""
+		ids = []
+		for gene in genes:
+			geneId = self.geneIds.get(gene)
+			if geneId is None:
+				geneId = len(self.postings)
+				self.geneIds[gene] = geneId
+				self.postings.append(array('i'))
+			ids.append(geneId)
+		return ids
+
+
+	def lookupGenes(self, genes):
+		"""
+		:param genes: Iterable<String>
+		:return: List<Int> - interned gene IDs of the known genes only
+		"""
+		return [self.geneIds[gene] for gene in genes if gene in self.geneIds]
+
+
+	def add(self, doc):
+		"""
+		Add (or replace) a geneset
+
+		:param doc: Dict - with the INDEX_LIST fields, 'taxId', 'humanSymbols' and optionally 'minhash'
+		:return: Int - slot
+		"""
+		if doc.get('minhash') is not None:
+			signature = np.asarray(doc['minhash'], dtype=np.uint32)
+		else:
+			signature = minhash_signature(doc['humanSymbols'])
+		with self.lock:
+			key = genesetKey(doc)
+			self.remove(key)
+			slot = len(self.keys)
+			geneIds = self.internGenes(set(doc['humanSymbols']))
+			for geneId in geneIds:
+				self.postings[geneId].append(slot)
+			self.sizes.append(len(geneIds))
+			self.taxIds.append(doc.get('taxId', 0))
+			self.signatures.frombytes(signature.tobytes())
+			self.bandHashes.frombytes(minhash_band_hashes(signature).tobytes())
+			self.keys.append(key)
+			self.slots[key] = slot
+			self.groups.setdefault(key[1:], set()).add(slot)
+			self.generation += 1
+			return slot
+
+
+	def remove(self, key):
+		"""
+		Tombstone a geneset (its postings are dropped at the next compaction)
+
+		:param key: Tuple<String> - (setName, source, subtype, user)
+		:return: Boolean - True if the geneset was indexed
+		"""
+		with self.lock:
+			slot = self.slots.pop(tuple(key), None)
+			if slot is None:
+				return False
+			self.groups[tuple(key)[1:]].discard(slot)
+			self.weightRows.pop(slot, None)
+			self.sizes[slot] = 0
+			self.keys[slot] = None
+			self.dead += 1
+			self.generation += 1
+			if self.dead >= COMPACT_MIN_DEAD and self.dead > len(self.slots):
+				self.compact()
+			return True
+
+
+	def compact(self):
+		"""
+		Drop tombstoned slots and renumber the live ones
+
+		:return: VOID
+		"""
+		with self.lock:
+			sizes = np.array(self.sizes, dtype=np.int32)
+			alive = np.array([k is not None for k in self.keys], dtype=bool)
+			newSlot = np.cumsum(alive, dtype=np.int32) - 1
+			for geneId, posting in enumerate(self.postings):
+				p = np.array(posting, dtype=np.int32)
+				self.postings[geneId] = array('i', newSlot[p[alive[p]]].tobytes())
+			self.sizes = array('i', sizes[alive].tobytes())
+			self.taxIds = array('i', np.array(self.taxIds, dtype=np.int32)[alive].tobytes())
+			signatures = np.array(self.signatures, dtype=np.uint32).reshape(-1, MINHASH_SIZE)
+			self.signatures = array('I', signatures[alive].tobytes())
+			bandHashes = np.array(self.bandHashes, dtype=np.uint64).reshape(-1, MINHASH_BANDS)
+			self.bandHashes = array('Q', bandHashes[alive].tobytes())
+			self.weightRows = {int(newSlot[slot]): row for slot, row in self.weightRows.items()}
+			self.keys = [k for k in self.keys if k is not None]
+			self.slots = {k: slot for slot, k in enumerate(self.keys)}
+			self.groups = dict()
+			for slot, k in enumerate(self.keys):
+				self.groups.setdefault(k[1:], set()).add(slot)
+			self.dead = 0
+			self.generation += 1
+
+
+	def build(self, docs):
+		"""
+		:param docs: Iterable<Dict>
+		:return: VOID
+		"""
+		with self.lock:
+			self.clear()
+			for doc in docs:
+				self.add(doc)
+
+
+	def removeGroup(self, source, subtype, user):
+		"""
+		:param source: String
+		:param subtype: String
+		:param user: String
+		:return: VOID
+		"""
+		with self.lock:
+			keys = [self.keys[slot] for slot in self.groups.get((source, subtype, user), [])]
+			for key in keys:
+				self.remove(key)
+
+
+	def refreshGroup(self, source, subtype, user):
+		"""
+		Reload every geneset of one source/subtype/user from MongoDB
+		(after an insert, which may also have pruned genesets)
+
+		:param source: String
+		:param subtype: String
+		:param user: String
+		:return: VOID
+		"""
+		query = {'source': source, 'subtype': subtype, 'user': user}
+		docs = fill_human_symbols(readDb[COLLECTION_NAME], list(readDb[COLLECTION_NAME].find(query, INDEX_PROJECTION)))
+		with self.lock:
+			self.removeGroup(source, subtype, user)
+			for doc in docs:
+				self.add(doc)
+
+
+	def intersectCounts(self, genes):
+		"""
+		Counting pass over the postings of the query genes
+
+		:param genes: Set<String> - human gene symbols
+		:return: ndarray<Int> - intersection size per slot
+		"""
+		# Buffer views must not outlive the lock: a growing array cannot be resized while exported
+		with self.lock:
+			postings = [np.frombuffer(self.postings[g], dtype=np.int32) for g in self.lookupGenes(genes)]
+			nSlots = len(self.keys)
+			if len(postings) == 0:
+				counts = np.zeros(nSlots, dtype=np.int64)
+			else:
+				counts = np.bincount(np.concatenate(postings), minlength=nSlots)
+			del postings
+		return counts
+
+
+	@staticmethod
+	def select(coeffs, threshold, topk):
+		"""
+		Positions of the coefficients passing 'threshold': all of them in order,
+		or the 'topk' best sorted by decreasing coefficient (bounded heap)
+
+		:param coeffs: ndarray<Float>
+		:param threshold: Float
+		:param topk: Int or None
+		:return: List<Int>
+		"""
+		keep = np.flatnonzero(coeffs >= threshold).tolist()
+		if topk is not None:
+			values = coeffs.tolist()
+			keep = heapq.nlargest(topk, keep, key=values.__getitem__)
+		return keep
+
+
+	def query(self, genes, method, threshold, topk=None):
+		"""
+		Exact similarity: indexed genesets whose coefficient with 'genes' is at least 'threshold'
+
+		:param genes: Set<String> - human gene symbols
+		:param method: String - key of app_utils.SIMILARITY_COUNT_METHODS
+		:param threshold: Float
+		:param topk: Int or None - only keep the 'topk' best matches, sorted by coefficient
+		:return: List<Tuple<Tuple<String>, Float>> - (key, coefficient), in slot order unless 'topk'
+		"""
+		with self.lock:
+			counts = self.intersectCounts(genes)
+			sizes = np.array(self.sizes, dtype=np.int32)
+			candidates = np.flatnonzero((counts > 0) & (sizes > 0))
+			coeffs = SIMILARITY_COUNT_METHODS[method](counts[candidates], sizes[candidates], len(genes))
+			return [(self.keys[candidates[i]], coeffs[i].item()) for i in self.select(coeffs, threshold, topk)]
+
+
+	def selectSlots(self, source=None, subtype=None, taxId=None):
+		"""
+		:param source: String or None
+		:param subtype: String or None
+		:param taxId: Int or None
+		:return: ndarray<Boolean> - per slot: live and matching the given fields
+		"""
+		with self.lock:
+			selected = np.zeros(len(self.keys), dtype=bool)
+			for (groupSource, groupSubtype, _), slots in self.groups.items():
+				if (source is None or source == groupSource) and (subtype is None or subtype == groupSubtype):
+					selected[list(slots)] = True
+			if taxId is not None:
+				selected &= np.array(self.taxIds, dtype=np.int32) == taxId
+			return selected
+
+
+	def enrichmentCounts(self, genes, background=None, source=None, subtype=None, taxId=None):
+		"""
+		Inputs of the over-representation test of 'genes' against the selected genesets.
+		The universe is 'background', or all indexed genes; query and genesets are
+		restricted to it.
+		
+		:param genes: Set<String> - human gene symbols
+		:param background: Set<String> or None
+		:param source: String or None
+		:param subtype: String or None
+		:param taxId: Int or None
+		:return keys: List<Tuple<String>> - selected genesets sharing genes with the query
+		:return overlap: ndarray<Int> - genes shared with the query, per geneset in 'keys'
+		:return setSize: ndarray<Int> - geneset sizes within the universe
+		:return querySize: Int
+		:return universeSize: Int
+		:return nTested: Int - number of selected genesets
+		"""
+		with self.lock:
+			if background is None:
+				universeSize = len(self.geneIds)
+				query = {g for g in genes if g in self.geneIds}
+				setSizes = np.array(self.sizes, dtype=np.int64)
+			else:
+				universeSize = len(background)
+				query = set(genes) & background
+				setSizes = self.intersectCounts(background)
+			overlap = self.intersectCounts(query)
+			selected = self.selectSlots(source, subtype, taxId) & (setSizes > 0)
+			candidates = np.flatnonzero(selected & (overlap > 0))
+			keys = [self.keys[slot] for slot in candidates]
+			return keys, overlap[candidates], setSizes[candidates], len(query), universeSize, int(selected.sum())
+
+
+	def incidence(self):
+		"""
+		Gene-by-slot incidence matrix of the postings (tombstoned slots included, with size 0)
+		
+		:return: scipy.sparse.csr_matrix<Int32> - shape (number of genes, number of slots)
+		"""
+		with self.lock:
+			if self._incidenceGeneration != self.generation:
+				lengths = np.array([len(posting) for posting in self.postings], dtype=np.int64)
+				indptr = np.concatenate([[0], np.cumsum(lengths)])
+				indices = np.concatenate([np.array(posting, dtype=np.int32) for posting in self.postings] + [np.zeros(0, dtype=np.int32)])
+				data = np.ones(len(indices), dtype=np.int32)
+				self._incidence = sp.csr_matrix((data, indices, indptr), shape=(len(self.postings), len(self.keys)))
+				self._incidenceGeneration = self.generation
+			return self._incidence
+
+
+	def queryMany(self, geneSets, method, threshold, topk=None):
+		"""
+		Exact similarity of several queries in one pass: the intersection counts of
+		every query with every geneset are one sparse product, queries x genes x slots
+		
+		:param geneSets: List<Set<String>> - human gene symbols per query
+		:param method: String - key of app_utils.SIMILARITY_COUNT_METHODS
+		:param threshold: Float
+		:param topk: Int or None
+		:return: List<List<Tuple<Tuple<String>, Float>>> - per query, as 'query'
+		"""
+		with self.lock:
+			incidence = self.incidence()
+			indptr = [0]
+			indices = []
+			for genes in geneSets:
+				indices.extend(self.lookupGenes(genes))
+				indptr.append(len(indices))
+			queries = sp.csr_matrix((np.ones(len(indices), dtype=np.int32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+									shape=(len(geneSets), incidence.shape[0]))
+			counts = (queries @ incidence).tocsr()
+			sizes = np.array(self.sizes, dtype=np.int32)
+			
+			results = []
+			for i, genes in enumerate(geneSets):
+				slots = counts.indices[counts.indptr[i]:counts.indptr[i + 1]]
+				intersect = counts.data[counts.indptr[i]:counts.indptr[i + 1]]
+				alive = sizes[slots] > 0
+				slots, intersect = slots[alive], intersect[alive]
+				# Slot order, as in 'query'
+				order = np.argsort(slots, kind='stable')
+				slots, intersect = slots[order], intersect[order]
+				coeffs = SIMILARITY_COUNT_METHODS[method](intersect, sizes[slots], len(genes))
+				results.append([(self.keys[slots[j]], coeffs[j].item()) for j in self.select(coeffs, threshold, topk)])
+			return results
+
+
+	def loadWeights(self):
+		"""
+		Fetch the coefficients of the live slots that have none loaded
+
+		:return: VOID
+		"""
+		with self.lock:
+			missing = [slot for slot, key in enumerate(self.keys) if key is not None and slot not in self.weightRows]
+			if len(missing) == 0:
+				return
+			if len(missing) > len(self.slots) // 2:
+				queries = [dict()]
+			else:
+				queries = [{'$or': [dict(zip(INDEX_LIST, self.keys[slot])) for slot in chunk]}
+							for chunk in iter_chunks(missing, WEIGHT_QUERY_SIZE)]
+			for query in queries:
+				cursor = readDb[COLLECTION_NAME].find(query, read_projection(WEIGHT_PROJECTION))
+				for chunk in iter_chunks(cursor, WEIGHT_QUERY_SIZE):
+					for doc in decode_genesets(chunk):
+						slot = self.slots.get(genesetKey(doc))
+						if slot is None or slot in self.weightRows:
+							continue
+						weights = {self.geneIds[g]: w for g, w in geneWeights(doc['genes']).items() if g in self.geneIds}
+						self.weightRows[slot] = (np.fromiter(weights.keys(), dtype=np.int32, count=len(weights)),
+												np.fromiter(weights.values(), dtype=np.float64, count=len(weights)))
+
+
+	def weights(self):
+		"""
+		Slot-by-gene coefficient matrix (tombstoned slots have empty rows)
+
+		:return: scipy.sparse.csr_matrix<Float64> - shape (number of slots, number of genes)
+		"""
+		with self.lock:
+			if self._weightsGeneration != self.generation:
+				self.loadWeights()
+				empty = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64))
+				rows = [self.weightRows.get(slot, empty) for slot in range(len(self.keys))]
+				indptr = np.concatenate([[0], np.cumsum([len(row[0]) for row in rows], dtype=np.int64)])
+				indices = np.concatenate([row[0] for row in rows] + [empty[0]])
+				data = np.concatenate([row[1] for row in rows] + [empty[1]])
+				self._weights = sp.csr_matrix((data, indices, indptr), shape=(len(self.keys), len(self.postings)))
+				self._weightsGeneration = self.generation
+			return self._weights
+
+
+	def weightedQuery(self, weights, method, threshold, topk=None):
+		"""
+		Coefficient-aware similarity: indexed genesets sharing genes with the query,
+		scored from the coefficient vectors of both
+
+		:param weights: Dict - {human symbol: coefficient} of the query (see 'geneWeights')
+		:param method: String - key of app_utils.SIMILARITY_WEIGHTED_METHODS
+		:param threshold: Float
+		:param topk: Int or None
+		:return: List<Tuple<Tuple<String>, Float>> - (key, coefficient), as 'query'
+		"""
+		with self.lock:
+			W = self.weights()
+			counts = self.intersectCounts(weights.keys())
+			sizes = np.array(self.sizes, dtype=np.int32)
+			candidates = np.flatnonzero((counts > 0) & (sizes > 0))
+			# Query genes unknown to the index only count towards the query's own norm
+			unknown = [w for g, w in weights.items() if g not in self.geneIds]
+			q = np.full(W.shape[1] + len(unknown), np.nan)
+			for gene, w in weights.items():
+				if gene in self.geneIds:
+					q[self.geneIds[gene]] = w
+			q[W.shape[1]:] = unknown
+			coeffs = SIMILARITY_WEIGHTED_METHODS[method](W[candidates], q)
+			return [(self.keys[candidates[i]], coeffs[i].item()) for i in self.select(coeffs, threshold, topk)]
+
+
+	def weightedQueryMany(self, weightsList, method, threshold, topk=None):
+		"""
+		Coefficient-aware similarity of several queries in one pass: the queries are
+		stacked into one sparse matrix, and the candidates of all of them come from
+		a single product with the structure of 'weights'. Results are identical to
+		those of 'weightedQuery'.
+
+		:param weightsList: List<Dict> - {human symbol: coefficient} per query
+		:param method: String - key of app_utils.SIMILARITY_WEIGHTED_METHODS
+		:param threshold: Float
+		:param topk: Int or None
+		:return: List<List<Tuple<Tuple<String>, Float>>> - per query, as 'weightedQuery'
+		"""
+		with self.lock:
+			W = self.weights()
+			# Queries by genes: known genes in the columns of W, then the unknown genes of each query
+			indptr = [0]
+			indices = []
+			data = []
+			unknownColumn = W.shape[1]
+			for weights in weightsList:
+				row = []
+				for gene, w in weights.items():
+					geneId = self.geneIds.get(gene)
+					if geneId is None:
+						geneId = unknownColumn
+						unknownColumn += 1
+					row.append((geneId, w))
+				row.sort()
+				indices.extend(geneId for geneId, _ in row)
+				data.extend(w for _, w in row)
+				indptr.append(len(indices))
+			indptr = np.array(indptr, dtype=np.int64)
+			Q = sp.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+								shape=(len(weightsList), unknownColumn))
+			# Shared genes per (query, slot): tombstoned slots have empty rows in W
+			known = Q.indices < W.shape[1]
+			knownIndptr = np.concatenate([[0], np.cumsum(known)])[indptr]
+			shared = sp.csr_matrix((np.ones(int(known.sum()), dtype=np.int32), Q.indices[known], knownIndptr), shape=(len(weightsList), W.shape[1]))
+			structure = sp.csr_matrix((np.ones(len(W.indices), dtype=np.int32), W.indices, W.indptr), shape=W.shape)
+			counts = (shared @ structure.T).tocsr()
+			counts.eliminate_zeros()
+			counts.sort_indices()
+			sizes = np.array(self.sizes, dtype=np.int32)
+			queryRows = np.repeat(np.arange(len(weightsList)), np.diff(counts.indptr))
+			alive = sizes[counts.indices] > 0
+			slots, queryRows = counts.indices[alive], queryRows[alive]
+			coeffs = SIMILARITY_WEIGHTED_METHODS[method](W[slots], Q, queryRows)
+
+			results = []
+			bounds = np.searchsorted(queryRows, np.arange(len(weightsList) + 1))
+			for i in range(len(weightsList)):
+				querySlots, queryCoeffs = slots[bounds[i]:bounds[i + 1]], coeffs[bounds[i]:bounds[i + 1]]
+				results.append([(self.keys[querySlots[j]], queryCoeffs[j].item()) for j in self.select(queryCoeffs, threshold, topk)])
+			return results
+
+
+	def approximateQuery(self, genes, method, threshold, topk=None):
+		"""
+		Approximate similarity: LSH candidates scored from their MinHash signatures.
+		The bands select by Jaccard coefficient (matches below ~0.3 are likely missed,
+		which the standard errors do not account for), so a small subset of a large
+		geneset, whose overlap coefficient is high, would rarely be a candidate:
+		'overlap' is answered exactly, with a standard error of 0.
+
+		:param genes: Set<String> - human gene symbols
+		:param method: String - 'jaccard' or 'overlap'
+		:param threshold: Float
+		:param topk: Int or None
+		:return: List<Tuple<Tuple<String>, Float, Float>> - (key, estimated coefficient, standard error)
+		"""
+		if method == 'overlap':
+			return [(key, coeff, 0.0) for key, coeff in self.query(genes, method, threshold, topk)]
+		querySignature = minhash_signature(genes)
+		queryBands = minhash_band_hashes(querySignature)
+		with self.lock:
+			bandHashes = np.frombuffer(self.bandHashes, dtype=np.uint64).reshape(-1, MINHASH_BANDS)
+			signatures = np.frombuffer(self.signatures, dtype=np.uint32).reshape(-1, MINHASH_SIZE)
+			sizes = np.array(self.sizes, dtype=np.int32)
+			candidates = np.flatnonzero((bandHashes == queryBands).any(axis=1) & (sizes > 0))
+			candidateSignatures = signatures[candidates]
+			del bandHashes, signatures
+			coeffs, errors = similarity_minhash(candidateSignatures, querySignature, sizes[candidates], len(genes), method)
+			return [(self.keys[candidates[i]], coeffs[i].item(), errors[i].item()) for i in self.select(coeffs, threshold, topk)]
+
+
+class _TableIds(object):
+	"""
+	Gene symbol -> gene ID mapping of a snapshot lookup table (the value numbers)
+	"""
+	def __init__(self, table):
+		self.table = table
+
+
+	def __len__(self):
+		return len(self.table)
+
+
+	def __contains__(self, gene):
+		return self.table.find(gene) is not None
+
+
+	def __getitem__(self, gene):
+		geneId = self.table.find(gene)
+		if geneId is None:
+			raise KeyError(gene)
+		return geneId
+
+
+	def get(self, gene, default=None):
+		geneId = self.table.find(gene)
+		return default if geneId is None else geneId
+
+
+class _TablePostings(object):
+	"""
+	Gene ID -> slots of a snapshot lookup table (memory-mapped views)
+	"""
+	def __init__(self, table):
+		self.table = table
+
+
+	def __len__(self):
+		return len(self.table)
+
+
+	def __getitem__(self, geneId):
+		return self.table.positionsOf(geneId)
+
+
+class _SnapshotKeys(object):
+	"""
+	Slot -> key of a snapshot, decoded on access
+	"""
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+
+
+	def __len__(self):
+		return len(self.snapshot)
+
+
+	def __getitem__(self, slot):
+		return self.snapshot.key(int(slot))
+
+
+	def __iter__(self):
+		return (self.snapshot.key(slot) for slot in range(len(self.snapshot)))
+
+
+class _SnapshotSlots(object):
+	"""
+	Key -> slot of a snapshot, looked up in its setName table
+	"""
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+
+
+	def __len__(self):
+		return len(self.snapshot)
+
+
+	def get(self, key, default=None):
+		slot = self.snapshot.locate(key)
+		return default if slot is None else slot
+
+
+class SnapshotGenesetIndex(GenesetIndex):
+	"""
+	Read-only index over a served snapshot: slots are the snapshot positions and
+	gene IDs the value numbers of its humanSymbols table, so postings, sizes, keys
+	and signatures are the memory-mapped arrays, shared by the processes of a host
+	"""
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+		super().__init__()
+
+
+	def clear(self):
+		table = self.snapshot.tables['humanSymbols']
+		self.geneIds = _TableIds(table)
+		self.postings = _TablePostings(table)
+		self.sizes = self.snapshot.symbolCounts
+		self.taxIds = None			# see 'selectSlots'
+		self.keys = _SnapshotKeys(self.snapshot)
+		self.slots = _SnapshotSlots(self.snapshot)
+		self.groups = dict()
+		self.signatures = self.snapshot.signatures
+		self.bandHashes = self.snapshot.bandHashes
+		self.weightRows = dict()
+		self.dead = 0
+		self.generation += 1
+
+
+	def selectSlots(self, source=None, subtype=None, taxId=None):
+		"""
+		:param source: String or None
+		:param subtype: String or None
+		:param taxId: Int or None
+		:return: ndarray<Boolean> - per slot: matching the given fields
+		"""
+		selected = np.ones(len(self.snapshot), dtype=bool)
+		for field, value in [('source', source), ('subtype', subtype), ('taxId', taxId)]:
+			if value is not None:
+				mask = np.zeros(len(self.snapshot), dtype=bool)
+				mask[self.snapshot.tables[field].positions(value)] = True
+				selected &= mask
+		return selected
+
+
+	def incidence(self):
+		"""
+		Gene-by-slot incidence matrix: the humanSymbols table is already in CSR layout
+
+		:return: scipy.sparse.csr_matrix<Int32> - shape (number of genes, number of slots)
+		"""
+		with self.lock:
+			if self._incidenceGeneration != self.generation:
+				table = self.snapshot.tables['humanSymbols']
+				data = np.ones(len(table.postings), dtype=np.int32)
+				self._incidence = sp.csr_matrix((data, table.postings, table.postingOffsets), shape=(len(table), len(self.snapshot)))
+				self._incidenceGeneration = self.generation
+			return self._incidence
+
+
+_index = None
+_indexLock = threading.Lock()
+
+
+def getIndex():
+	"""
+	Process-wide index, built from MongoDB on first use and rebuilt
+	whenever the collection version has moved on (over the served snapshot
+	in snapshot mode)
+
+	:return: GenesetIndex
+	"""
+	global _index
+	version = get_collection_version(readDb, COLLECTION_NAME)
+	with _indexLock:
+		if _index is None or _index.version != version:
+			if SNAPSHOT_MODE:
+				index = SnapshotGenesetIndex(readDb.snapshot)
+			else:
+				index = GenesetIndex()
+				docs = iter_chunks(readDb[COLLECTION_NAME].find({}, INDEX_PROJECTION), BUILD_CHUNK_SIZE)
+				index.build(doc for chunk in docs for doc in fill_human_symbols(readDb[COLLECTION_NAME], chunk))
+			index.version = version
+			_index = index
+	return _index
+
+
+def getIndexIfLoaded():
+	"""
+	:return: GenesetIndex or None - None if no request has built the index yet
+	"""
+	return _index
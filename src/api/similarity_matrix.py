@@ -0,0 +1,295 @@
+"""
+==================================================================
+similarity_matrix.py: All-vs-all geneset similarity (batch job)
+==================================================================
+
+The selected genesets are loaded into sparse geneset-by-gene incidence
+matrices (CSR, human gene symbols as columns). All intersection counts
+come from one sparse matrix product A * B^T, computed in row blocks of A
+spread across worker processes; coefficients follow from the counts and
+set sizes with the definitions in app_utils. Pairs at or above the
+threshold are written to a tab-delimited file or to the SIMILARITY_COL
+collection.
+
+Comparing a selection with itself ('--so MSigDB --st C2' without a second
+selection) reports every unordered pair once and skips self-pairs.
+
+Example:
+	[\\GeMS\\src\\api\\] python similarity_matrix.py --so MSigDB --st C2 --so2 Reactome --me jaccard --th 0.3 --np 8 --out C2_vs_Reactome.tsv
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from app_utils import SIMILARITY_COUNT_METHODS
+from db_config import COLLECTION_NAME, SIMILARITY_COL
+from db_utils import db, INDEX_LIST, fill_human_symbols
+from gmtx_utils import iter_chunks
+
+DEFAULT_BLOCK_SIZE = 500
+DEFAULT_WRITE_CHUNK = 10000
+
+SELECTION_FIELDS = ['source', 'subtype', 'user', 'taxId', 'domain']
+
+
+def load_genesets(query):
+	"""
+	:param query: Dict - MongoDB filter
+	:return keys: List<Tuple<String>> - (setName, source, subtype, user)
+	:return geneLists: List<List<String>> - human gene symbols
+	"""
+	keys = []
+	geneLists = []
+	projection = {**{k: 1 for k in INDEX_LIST}, 'humanSymbols': 1, '_id': 0}
+	docs = (doc for chunk in iter_chunks(db[COLLECTION_NAME].find(query, projection), DEFAULT_BLOCK_SIZE) for doc in fill_human_symbols(db[COLLECTION_NAME], chunk))
+	for doc in docs:
+		keys.append(tuple(doc[k] for k in INDEX_LIST))
+		geneLists.append(doc['humanSymbols'])
+	return keys, geneLists
+
+
+def build_incidence(geneLists, geneIds):
+	"""
+	Binary geneset-by-gene incidence matrix
+
+	:param geneLists: List<Iterable<String>>
+	:param geneIds: Dict - {gene: column}, shared between matrices (new genes are added)
+	:return: scipy.sparse.csr_matrix<Int32> - shape (len(geneLists), len(geneIds))
+	"""
+	indptr = [0]
+	indices = []
+	for genes in geneLists:
+		for gene in set(genes):
+			indices.append(geneIds.setdefault(gene, len(geneIds)))
+		indptr.append(len(indices))
+	data = np.ones(len(indices), dtype=np.int32)
+	matrix = sp.csr_matrix((data, np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+						shape=(len(geneLists), len(geneIds)))
+	return matrix
+
+
+def make_block_state(B, method, threshold, selfJoin):
+	"""
+	Everything 'block_pairs' needs besides the block: built once per run (per process)
+
+	:param B: scipy.sparse.csr_matrix
+	:param method: String
+	:param threshold: Float
+	:param selfJoin: Boolean
+	:return: Dict
+	"""
+	return {'BT': B.T.tocsc(),
+			'sizesB': np.diff(B.indptr),
+			'method': method,
+			'threshold': threshold,
+			'selfJoin': selfJoin}
+
+
+def block_pairs(state, task):
+	"""
+	Above-threshold pairs of one row block of A
+
+	:param state: Dict - from 'make_block_state'
+	:param task: Tuple<Int, scipy.sparse.csr_matrix> - (row offset, block)
+	:return: Tuple<ndarray> - rows of A, rows of B, coefficients
+	"""
+	offset, block = task
+	counts = (block @ state['BT']).tocoo()
+	rows = counts.row + offset
+	sizesA = np.diff(block.indptr)[counts.row]
+	coeffs = SIMILARITY_COUNT_METHODS[state['method']](counts.data, sizesA, state['sizesB'][counts.col])
+	keep = coeffs >= state['threshold']
+	if state['selfJoin']:
+		keep &= rows < counts.col
+	return rows[keep], counts.col[keep], coeffs[keep]
+
+
+# State of a spawned pool worker process only: runs in this process (e.g. concurrent
+# API jobs, see jobs.py) each keep their own state
+_worker = dict()
+
+
+def _initWorker(B, method, threshold, selfJoin):
+	"""
+	Process pool initializer: the right-hand matrix is sent once per worker
+
+	:return: VOID
+	"""
+	_worker.update(make_block_state(B, method, threshold, selfJoin))
+
+
+def _blockPairs(task):
+	"""
+	Pool task: see 'block_pairs'
+	"""
+	return block_pairs(_worker, task)
+
+
+def compute_pairs(A, B, method, threshold, selfJoin=False, blockSize=DEFAULT_BLOCK_SIZE, workers=1):
+	"""
+	All pairs (i, j) with coefficient(A_i, B_j) >= threshold, one row block at a time
+
+	:param A: scipy.sparse.csr_matrix
+	:param B: scipy.sparse.csr_matrix - same columns as A
+	:param method: String - key of app_utils.SIMILARITY_COUNT_METHODS
+	:param threshold: Float
+	:param selfJoin: Boolean - A and B are the same selection: keep i < j only
+	:param blockSize: Int - rows of A per product
+	:param workers: Int - processes (1: compute in this process)
+	:return: Generator<Tuple<ndarray>> - (rows of A, rows of B, coefficients) per block, in block order
+	"""
+	tasks = ((i, A[i:i + blockSize]) for i in range(0, A.shape[0], blockSize))
+	initArgs = (B, method, threshold, selfJoin)
+	if workers == 1:
+		state = make_block_state(*initArgs)
+		for task in tasks:
+			yield block_pairs(state, task)
+	else:
+		# 'spawn': safe to start from an API worker thread
+		ctx = multiprocessing.get_context('spawn')
+		with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_initWorker, initargs=initArgs) as pool:
+			yield from pool.map(_blockPairs, tasks)
+
+
+def run_similarity_matrix(query, against, method, threshold, out=None, blockSize=DEFAULT_BLOCK_SIZE,
+						workers=1, job=None):
+	"""
+	Load, compute and write the similarity matrix of two geneset selections
+
+	:param query: Dict - MongoDB filter of the left-hand genesets
+	:param against: Dict or None - filter of the right-hand genesets (None: same as 'query')
+	:param method: String
+	:param threshold: Float
+	:param out: String or None - tab-delimited output file (None: SIMILARITY_COL collection)
+	:param blockSize: Int
+	:param workers: Int
+	:param job: jobs.Job or None - receives progress updates
+	:return: Dict - summary
+	"""
+	assert method in SIMILARITY_COUNT_METHODS
+	start = time.time()
+	runId = job.id if job is not None else '{:x}'.format(int(start * 1000))
+
+	selfJoin = against is None or against == query
+	keysA, genesA = load_genesets(query)
+	geneIds = dict()
+	A = build_incidence(genesA, geneIds)
+	if selfJoin:
+		keysB, B = keysA, A
+	else:
+		keysB, genesB = load_genesets(against)
+		B = build_incidence(genesB, geneIds)
+		A.resize(A.shape[0], len(geneIds))
+	del genesA
+
+	nBlocks = -(-A.shape[0] // blockSize)
+	if job is not None:
+		job.update(genesetsA=len(keysA), genesetsB=len(keysB), blocks=nBlocks, blocksDone=0, pairs=0)
+
+	pairCount = 0
+	writer = _TsvWriter(out) if out is not None else _CollectionWriter(runId, method)
+	try:
+		for blockNum, (rows, cols, coeffs) in enumerate(compute_pairs(A, B, method, threshold, selfJoin, blockSize, workers), 1):
+			writer.write(keysA, keysB, rows, cols, coeffs)
+			pairCount += len(coeffs)
+			if job is not None:
+				job.update(blocksDone=blockNum, pairs=pairCount)
+	finally:
+		writer.close()
+
+	return {'run': runId,
+			'method': method,
+			'threshold': threshold,
+			'genesetsA': len(keysA),
+			'genesetsB': len(keysB),
+			'pairs': pairCount,
+			'output': out if out is not None else SIMILARITY_COL,
+			'seconds': time.time() - start}
+
+
+class _TsvWriter(object):
+	def __init__(self, fileLoc):
+		self.f = open(fileLoc, 'w', encoding='utf-8')
+		self.f.write('\t'.join(['a_' + k for k in INDEX_LIST] + ['b_' + k for k in INDEX_LIST] + ['coeff']) + '\n')
+
+
+	def write(self, keysA, keysB, rows, cols, coeffs):
+		for i, j, k in zip(rows.tolist(), cols.tolist(), coeffs.tolist()):
+			self.f.write('\t'.join(keysA[i] + keysB[j] + (repr(k),)) + '\n')
+
+
+	def close(self):
+		self.f.close()
+
+
+class _CollectionWriter(object):
+	def __init__(self, runId, method):
+		self.runId = runId
+		self.method = method
+
+
+	def write(self, keysA, keysB, rows, cols, coeffs):
+		docs = ({'run': self.runId,
+				'method': self.method,
+				'a': dict(zip(INDEX_LIST, keysA[i])),
+				'b': dict(zip(INDEX_LIST, keysB[j])),
+				'coeff': k} for i, j, k in zip(rows.tolist(), cols.tolist(), coeffs.tolist()))
+		for chunk in iter_chunks(docs, DEFAULT_WRITE_CHUNK):
+			db[SIMILARITY_COL].insert_many(chunk, ordered=False)
+
+
+	def close(self):
+		pass
+
+
+def make_selection(source, subtype=None, user=None, taxId=None, domain=None):
+	"""
+	:return: Dict - MongoDB filter from the given fields
+	"""
+	values = [source, subtype, user, taxId, domain]
+	return {k: v for k, v in zip(SELECTION_FIELDS, values) if v is not None}
+
+
+def main():
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--so', type=str, help='Source of the left-hand genesets (e.g. MSigDB)')
+	parser.add_argument('--st', type=str, default=None, help='Subtype of the left-hand genesets (e.g. C2)')
+	parser.add_argument('--us', type=str, default=None, help='User of the left-hand genesets')
+	parser.add_argument('--ti', type=int, default=None, help='NCBI Taxonomic ID of the left-hand genesets')
+	parser.add_argument('--so2', type=str, default=None, help='Source of the right-hand genesets (default: same selection)')
+	parser.add_argument('--st2', type=str, default=None, help='Subtype of the right-hand genesets')
+	parser.add_argument('--us2', type=str, default=None, help='User of the right-hand genesets')
+	parser.add_argument('--ti2', type=int, default=None, help='NCBI Taxonomic ID of the right-hand genesets')
+
+	parser.add_argument('--me', type=str, default='jaccard', help='Method: ' + ', '.join(SIMILARITY_COUNT_METHODS))
+	parser.add_argument('--th', type=float, default=0.5, help='Threshold: minimum coefficient of the reported pairs')
+	parser.add_argument('--out', type=str, default=None, help='Tab-delimited output file (default: ' + SIMILARITY_COL + ' collection)')
+	parser.add_argument('--bs', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size: left-hand genesets per matrix product')
+	parser.add_argument('--np', type=int, default=os.cpu_count(), help='Number of worker processes')
+
+	# Input parameter constraints
+	args = parser.parse_args()
+	assert args.so is not None
+	assert args.me in SIMILARITY_COUNT_METHODS
+	assert args.bs > 0 and args.np > 0
+
+	query = make_selection(args.so, args.st, args.us, args.ti)
+	against = None
+	if args.so2 is not None:
+		against = make_selection(args.so2, args.st2, args.us2, args.ti2)
+
+	summary = run_similarity_matrix(query, against, args.me, args.th, out=args.out, blockSize=args.bs, workers=args.np)
+	print('{} x {} genesets: {} pairs >= {} ({}) written to {} in {:.1f} s'.format(
+		summary['genesetsA'], summary['genesetsB'], summary['pairs'], args.th, args.me, summary['output'], summary['seconds']))
+
+
+if __name__ == '__main__':
+	main()
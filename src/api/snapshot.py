@@ -0,0 +1,771 @@
+"""
+====================================================================
+snapshot.py: Compact binary snapshot of the genesets collection
+====================================================================
+
+Exports the genesets (optionally a selection) to a directory that analysis
+jobs load in milliseconds instead of downloading JSON from /api/genesets:
+
+	manifest.json	Counts, array files with their dtypes and lengths, export
+					parameters
+	genes.tsv		Interned gene table: one distinct gene array per line
+					(native symbol, native ID, human symbol, human ID);
+					the line number (from 0) is the gene ID
+	geneTableOffsets.bin	int64, genes + 1 byte offsets of the lines of genes.tsv
+	indices.bin		int32, gene IDs of all genesets, concatenated
+	offsets.bin		int64, genesets + 1 CSR offsets: the genes of geneset i
+					are indices[offsets[i]:offsets[i + 1]]
+	coeffs.bin		float64, coefficients of the genesets that have any, per
+					entry of indices (NaN for a gene without one)
+	coeffOffsets.bin	int64, genesets + 1 CSR offsets into coeffs: geneset i
+					has coeffs[coeffOffsets[i]:coeffOffsets[i + 1]], an
+					empty range if none of its genes has a coefficient
+	metadata.jsonl	One geneset per line (MongoDB extended JSON), every field
+					except 'genes' and the internal fields
+	metadataOffsets.bin	int64, genesets + 1 byte offsets of the lines of metadata.jsonl
+	minhash.bin		uint32, genesets x MINHASH_SIZE MinHash signatures of the
+					human symbols (app_utils.minhash_signature)
+	bandHashes.bin	uint64, genesets x MINHASH_BANDS LSH band hashes
+	symbolCounts.bin	int32, number of distinct human symbols per geneset
+	tables/			Lookup tables ('ValueTable') of the key fields (setName,
+					source, subtype, user, taxId) and of the flat gene fields
+					(nativeSymbols, nativeIds, humanSymbols, humanIds):
+		<field>.values.bin			uint8, distinct values ('encode_value'), sorted
+		<field>.valueOffsets.bin	int64, values + 1 byte offsets
+		<field>.postings.bin		int32, sorted geneset positions holding each value
+		<field>.postingOffsets.bin	int64, values + 1 offsets into postings
+		<field>.codes.bin			int32, per geneset: number of its value (-1 if
+									missing); key fields only
+
+Genesets are written in the order of the unique index (setName, source,
+subtype, user). The arrays are raw little-endian binaries memory-mapped
+with NumPy by 'load_snapshot' (zero-copy); gene table and metadata lines
+are decoded on access.
+
+'SnapshotDatabase' serves a loaded snapshot in place of MongoDB for the
+read queries of the REST-API (see read_db.py). Everything it reads is
+memory-mapped, so the worker processes of a host share one copy in the OS
+page cache.
+
+Example:
+	[\\GeMS\\src\\api\\] python snapshot.py --out ../../snapshot --so MSigDB
+
+	>>> from snapshot import load_snapshot
+	>>> s = load_snapshot('../../snapshot')
+	>>> s.geneArrays(0)
+	[('Tubb2a', '498736', 'TUBB2A', '7280'), ...]
+
+"""
+
+import argparse
+import bisect
+import json
+import os
+import time
+from contextlib import ExitStack
+
+import numpy as np
+from bson import json_util
+
+from app_utils import MINHASH_SIZE, MINHASH_BANDS, minhash_signature, minhash_band_hashes
+from db_config import COLLECTION_NAME, META_COL
+from db_utils import db, INDEX_LIST, INTERNAL_FIELDS, GENE_FIELDS, V2_GENE_FIELDS, flatten_genes, get_collection_version
+from gene_schema import read_projection, decode_genesets
+from gmtx_utils import iter_chunks
+from pagination import SORT_ORDER, makeResumeQuery
+
+SNAPSHOT_FORMAT = 3
+DEFAULT_CHUNK_SIZE = 1000
+
+ARRAY_FILES = {'indices': ('indices.bin', '<i4'),
+				'offsets': ('offsets.bin', '<i8'),
+				'coeffs': ('coeffs.bin', '<f8'),
+				'coeffOffsets': ('coeffOffsets.bin', '<i8'),
+				'geneTableOffsets': ('geneTableOffsets.bin', '<i8'),
+				'metadataOffsets': ('metadataOffsets.bin', '<i8'),
+				'minhash': ('minhash.bin', '<u4'),
+				'bandHashes': ('bandHashes.bin', '<u8'),
+				'symbolCounts': ('symbolCounts.bin', '<i4')}
+GENE_TABLE_FILE = 'genes.tsv'
+METADATA_FILE = 'metadata.jsonl'
+MANIFEST_FILE = 'manifest.json'
+
+# Lookup tables: fields of the unique index (+ taxId) and flat gene fields
+KEY_FIELDS = INDEX_LIST + ['taxId']
+TABLE_DIR = 'tables'
+TABLE_FILES = {'values': ('values.bin', '|u1'),
+				'valueOffsets': ('valueOffsets.bin', '<i8'),
+				'postings': ('postings.bin', '<i4'),
+				'postingOffsets': ('postingOffsets.bin', '<i8'),
+				'codes': ('codes.bin', '<i4')}
+
+
+def encode_value(value):
+	"""
+	Key of a value in the lookup tables: values equal in MongoDB queries (e.g. 9606 and
+	9606.0) have the same key
+
+	:param value: Any - BSON-serialisable
+	:return: Bytes
+	"""
+	if isinstance(value, float) and value.is_integer():
+		value = int(value)
+	return json_util.dumps(value, sort_keys=True).encode('utf-8')
+
+
+def _writeArray(outDir, fileName, values, dtype):
+	"""
+	:param outDir: String
+	:param fileName: String - relative to 'outDir'
+	:param values: Iterable or ndarray
+	:param dtype: String
+	:return: Dict - manifest entry
+	"""
+	data = np.asarray(values, dtype=dtype)
+	with open(os.path.join(outDir, fileName), 'wb') as f:
+		f.write(data.tobytes())
+	return {'file': fileName, 'dtype': dtype, 'length': len(data)}
+
+
+def _writeTable(outDir, field, encoded, values, positions, nGenesets, codes=None):
+	"""
+	Write the lookup table of one field
+
+	:param outDir: String
+	:param field: String
+	:param encoded: List<Bytes> - distinct values ('encode_value'), in any order
+	:param values: ndarray<Int> - number in 'encoded' of each (value, geneset) pair
+	:param positions: ndarray<Int> - geneset position of each pair (repeats allowed)
+	:param nGenesets: Int
+	:param codes: ndarray<Int> or None - per geneset: number in 'encoded' (-1 if missing)
+	:return: Dict - manifest entries of the table files
+	"""
+	order = sorted(range(len(encoded)), key=encoded.__getitem__)
+	rank = np.empty(len(encoded), dtype=np.int64)
+	rank[order] = np.arange(len(encoded))
+	sortedValues = [encoded[n] for n in order]
+
+	# Distinct pairs sorted by value, then position
+	pairs = np.unique(rank[values] * nGenesets + np.asarray(positions, dtype=np.int64))
+	pairValues, pairPositions = np.divmod(pairs, nGenesets)
+
+	fileName = lambda part: TABLE_DIR + '/' + field + '.' + TABLE_FILES[part][0]
+	write = lambda part, data: _writeArray(outDir, fileName(part), data, TABLE_FILES[part][1])
+	table = {'values': write('values', np.frombuffer(b''.join(sortedValues), dtype=np.uint8)),
+			'valueOffsets': write('valueOffsets', np.cumsum([0] + [len(v) for v in sortedValues])),
+			'postings': write('postings', pairPositions),
+			'postingOffsets': write('postingOffsets', np.searchsorted(pairValues, np.arange(len(encoded) + 1)))}
+	if codes is not None:
+		table['codes'] = write('codes', np.where(codes >= 0, rank[np.maximum(codes, 0)] if len(encoded) > 0 else -1, -1))
+	return table
+
+
+def export_snapshot(outDir, query=None, chunkSize=DEFAULT_CHUNK_SIZE):
+	"""
+	Stream the selected genesets into a snapshot directory (one chunk of documents in memory;
+	genes of schema v2 genesets are decoded)
+
+	:param outDir: String - created if missing; existing snapshot files are overwritten
+	:param query: Dict or None - MongoDB filter
+	:param chunkSize: Int - genesets converted per batch
+	:return: Dict - manifest
+	"""
+	query = dict() if query is None else query
+	os.makedirs(os.path.join(outDir, TABLE_DIR), exist_ok=True)
+	path = lambda name: os.path.join(outDir, name)
+	version = get_collection_version(db, COLLECTION_NAME)
+
+	# Arrays written while streaming (one row per geneset, or per entry for indices and coeffs)
+	streamed = ['indices', 'offsets', 'coeffs', 'coeffOffsets', 'metadataOffsets', 'minhash', 'bandHashes', 'symbolCounts']
+	lengths = {name: 0 for name in streamed}
+	geneIds = dict()
+	keyCodes = {field: dict() for field in KEY_FIELDS}		# encoded value -> number, in order of appearance
+	codes = {field: [] for field in KEY_FIELDS}
+	nGenesets = 0
+	nEntries = 0
+	nCoeffs = 0
+	metaSize = 0
+	projection = read_projection({field: 0 for field in INTERNAL_FIELDS + ['_id']})
+	cursor = db[COLLECTION_NAME].find(query, projection, no_cursor_timeout=True).sort([(k, 1) for k in INDEX_LIST])
+	try:
+		with ExitStack() as stack:
+			files = {name: stack.enter_context(open(path(ARRAY_FILES[name][0]), 'wb')) for name in streamed}
+			fMeta = stack.enter_context(open(path(METADATA_FILE), 'wb'))
+
+			def write(name, values):
+				data = np.asarray(values, dtype=ARRAY_FILES[name][1])
+				files[name].write(data.tobytes())
+				lengths[name] += data.size
+
+			write('offsets', [0])
+			write('coeffOffsets', [0])
+			write('metadataOffsets', [0])
+			for chunk in iter_chunks(cursor, chunkSize):
+				rows = {name: [] for name in streamed}
+				for doc in decode_genesets(chunk):
+					genes = doc.pop('genes')
+					for geneArray, _ in genes:
+						rows['indices'].append(geneIds.setdefault(tuple(geneArray), len(geneIds)))
+					# Most genesets have no coefficients: nothing is stored for them
+					if any(coeff is not None for _, coeff in genes):
+						rows['coeffs'].extend(np.nan if coeff is None else coeff for _, coeff in genes)
+						nCoeffs += len(genes)
+					nEntries += len(genes)
+					rows['offsets'].append(nEntries)
+					rows['coeffOffsets'].append(nCoeffs)
+					humanSymbols = flatten_genes(genes)['humanSymbols']
+					rows['minhash'].append(minhash_signature(humanSymbols))
+					rows['symbolCounts'].append(len(set(humanSymbols)))
+					for field in KEY_FIELDS:
+						codes[field].append(keyCodes[field].setdefault(encode_value(doc[field]), len(keyCodes[field])) if field in doc else -1)
+					line = (json_util.dumps(doc) + '\n').encode('utf-8')
+					fMeta.write(line)
+					metaSize += len(line)
+					rows['metadataOffsets'].append(metaSize)
+				signatures = np.array(rows['minhash'], dtype=np.uint32).reshape(-1, MINHASH_SIZE)
+				rows['minhash'] = signatures
+				rows['bandHashes'] = minhash_band_hashes(signatures)
+				for name in streamed:
+					write(name, rows[name])
+				nGenesets += len(chunk)
+	finally:
+		cursor.close()
+
+	arrays = {name: {'file': ARRAY_FILES[name][0], 'dtype': ARRAY_FILES[name][1], 'length': lengths[name]} for name in streamed}
+	geneTableOffsets = [0]
+	with open(path(GENE_TABLE_FILE), 'wb') as f:
+		for geneArray in geneIds:
+			line = ('\t'.join(geneArray) + '\n').encode('utf-8')
+			f.write(line)
+			geneTableOffsets.append(geneTableOffsets[-1] + len(line))
+	arrays['geneTableOffsets'] = _writeArray(outDir, ARRAY_FILES['geneTableOffsets'][0], geneTableOffsets, ARRAY_FILES['geneTableOffsets'][1])
+
+	# Lookup tables: key fields from their codes, gene fields through the gene table
+	tables = dict()
+	for field in KEY_FIELDS:
+		fieldCodes = np.array(codes[field], dtype=np.int64)
+		present = np.flatnonzero(fieldCodes >= 0)
+		encoded = sorted(keyCodes[field], key=keyCodes[field].get)
+		tables[field] = _writeTable(outDir, field, encoded, fieldCodes[present], present, max(nGenesets, 1), fieldCodes)
+	indices = np.fromfile(path(ARRAY_FILES['indices'][0]), dtype=ARRAY_FILES['indices'][1])
+	entrySets = np.repeat(np.arange(nGenesets, dtype=np.int64), np.diff(np.fromfile(path(ARRAY_FILES['offsets'][0]), dtype=ARRAY_FILES['offsets'][1])))
+	for column, field in enumerate(GENE_FIELDS):
+		valueNumbers = dict()
+		geneValues = np.array([valueNumbers.setdefault(geneArray[column].encode('utf-8'), len(valueNumbers)) if geneArray[column] != '' else -1
+								for geneArray in geneIds], dtype=np.int64)
+		encoded = [encode_value(value.decode('utf-8')) for value in sorted(valueNumbers, key=valueNumbers.get)]
+		entryValues = geneValues[indices] if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+		present = entryValues >= 0
+		tables[field] = _writeTable(outDir, field, encoded, entryValues[present], entrySets[present], max(nGenesets, 1))
+
+	# Written last: a directory without manifest is an incomplete export
+	manifest = {'format': SNAPSHOT_FORMAT,
+				'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+				'collection': COLLECTION_NAME,
+				'collectionVersion': version,
+				'query': json.loads(json_util.dumps(query)),
+				'genesets': nGenesets,
+				'entries': nEntries,
+				'coeffEntries': nCoeffs,
+				'genes': len(geneIds),
+				'geneTable': GENE_TABLE_FILE,
+				'metadata': METADATA_FILE,
+				'arrays': arrays,
+				'tables': tables}
+	with open(path(MANIFEST_FILE), 'w') as f:
+		json.dump(manifest, f, indent=2)
+	return manifest
+
+
+_MISSING = object()
+
+
+def _mapArray(directory, spec):
+	"""
+	:param directory: String
+	:param spec: Dict - manifest entry ('file', 'dtype', 'length')
+	:return: np.memmap (read-only)
+	"""
+	if spec['length'] == 0:
+		return np.zeros(0, dtype=spec['dtype'])		# np.memmap cannot map empty files
+	return np.memmap(os.path.join(directory, spec['file']), dtype=spec['dtype'], mode='r', shape=(spec['length'],))
+
+
+class _LineTable(object):
+	"""
+	Lines of a text file, decoded on access from the memory-mapped file and its byte offsets
+	"""
+	def __init__(self, data, offsets, parse):
+		self.data = data
+		self.offsets = offsets
+		self.parse = parse
+
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+
+	def __getitem__(self, n):
+		return self.parse(self.data[self.offsets[n]:self.offsets[n + 1]].tobytes().decode('utf-8').rstrip('\n'))
+
+
+class ValueTable(object):
+	"""
+	Lookup table of one field: its distinct values, sorted by their 'encode_value' key,
+	with the sorted positions of the genesets holding each
+	"""
+	def __init__(self, arrays):
+		self.values = arrays['values']
+		self.valueOffsets = arrays['valueOffsets']
+		self.postings = arrays['postings']
+		self.postingOffsets = arrays['postingOffsets']
+		self.codes = arrays.get('codes')
+
+
+	def __len__(self):
+		return len(self.valueOffsets) - 1
+
+
+	def __getitem__(self, n):
+		"""
+		:param n: Int - value number
+		:return: Bytes - encoded value (sorted by n, for 'bisect')
+		"""
+		return self.values[self.valueOffsets[n]:self.valueOffsets[n + 1]].tobytes()
+
+
+	def value(self, n):
+		"""
+		:param n: Int
+		:return: Any
+		"""
+		return json_util.loads(self[n].decode('utf-8'))
+
+
+	def find(self, value):
+		"""
+		:param value: Any
+		:return: Int or None - value number
+		"""
+		key = encode_value(value)
+		n = bisect.bisect_left(self, key)
+		return n if n < len(self) and self[n] == key else None
+
+
+	def positionsOf(self, n):
+		"""
+		:param n: Int - value number
+		:return: np.memmap<Int32> - sorted geneset positions (view, no copy)
+		"""
+		return self.postings[self.postingOffsets[n]:self.postingOffsets[n + 1]]
+
+
+	def positions(self, value):
+		"""
+		:param value: Any
+		:return: ndarray<Int32> - sorted positions of the genesets holding 'value'
+		"""
+		n = self.find(value)
+		return np.zeros(0, dtype=np.int32) if n is None else self.positionsOf(n)
+
+
+	def valueAt(self, i):
+		"""
+		:param i: Int - geneset position (key fields only)
+		:return: Any - _MISSING if the geneset has no value
+		"""
+		n = self.codes[i]
+		return _MISSING if n < 0 else self.value(n)
+
+
+class Snapshot(object):
+	def __init__(self, directory, manifest, arrays, tables):
+		self.directory = directory
+		self.manifest = manifest
+		self.indices = arrays['indices']
+		self.offsets = arrays['offsets']
+		self.coeffs = arrays['coeffs']
+		self.coeffOffsets = arrays['coeffOffsets']
+		self.signatures = arrays['minhash'].reshape(-1, MINHASH_SIZE)
+		self.bandHashes = arrays['bandHashes'].reshape(-1, MINHASH_BANDS)
+		self.symbolCounts = arrays['symbolCounts']
+		self.tables = tables			# field -> ValueTable
+		# gene ID -> Tuple<String> (nSym, nId, hSym, hId)
+		self.geneTable = _LineTable(arrays['geneTable'], arrays['geneTableOffsets'], lambda line: tuple(line.split('\t')))
+		# geneset -> Dict
+		self.metadata = _LineTable(arrays['metadata'], arrays['metadataOffsets'], json_util.loads)
+
+
+	def __len__(self):
+		return self.manifest['genesets']
+
+
+	def key(self, i):
+		"""
+		:param i: Int - geneset position
+		:return: Tuple - (setName, source, subtype, user)
+		"""
+		return tuple(self.tables[k].valueAt(i) for k in INDEX_LIST)
+
+
+	def after(self, key):
+		"""
+		:param key: Tuple<String> - (setName, source, subtype, user)
+		:return: Int - first position whose key is greater (genesets are stored in key order)
+		"""
+		low, high = 0, len(self)
+		while low < high:
+			middle = (low + high) // 2
+			if self.key(middle) <= tuple(key):
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+
+	def locate(self, key):
+		"""
+		:param key: Tuple - (setName, source, subtype, user)
+		:return: Int or None - geneset position
+		"""
+		for i in self.tables[INDEX_LIST[0]].positions(key[0]).tolist():
+			if self.key(i) == tuple(key):
+				return i
+		return None
+
+
+	def geneIds(self, i):
+		"""
+		:param i: Int - geneset position
+		:return: np.memmap<Int32> - gene IDs (view, no copy)
+		"""
+		return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+
+	def geneArrays(self, i):
+		"""
+		:param i: Int
+		:return: List<Tuple<String>> - gene arrays, in stored order
+		"""
+		return [self.geneTable[g] for g in self.geneIds(i).tolist()]
+
+
+	def coefficients(self, i):
+		"""
+		:param i: Int
+		:return: List<Float> - coefficient per gene, in stored order (None if none)
+		"""
+		start, end = self.coeffOffsets[i], self.coeffOffsets[i + 1]
+		if start == end:
+			return [None] * int(self.offsets[i + 1] - self.offsets[i])
+		return [None if np.isnan(c) else c for c in self.coeffs[start:end].tolist()]
+
+
+	def document(self, i):
+		"""
+		Geneset as stored in MongoDB (internal fields rebuilt)
+
+		:param i: Int
+		:return: Dict
+		"""
+		genes = [[list(geneArray), c] for geneArray, c in zip(self.geneArrays(i), self.coefficients(i))]
+		doc = self.metadata[i]
+		doc['genes'] = genes
+		doc.update(flatten_genes(genes))
+		return doc
+
+
+def load_snapshot(directory):
+	"""
+	Memory-map a snapshot exported by 'export_snapshot'
+
+	:param directory: String
+	:return: Snapshot
+	"""
+	with open(os.path.join(directory, MANIFEST_FILE), 'r') as f:
+		manifest = json.load(f)
+	assert manifest['format'] == SNAPSHOT_FORMAT, 'Snapshot format {} (expected {}): export it again'.format(manifest['format'], SNAPSHOT_FORMAT)
+
+	arrays = {name: _mapArray(directory, spec) for name, spec in manifest['arrays'].items()}
+	for name in ['geneTable', 'metadata']:
+		fileName = manifest[name]
+		arrays[name] = _mapArray(directory, {'file': fileName, 'dtype': '|u1', 'length': os.path.getsize(os.path.join(directory, fileName))})
+	tables = {field: ValueTable({part: _mapArray(directory, spec) for part, spec in parts.items()})
+				for field, parts in manifest['tables'].items()}
+	assert len(arrays['geneTableOffsets']) == manifest['genes'] + 1 and len(arrays['metadataOffsets']) == manifest['genesets'] + 1
+	return Snapshot(directory, manifest, arrays, tables)
+
+
+class _DocumentView(object):
+	"""
+	Lazy field access to one geneset of a snapshot: key fields come from the
+	lookup tables, metadata and gene fields are only decoded when a query or
+	projection needs them
+	"""
+	def __init__(self, snapshot, i):
+		self.snapshot = snapshot
+		self.i = i
+		self.metadata = None
+		self.genes = None
+
+
+	def get(self, field):
+		if field == 'genes' or field in GENE_FIELDS:
+			if self.genes is None:
+				self.genes = self.snapshot.document(self.i)
+			return self.genes.get(field, _MISSING)
+		if field in KEY_FIELDS:
+			return self.snapshot.tables[field].valueAt(self.i)
+		if self.metadata is None:
+			self.metadata = self.snapshot.metadata[self.i]
+		value = self.metadata
+		for part in field.split('.'):
+			if not isinstance(value, dict) or part not in value:
+				return _MISSING
+			value = value[part]
+		return value
+
+
+def _matchCondition(value, condition):
+	"""
+	:param value: Any - field value (_MISSING if absent)
+	:param condition: Any - MongoDB value or operator expression
+	:return: Boolean
+	"""
+	values = value if isinstance(value, list) else [value]
+	if not (isinstance(condition, dict) and len(condition) > 0 and all(k.startswith('$') for k in condition)):
+		return condition in values or value == condition
+	for op, arg in condition.items():
+		if op == '$exists':
+			ok = (value is not _MISSING) == bool(arg)
+		elif op == '$in':
+			ok = any(v in arg for v in values)
+		elif op == '$nin':
+			ok = not any(v in arg for v in values)
+		elif op == '$ne':
+			ok = arg not in values
+		elif op in ('$gt', '$gte', '$lt', '$lte'):
+			compare = {'$gt': lambda a: a > arg, '$gte': lambda a: a >= arg,
+						'$lt': lambda a: a < arg, '$lte': lambda a: a <= arg}[op]
+			ok = any(v is not _MISSING and type(v) == type(arg) and compare(v) for v in values)
+		else:
+			raise ValueError('Unsupported query operator in snapshot mode: ' + op)
+		if not ok:
+			return False
+	return True
+
+
+def _matchQuery(view, query):
+	"""
+	:param view: _DocumentView
+	:param query: Dict - MongoDB filter (equality, $and, $or, $in, $nin, $ne, $gt(e), $lt(e), $exists)
+	:return: Boolean
+	"""
+	for k, v in query.items():
+		if k == '$and':
+			ok = all(_matchQuery(view, q) for q in v)
+		elif k == '$or':
+			ok = any(_matchQuery(view, q) for q in v)
+		else:
+			ok = _matchCondition(view.get(k), v)
+		if not ok:
+			return False
+	return True
+
+
+class SnapshotCursor(object):
+	def __init__(self, collection, query, projection):
+		self.collection = collection
+		self.query = query
+		self.projection = projection
+		self.sortSpec = None
+		self.limitCount = 0
+
+
+	def sort(self, keyOrList, direction=1):
+		self.sortSpec = keyOrList if isinstance(keyOrList, list) else [(keyOrList, direction)]
+		return self
+
+
+	def limit(self, count):
+		self.limitCount = count
+		return self
+
+
+	def batch_size(self, size):
+		return self
+
+
+	def close(self):
+		pass
+
+
+	def __iter__(self):
+		snapshot = self.collection.snapshot
+		positions = self.collection.candidates(self.query)
+		matches = (i for i in positions if _matchQuery(_DocumentView(snapshot, i), self.query))
+		# Positions are in SORT_ORDER already: pages stop after 'limit' matches
+		if self.sortSpec is not None and list(self.sortSpec) != SORT_ORDER:
+			matches = list(matches)
+			# Stable sorts, least significant key first (missing values first, as in MongoDB)
+			for field, direction in reversed(self.sortSpec):
+				sortValue = lambda i: (lambda v: (0, '') if v is _MISSING else (1, v))(_DocumentView(snapshot, i).get(field))
+				matches.sort(key=sortValue, reverse=direction < 0)
+		for n, i in enumerate(matches):
+			if self.limitCount and n >= self.limitCount:
+				break
+			yield self.collection.project(i, self.projection)
+
+
+class SnapshotCollection(object):
+	"""
+	Read-only stand-in for the genesets collection, answering the queries
+	of the REST-API from a memory-mapped snapshot
+	"""
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+		self.tables = snapshot.tables		# memory-mapped: nothing is built per process
+
+
+	def candidates(self, query):
+		"""
+		Positions that may match 'query', narrowed with the lookup tables
+
+		:param query: Dict
+		:return: List<Int> - sorted
+		"""
+		positions = self._narrow(query)
+		return range(len(self.snapshot)) if positions is None else positions.tolist()
+
+
+	def _narrow(self, query):
+		"""
+		:return: ndarray<Int> or None - sorted distinct positions, None if no lookup table applies
+		"""
+		result = None
+		for k, v in query.items():
+			positions = None
+			if k == '$and':
+				for q in v:
+					p = self._narrow(q)
+					if p is not None:
+						positions = p if positions is None else np.intersect1d(positions, p, assume_unique=True)
+			elif k == '$or' and self._resumeKey(v) is not None:
+				# Resumed page (pagination.makeResumeQuery): everything after the key
+				positions = np.arange(self.snapshot.after(self._resumeKey(v)), len(self.snapshot), dtype=np.int64)
+			elif k == '$or':
+				parts = [self._narrow(q) for q in v]
+				if all(p is not None for p in parts):
+					positions = np.unique(np.concatenate(parts + [np.zeros(0, dtype=np.int32)]))
+			elif isinstance(v, dict) and set(v.keys()) == {'$in'} and k in self.tables:
+				positions = np.unique(np.concatenate([self.tables[k].positions(value) for value in v['$in']] + [np.zeros(0, dtype=np.int32)]))
+			elif isinstance(v, dict):
+				pass
+			elif k in KEY_FIELDS or (k in GENE_FIELDS and isinstance(v, str)):
+				positions = self.tables[k].positions(v)
+			elif k in V2_GENE_FIELDS:
+				# Snapshots store decoded genes only
+				positions = np.zeros(0, dtype=np.int32)
+			if positions is not None:
+				result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+		return result
+
+
+	@staticmethod
+	def _resumeKey(clauses):
+		"""
+		:param clauses: List<Dict> - '$or' clauses
+		:return: Tuple<String> or None - key if the clauses are those of pagination.makeResumeQuery
+		"""
+		last = clauses[-1] if isinstance(clauses, list) and len(clauses) > 0 else None
+		if not isinstance(last, dict) or not isinstance(last.get(INDEX_LIST[-1]), dict) or '$gt' not in last[INDEX_LIST[-1]]:
+			return None
+		key = [last.get(k) for k in INDEX_LIST[:-1]] + [last[INDEX_LIST[-1]]['$gt']]
+		if not all(isinstance(value, str) for value in key) or makeResumeQuery(key)['$or'] != clauses:
+			return None
+		return tuple(key)
+
+
+	def project(self, i, projection):
+		"""
+		:param i: Int - geneset position
+		:param projection: Dict or None - inclusion or exclusion ('_id' is ignored)
+		:return: Dict
+		"""
+		fields = {k: v for k, v in (projection or {}).items() if k != '_id'}
+		view = _DocumentView(self.snapshot, i)
+		if len(fields) > 0 and all(fields.values()):
+			doc = dict()
+			for field in fields:
+				value = view.get(field)
+				if value is not _MISSING:
+					doc[field] = value
+			return doc
+		doc = self.snapshot.metadata[i]
+		if not all(field in fields for field in ['genes'] + GENE_FIELDS):
+			doc.update({k: v for k, v in self.snapshot.document(i).items() if k == 'genes' or k in GENE_FIELDS})
+		return {k: v for k, v in doc.items() if k not in fields}
+
+
+	def find(self, query=None, projection=None, **kwargs):
+		return SnapshotCursor(self, query or dict(), projection)
+
+
+	def find_one(self, query=None, projection=None):
+		for doc in self.find(query, projection).limit(1):
+			return doc
+		return None
+
+
+class _SnapshotMeta(object):
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+
+
+	def find_one(self, query, projection=None):
+		if query.get('_id') != self.snapshot.manifest['collection']:
+			return None
+		return {'_id': query['_id'], 'version': self.snapshot.manifest['collectionVersion']}
+
+
+class SnapshotDatabase(object):
+	"""
+	Read-only stand-in for the database: the genesets collection and its version counter
+	"""
+	def __init__(self, snapshot):
+		self.snapshot = snapshot
+		self.collections = {snapshot.manifest['collection']: SnapshotCollection(snapshot),
+							META_COL: _SnapshotMeta(snapshot)}
+
+
+	def __getitem__(self, name):
+		if name not in self.collections:
+			raise KeyError('Collection not available in snapshot mode: ' + name)
+		return self.collections[name]
+
+
+def main():
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--out', type=str, help='Output directory')
+	parser.add_argument('--so', type=str, default=None, help='Only export genesets of this source')
+	parser.add_argument('--st', type=str, default=None, help='Only export genesets of this subtype')
+	parser.add_argument('--us', type=str, default=None, help='Only export genesets of this user')
+	parser.add_argument('--ti', type=int, default=None, help='Only export genesets of this NCBI Taxonomic ID')
+	parser.add_argument('--cs', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size: genesets converted per batch')
+
+	# Input parameter constraints
+	args = parser.parse_args()
+	assert args.out is not None
+	assert args.cs > 0
+
+	query = {k: v for k, v in zip(['source', 'subtype', 'user', 'taxId'], [args.so, args.st, args.us, args.ti]) if v is not None}
+	start = time.time()
+	manifest = export_snapshot(args.out, query, args.cs)
+	size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(args.out) for f in files)
+	print('{} genesets, {} entries, {} distinct genes: {:.1f} MB written to {} in {:.1f} s'.format(
+		manifest['genesets'], manifest['entries'], manifest['genes'], size / 1e6, args.out, time.time() - start))
+
+
+if __name__ == '__main__':
+	main()
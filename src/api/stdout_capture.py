@@ -0,0 +1,69 @@
+"""
+======================================================================
+stdout_capture.py: Per-thread capture of standard output
+======================================================================
+
+Gene mapping and upload report invalid genes with 'print'. Swapping
+'sys.stdout' (or 'contextlib.redirect_stdout') to collect them affects every
+thread of the process, so messages of concurrent API requests and background
+jobs would end up in each other's reports. 'captureStdout' instead installs
+a router as 'sys.stdout' once, which sends each write to the innermost
+capture buffer of the writing thread, or to the original stream.
+
+"""
+
+import sys
+import threading
+from contextlib import contextmanager
+from io import StringIO
+
+_local = threading.local()
+_installLock = threading.Lock()
+
+
+class _ThreadRoutedStdout(object):
+	def __init__(self, default):
+		self.default = default
+
+
+	def target(self):
+		stack = getattr(_local, 'stack', None)
+		return stack[-1] if stack else self.default
+
+
+	def write(self, s):
+		return self.target().write(s)
+
+
+	def flush(self):
+		self.target().flush()
+
+
+	def __getattr__(self, name):
+		return getattr(self.default, name)
+
+
+@contextmanager
+def captureStdout():
+	"""
+	Collect what the current thread prints
+
+	Example:
+		>>> with captureStdout() as s:
+		...     print('Error: X (taxId  9606) is not valid.')
+		>>> s.getvalue().splitlines()
+		['Error: X (taxId  9606) is not valid.']
+
+	:return: StringIO
+	"""
+	with _installLock:
+		if not isinstance(sys.stdout, _ThreadRoutedStdout):
+			sys.stdout = _ThreadRoutedStdout(sys.stdout)
+	if not hasattr(_local, 'stack'):
+		_local.stack = []
+	buffer = StringIO()
+	_local.stack.append(buffer)
+	try:
+		yield buffer
+	finally:
+		_local.stack.pop()
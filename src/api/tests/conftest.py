@@ -0,0 +1,49 @@
+"""
+Test setup: the API modules are imported from src/api and, when mongomock is
+installed, talk to an in-memory MongoDB (tests that need it are skipped
+otherwise). Run from src/api:
+
+	python -m pytest tests
+
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Responses and snapshots would outlive the collections dropped after each test
+os.environ['GEMS_RESPONSE_CACHE'] = 'off'
+os.environ.pop('GEMS_SNAPSHOT_DIR', None)
+
+try:
+	import mongomock
+except ImportError:
+	# No database at all (db_utils.db is None): never a real server
+	mongomock = None
+	os.environ.pop('MONGODB_HOST', None)
+else:
+	import pymongo
+	pymongo.MongoClient = mongomock.MongoClient
+	os.environ.update(MONGODB_USERNAME='gems', MONGODB_PASSWORD='gems', MONGODB_HOST='localhost',
+						MONGODB_PORT='27017', MONGODB_DB='gems_test')
+
+
+@pytest.fixture
+def db():
+	"""
+	:return: Database - empty, dropped after the test (mapping caches and similarity index reset)
+	"""
+	if mongomock is None:
+		pytest.skip('mongomock is not installed')
+	import db_utils
+	import map_utils
+	map_utils.clearMappingCache()
+	yield db_utils.db
+	for name in db_utils.db.list_collection_names():
+		db_utils.db.drop_collection(name)
+	map_utils.clearMappingCache()
+	if 'similarity_index' in sys.modules:
+		sys.modules['similarity_index']._index = None
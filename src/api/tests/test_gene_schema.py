@@ -0,0 +1,95 @@
+"""
+Genesets written as schema v2 must read back byte-identical to their v1 genes
+"""
+
+import json
+
+import pytest
+
+GENES = [(22059, 'Trp53', 10090), (12189, 'Brca1', 10090), (7157, 'TP53', 9606), (672, 'BRCA1', 9606)]
+
+GENESETS = {
+	'plain': [[['Trp53', '22059', 'TP53', '7157'], 1.5], [['Brca1', '12189', 'BRCA1', '672'], None]],
+	# Symbols other than those of the NCBI collection: kept as overrides
+	'overrides': [[['p53', '22059', 'TP53', '7157'], -0.25], [['', '12189', 'Brca1-human', '672'], None],
+				[['Brca1', '12189', 'BRCA1', '672'], 0.0]],
+	# Genes without IDs
+	'idless': [[['Unknown', '', 'UNK', ''], None], [['Trp53', '22059', '', ''], 2.0], [['', '', '', ''], None]],
+	# Zero-padded IDs do not survive int encoding: stays v1
+	'padded': [[['Trp53', '022059', 'TP53', '7157'], None]],
+}
+
+
+def v1Geneset(name):
+	from db_utils import flatten_genes
+	doc = {'setName': name, 'source': 'S', 'subtype': '', 'user': 'u', 'desc': 'd', 'genes': GENESETS[name]}
+	doc.update(flatten_genes(doc['genes']))
+	return doc
+
+
+@pytest.fixture
+def genesets(db):
+	"""
+	:return: Dict - {setName: v1 geneset}, stored as v2 where possible
+	"""
+	from db_config import GENE_COL, COLLECTION_NAME
+	from gene_schema import encode_genesets, to_v2
+	db[GENE_COL].insert_many([{'geneId': geneId, 'Symbol': symbol, 'Symbol_official': symbol, 'taxId': taxId, 'Synonyms': []}
+								for geneId, symbol, taxId in GENES])
+	docs = [v1Geneset(name) for name in GENESETS]
+	for doc, encoded in zip(docs, encode_genesets(docs)):
+		db[COLLECTION_NAME].insert_one(dict(doc) if encoded is None else to_v2(doc, encoded))
+	return {doc['setName']: doc for doc in docs}
+
+
+def test_encoding(genesets, db):
+	from db_config import COLLECTION_NAME
+	from gene_schema import is_v2
+	stored = {doc['setName']: doc for doc in db[COLLECTION_NAME].find()}
+	assert not is_v2(stored['padded'])
+	assert stored['padded']['genes'] == GENESETS['padded']
+	for name in ['plain', 'overrides', 'idless']:
+		assert is_v2(stored[name])
+		assert not any(field in stored[name] for field in ['genes', 'nativeIds', 'humanIds'])
+	assert 'symbolOverrides' not in stored['plain']
+	assert stored['overrides']['symbolOverrides'] == [[0, 'p53', 'TP53'], [1, '', 'Brca1-human']]
+	assert stored['idless']['nativeGeneIds'] == [0, 22059, 0]
+	assert stored['idless']['humanGeneIds'] == [0, 0, 0]
+
+
+@pytest.mark.parametrize('projection', [
+	{'setName': 1, 'genes': 1, 'nativeIds': 1, 'humanIds': 1, '_id': 0},	# inclusion
+	{'_id': 0, 'desc': 0},													# exclusion
+	{'_id': 0, 'desc': 0, 'coeffs': 0},										# exclusion naming a v2 field
+])
+def test_round_trip(genesets, db, projection):
+	from db_config import COLLECTION_NAME
+	from db_utils import V2_GENE_FIELDS
+	from gene_schema import DECODED_FIELDS, read_projection, decode_genesets
+	docs = decode_genesets(list(db[COLLECTION_NAME].find({}, read_projection(projection))), DECODED_FIELDS)
+	assert sorted(doc['setName'] for doc in docs) == sorted(GENESETS)
+	for doc in docs:
+		expected = genesets[doc['setName']]
+		for field in DECODED_FIELDS:
+			assert json.dumps(doc[field]) == json.dumps(expected[field])
+		assert not any(field in doc for field in V2_GENE_FIELDS)
+		assert ('desc' in doc) == (projection.get('desc') == 1)
+
+
+def test_read_projection():
+	from db_utils import V2_GENE_FIELDS
+	from gene_schema import read_projection
+	# Inclusion: v2 fields only if a decoded field is asked for
+	assert read_projection({'setName': 1, '_id': 0}) == {'setName': 1, '_id': 0}
+	assert read_projection({'nativeIds': 1}) == {'nativeIds': 1, **{field: 1 for field in V2_GENE_FIELDS}}
+	# Exclusion: v2 fields are never excluded
+	assert read_projection({'_id': 0, 'coeffs': 0, 'desc': 0}) == {'_id': 0, 'desc': 0}
+	assert read_projection(None) is None
+
+
+def test_genes_only_by_default(genesets, db):
+	from db_config import COLLECTION_NAME
+	from gene_schema import read_projection, decode_genesets
+	doc = decode_genesets(list(db[COLLECTION_NAME].find({'setName': 'overrides'}, read_projection({'_id': 0}))))[0]
+	assert json.dumps(doc['genes']) == json.dumps(GENESETS['overrides'])
+	assert 'nativeIds' not in doc and 'humanIds' not in doc
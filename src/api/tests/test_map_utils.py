@@ -0,0 +1,84 @@
+"""
+getGeneArrays (batched lookups) must give the same gene arrays and print the
+same error messages as getGeneArray called on each gene in turn
+"""
+
+import pytest
+
+HUMAN = 9606
+MOUSE = 10090
+
+GENES = [
+	# Human
+	(7157, 'TP53', HUMAN, ['P53', 'AMB']),
+	(672, 'BRCA1', HUMAN, ['RNF53']),
+	(1001, 'HA', HUMAN, ['AMB']),		# 'AMB' is ambiguous
+	(1002, 'HB', HUMAN, []),
+	(1003, 'HC', HUMAN, []),
+	# Mouse
+	(22059, 'Trp53', MOUSE, ['p53']),
+	(12189, 'Brca1', MOUSE, []),
+	(100, 'Multi', MOUSE, []),			# two human homologs
+	(200, 'Lonely', MOUSE, []),			# no homolog
+	(300, 'Amb1', MOUSE, ['mamb']),
+	(301, 'Amb2', MOUSE, ['mamb']),		# 'mamb' is ambiguous
+	(400, 'M1', MOUSE, []),
+	(401, 'M2', MOUSE, []),
+]
+
+HOMOLOGENE = [
+	[(HUMAN, 7157), (MOUSE, 22059)],
+	[(HUMAN, 672), (MOUSE, 12189)],
+	[(HUMAN, 1001), (HUMAN, 1002), (MOUSE, 100)],
+	[(HUMAN, 1003), (MOUSE, 400), (MOUSE, 401)],	# two mouse homologs
+]
+
+# (taxId, format, genes): valid, duplicated, synonym, ambiguous, homolog-less and invalid inputs
+CASES = [
+	(MOUSE, 0, ['Trp53', 'p53', 'Multi', 'Lonely', 'mamb', 'NOPE', 'Trp53', 'Brca1', 'M1']),
+	(HUMAN, 0, ['TP53', 'P53', 'AMB', 'NOPE', 'BRCA1', 'TP53', 'HC']),
+	(MOUSE, 1, ['22059', '100', '200', '999999', 12189, '400', '22059']),
+	(HUMAN, 1, ['7157', 672, '999999', '1003', '7157']),
+	(MOUSE, 2, ['TP53', 'HA', 'HC', 'AMB', 'NOPE', 'RNF53', 'BRCA1', 'TP53']),
+	(HUMAN, 2, ['TP53', 'HA', 'AMB', 'NOPE', 'RNF53']),
+	(MOUSE, 3, ['7157', '1001', '1003', '999999', 672, '7157']),
+	(HUMAN, 3, ['7157', '1002', '999999', 672]),
+]
+
+
+@pytest.fixture
+def ncbi(db):
+	from db_config import GENE_COL, MAPPING_COL
+	db[GENE_COL].insert_many([{'geneId': geneId, 'Symbol': symbol, 'Symbol_official': symbol, 'taxId': taxId, 'Synonyms': synonyms}
+								for geneId, symbol, taxId, synonyms in GENES])
+	db[MAPPING_COL].insert_many([{'homId': i, 'members': [{'taxId': taxId, 'geneId': geneId} for taxId, geneId in members]}
+								for i, members in enumerate(HOMOLOGENE)])
+	return db
+
+
+@pytest.mark.parametrize('taxId, geneFormat, genes', CASES)
+def test_batched_matches_per_gene(ncbi, capsys, taxId, geneFormat, genes):
+	from map_utils import getGeneArray, getGeneArrays, clearMappingCache
+
+	perGene = [getGeneArray(gene, taxId, geneFormat) for gene in genes]
+	perGeneOutput = capsys.readouterr().out
+	clearMappingCache()
+	batched = getGeneArrays(genes, taxId, geneFormat)
+	batchedOutput = capsys.readouterr().out
+
+	assert batched == perGene
+	assert batchedOutput == perGeneOutput
+	assert 'is not valid' in perGeneOutput
+
+
+def test_expected_arrays(ncbi, capsys):
+	from map_utils import getGeneArrays
+
+	assert getGeneArrays(['p53', 'Multi', 'mamb'], MOUSE, 0) == [
+		['p53', '22059', 'TP53', '7157'],
+		['Multi', '100', '', ''],
+		['mamb', '', '', '']]
+	assert getGeneArrays(['1003', '7157'], MOUSE, 3) == [
+		['', '', 'HC', '1003'],
+		['Trp53', '22059', 'TP53', '7157']]
+	assert capsys.readouterr().out == 'Error: mamb (taxId  10090) is not valid.\n'
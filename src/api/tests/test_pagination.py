@@ -0,0 +1,122 @@
+"""
+Keyset pagination of /api/genesets and ranked pagination of /api/similar
+"""
+
+import base64
+import json
+
+import pytest
+
+from db_utils import INDEX_LIST
+from pagination import encodeResumeToken, decodeResumeToken, paginateRanked
+
+MALFORMED_TOKENS = [
+	'not base64!',
+	base64.urlsafe_b64encode(b'{"a": 1}').decode('ascii'),		# not a list
+	encodeResumeToken(['gs1', 'S', '']),						# too short
+	encodeResumeToken(['gs1', 'S', '', 1]),					# key values must be strings
+	'éééé',
+]
+
+
+def test_token_round_trip():
+	key = ['gs1', 'S', '', 'ué']
+	assert decodeResumeToken(encodeResumeToken(key), len(INDEX_LIST)) == key
+	ranked = [0.5] + key
+	assert decodeResumeToken(encodeResumeToken(ranked), len(INDEX_LIST) + 1) == ranked
+
+
+@pytest.mark.parametrize('token', MALFORMED_TOKENS)
+def test_malformed_token(token):
+	for length in [len(INDEX_LIST), len(INDEX_LIST) + 1]:
+		with pytest.raises(ValueError):
+			decodeResumeToken(token, length)
+
+
+def test_malformed_ranked_token():
+	for values in [[True, 'gs1', 'S', '', 'u'], ['0.5', 'gs1', 'S', '', 'u'], ['gs1', 'S', '', 'u', 0.5]]:
+		with pytest.raises(ValueError):
+			decodeResumeToken(encodeResumeToken(values), len(INDEX_LIST) + 1)
+
+
+def test_ranked_pages():
+	# Ties are broken by key, whatever the input order
+	matches = [(('gs3', 'S', '', 'u'), 0.5), (('gs1', 'T', '', 'u'), 0.9), (('gs2', 'S', '', 'u'), 0.5),
+				(('gs1', 'S', '', 'u'), 0.5), (('gs4', 'S', '', 'u'), 0.1)]
+	expected = [('gs1', 'T'), ('gs1', 'S'), ('gs2', 'S'), ('gs3', 'S'), ('gs4', 'S')]
+	for limit in [1, 2, 5, 6]:
+		pages = []
+		token = None
+		while True:
+			page, token = paginateRanked(matches, limit, token)
+			pages.append(page)
+			if token is None:
+				break
+		assert [key[:2] for page in pages for key, _ in page] == expected
+		assert all(len(page) == limit for page in pages[:-1])
+		# No empty last page when the matches fill the pages exactly
+		assert 0 < len(pages[-1]) <= limit
+
+
+def mk(name, genes, source='S'):
+	from db_utils import flatten_genes
+	doc = {'setName': name, 'source': source, 'subtype': '', 'user': 'u', 'taxId': 9606, 'desc': 'd',
+			'genes': [[['', '', gene, ''], None] for gene in genes], 'hasCoeff': False}
+	doc.update(flatten_genes(doc['genes']))
+	return doc
+
+
+@pytest.fixture
+def client(db):
+	from db_config import COLLECTION_NAME
+	# 'gs3' and 'gs4' tie with 'gs2' against 'gs2'
+	db[COLLECTION_NAME].insert_many([mk('gs1', ['A', 'B', 'C', 'D']), mk('gs2', ['A', 'B']), mk('gs4', ['A', 'B']),
+									mk('gs3', ['A', 'B']), mk('gs0', ['A', 'B'], 'T'), mk('gs5', ['Z'])])
+	import app
+	return app.app.test_client()
+
+
+def getPages(client, url):
+	pages = []
+	token = ''
+	while token is not None:
+		body = json.loads(client.get(url + ('&resumeToken=' + token if token else '')).data)
+		pages.append(body['response'])
+		token = body['resumeToken']
+	return pages
+
+
+def test_genesets_pages(client):
+	pages = getPages(client, '/api/genesets?source=S&limit=2&returnParams=setName')
+	assert [[doc['setName'] for doc in page] for page in pages] == [['gs1', 'gs2'], ['gs3', 'gs4'], ['gs5']]
+	# Exactly filled pages: the last full page has no token
+	pages = getPages(client, '/api/genesets?source=S&limit=5&returnParams=setName')
+	assert [len(page) for page in pages] == [5]
+
+
+def test_gmt_pages(client):
+	response = client.get('/api/genesets?source=S&limit=3&getGmt=true')
+	assert [line.split('\t')[0] for line in response.data.decode('utf-8').split('\n')] == ['gs1', 'gs2', 'gs3']
+	token = response.headers['X-Resume-Token']
+	response = client.get('/api/genesets?source=S&limit=3&getGmt=true&resumeToken=' + token)
+	assert [line.split('\t')[0] for line in response.data.decode('utf-8').split('\n')] == ['gs4', 'gs5']
+	assert 'X-Resume-Token' not in response.headers
+
+
+def test_similar_ties(client):
+	url = '/api/similar?setName=gs2&source=S&subtype=&user=u&method=jaccard&threshold=0.1&limit=2'
+	pages = getPages(client, url)
+	assert [[(m['setName'], m['source'], m['coeff']) for m in page] for page in pages] == [
+		[('gs0', 'T', 1.0), ('gs2', 'S', 1.0)], [('gs3', 'S', 1.0), ('gs4', 'S', 1.0)], [('gs1', 'S', 0.5)]]
+
+
+@pytest.mark.parametrize('token', MALFORMED_TOKENS)
+def test_malformed_token_answers_400(client, token):
+	for url in ['/api/genesets?source=S&limit=2&resumeToken=',
+				'/api/genesets?source=S&limit=2&getGmt=true&resumeToken=',
+				'/api/similar?setName=gs2&source=S&subtype=&user=u&method=jaccard&threshold=0.1&limit=2&resumeToken=']:
+		response = client.get(url + token)
+		assert response.status_code == 400
+		assert response.get_json() == {'response': 400}
+	response = client.post('/api/genesets', json={'source': 'S', 'limit': 2, 'resumeToken': token})
+	assert response.status_code == 400
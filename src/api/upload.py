@@ -11,33 +11,271 @@ __status__ = "In progress"
 
 import argparse
 import os
-import sys
-from io import StringIO
+import time
+from contextlib import closing
 
 
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
 from db_config import COLLECTION_NAME
-from db_utils import db, create_collection, FIELD_CONSTRAINTS, INDEX_LIST
-from gmtx_utils import parse_file, make_default_json, make_col_search_dict, make_batch_input
-from gmtx_utils import make_api_default_json
+from db_utils import db, create_collection, bump_collection_version, FIELD_CONSTRAINTS, INDEX_LIST
+from gmtx_utils import stream_file, make_default_json, make_col_search_dict, iter_batch_input
+from gmtx_utils import make_api_default_json, iter_chunks, make_fingerprint_seed, make_fingerprint
+from stdout_capture import captureStdout
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Fields that scope '--pr': one upload only prunes the genesets of its own file
+PRUNE_SCOPE = ['source', 'subtype', 'user', 'taxId', 'domain']
+
+
+def bulkUpsert(genesets, ordered=False):
+	"""
+	Replace-with-upsert a list of genesets on the uniqueness index in one bulk write.
+	Per-document errors (e.g. schema validator rejections) are printed and counted,
+	they do not abort the rest of an unordered write.
+	
+	:param genesets: List<Dict>
+	:param ordered: Boolean - stop at the first failing document
+	:return: Dict - {'inserted': Int, 'matched': Int, 'failed': Int}
+	"""
+	requests = []
+	for geneset in genesets:
+		uniqueCondition = {index: geneset[index] for index in INDEX_LIST}
+		requests.append(ReplaceOne(uniqueCondition, geneset, upsert=True))
+	
+	try:
+		result = db[COLLECTION_NAME].bulk_write(requests, ordered=ordered)
+		details = result.bulk_api_result
+	except BulkWriteError as e:
+		details = e.details
+	
+	for writeError in details['writeErrors']:
+		geneset = genesets[writeError['index']]
+		print("Error: geneset " + str(geneset['setName']) + " was not written - " + writeError['errmsg'])
+	
+	inserted = details['nUpserted'] + details['nInserted']
+	matched = details['nMatched']
+	# Documents skipped after the first error of an ordered write also count as failed
+	failed = len(genesets) - inserted - matched
+	return {'inserted': inserted, 'matched': matched, 'failed': failed}
+
+
+def loadToMongo(jsonList, chunkSize=DEFAULT_CHUNK_SIZE, ordered=False, verbose=False, progress=None):
+	"""
+	Upload logic: bulk upsert on index, 'chunkSize' genesets per round trip.
+	'jsonList' may be a generator (see 'gmtx_utils.iter_batch_input'): only one
+	chunk is held in memory at a time.
+	
+	:param jsonList: Iterable<Dict>
+	:param chunkSize: Int
+	:param ordered: Boolean
+	:param verbose: Boolean - print a report (with throughput) per chunk
+	:param progress: Callable or None - called with keyword counts: 'mapped' once a chunk is built, totals once it is written
+	:return: Dict - total 'rows', 'inserted', 'matched' and 'failed' counts
+	"""
+	totals = {'rows': 0, 'inserted': 0, 'matched': 0, 'failed': 0}
+	start = time.time()
+	for chunkNum, chunk in enumerate(iter_chunks(jsonList, chunkSize), 1):
+		if progress is not None:
+			progress(mapped=totals['rows'] + len(chunk))
+		report = bulkUpsert(chunk, ordered)
+		totals['rows'] += len(chunk)
+		for k, v in report.items():
+			totals[k] += v
+		if progress is not None:
+			progress(**totals)
+		if verbose:
+			elapsed = time.time() - start
+			print("Chunk {}: {} inserted, {} matched, {} failed ({} rows, {:.1f} rows/sec)".format(
+				chunkNum, report['inserted'], report['matched'], report['failed'],
+				totals['rows'], totals['rows'] / max(elapsed, 1e-9)))
+	return totals
+
+
+
+def get_fingerprints(source, subtype, user):
+	"""
+	Fingerprints of the stored genesets of one source/subtype/user
+	
+	:param source: String
+	:param subtype: String
+	:param user: String
+	:return: Dict - {setName: fingerprint or None}
+	"""
+	query = {'source': source, 'subtype': subtype, 'user': user}
+	findDocs = db[COLLECTION_NAME].find(query, {'setName': 1, 'fingerprint': 1, '_id': 0})
+	return {d['setName']: d.get('fingerprint') for d in findDocs}
+
+
+def filter_changed_rows(rowIterator, setNameCol, fingerprintSeed, stored, counts):
+	"""
+	Delta mode: drop the rows whose fingerprint matches the stored geneset, before any gene mapping
+	
+	:param rowIterator: Iterable<List<String>>
+	:param setNameCol: Int
+	:param fingerprintSeed: <class '_hashlib.HASH'>
+	:param stored: Dict - see 'get_fingerprints'
+	:param counts: Dict - updated in place: 'seen' (Set<String> of set names) and 'skipped' (Int)
+	:return: Generator<List<String>>
+	"""
+	for parsedLine in rowIterator:
+		setName = parsedLine[setNameCol]
+		counts['seen'].add(setName)
+		if stored.get(setName) == make_fingerprint(fingerprintSeed, parsedLine):
+			counts['skipped'] += 1
+		else:
+			yield parsedLine
+
+
+def prune_genesets(source, subtype, user, setNames):
+	"""
+	Delete the named genesets of one source/subtype/user
+	
+	:param source: String
+	:param subtype: String
+	:param user: String
+	:param setNames: List<String>
+	:return: Int - number of deleted genesets
+	"""
+	deleted = 0
+	for chunk in iter_chunks(setNames, DEFAULT_CHUNK_SIZE):
+		query = {'source': source, 'subtype': subtype, 'user': user, 'setName': {'$in': chunk}}
+		deleted += db[COLLECTION_NAME].delete_many(query).deleted_count
+	return deleted
+
+
+def prune_scope(constantJSON):
+	"""
+	The genesets an input file stands for: several files share a source/subtype/user
+	(e.g. one per organism or MSigDB sub-category), so the taxId and domain are part of it
+	
+	:param constantJSON: Dict - see 'gmtx_utils.make_default_json'
+	:return: Dict - MongoDB filter on 'PRUNE_SCOPE'
+	"""
+	return {field: constantJSON[field] for field in PRUNE_SCOPE}
+
+
+def prune_missing(scope, seen):
+	"""
+	Delete the genesets of a prune scope whose set name is not in 'seen'
+	
+	:param scope: Dict - see 'prune_scope'
+	:param seen: Set<String> - set names of the input file(s) of the scope
+	:return: Int - number of deleted genesets
+	"""
+	stored = db[COLLECTION_NAME].find(scope, {'setName': 1, '_id': 0})
+	missing = [d['setName'] for d in stored if d['setName'] not in seen]
+	deleted = 0
+	for chunk in iter_chunks(missing, DEFAULT_CHUNK_SIZE):
+		deleted += db[COLLECTION_NAME].delete_many({**scope, 'setName': {'$in': chunk}}).deleted_count
+	return deleted
+
+
+def load_rows(rowIterator, searchDict, constantJSON, fingerprintSeed, chunkSize=DEFAULT_CHUNK_SIZE,
+			ordered=False, verbose=False, delta=False, prune=False, progress=None, seen=None):
+	"""
+	Shared upload pipeline: [skip unchanged rows ->] map genes -> build documents -> bulk write [-> prune]
+	
+	:param rowIterator: Iterable<List<String>>
+	:param searchDict: Dict
+	:param constantJSON: Dict
+	:param fingerprintSeed: <class '_hashlib.HASH'>
+	:param chunkSize: Int
+	:param ordered: Boolean
+	:param verbose: Boolean
+	:param delta: Boolean - only map and write new or changed genesets
+	:param prune: Boolean - (delta mode) delete stored genesets of the same 'prune_scope' missing from the input
+	:param progress: Callable or None - see 'loadToMongo'
+	:param seen: Set<String> or None - (delta mode) collects the set names of the input
+	:return: Dict - see 'loadToMongo', plus 'skipped' and 'deleted' counts
+	"""
+	assert delta or not prune
+	key = (constantJSON['source'], constantJSON['subtype'], constantJSON['user'])
+	counts = {'seen': set() if seen is None else seen, 'skipped': 0}
+	if delta:
+		stored = get_fingerprints(*key)
+		setNameCol = searchDict['accepted']['setName']
+		rowIterator = filter_changed_rows(rowIterator, setNameCol, fingerprintSeed, stored, counts)
+	
+	# Extract and merge (lazily: genes are mapped one window of 'chunkSize' rows at a time)
+	mongo_input = iter_batch_input(rowIterator, searchDict, constantJSON, chunkSize, fingerprintSeed)
+	
+	# Load data
+	totals = loadToMongo(mongo_input, chunkSize=chunkSize, ordered=ordered, verbose=verbose, progress=progress)
+	totals['skipped'] = counts['skipped']
+	totals['deleted'] = 0
+	if prune:
+		totals['deleted'] = prune_missing(prune_scope(constantJSON), counts['seen'])
+	if totals['inserted'] + totals['matched'] + totals['deleted'] > 0:
+		bump_collection_version(db, COLLECTION_NAME)
+	return totals
 
 
-def loadToMongo(jsonList):
+def upload_file(fileLoc, args, chunkSize=DEFAULT_CHUNK_SIZE, ordered=False, verbose=False, delta=False, prune=False,
+				seen=None):
 	"""
-	Upload logic: upsert on index
+	Stream, map and bulk-write a single GMTx file
 	
-	:param jsonList: List<Dict>
-	:return: VOID
+	:param fileLoc: String
+	:param args: <class 'argparse.Namespace'> - gf, so, ti, us, st, do
+	:param chunkSize: Int
+	:param ordered: Boolean
+	:param verbose: Boolean
+	:param delta: Boolean
+	:param prune: Boolean
+	:param seen: Set<String> or None - see 'load_rows'
+	:return: Dict - see 'load_rows'
 	"""
-	for geneset in jsonList:
-		uniqueCondition = [{index: geneset[index]} for index in INDEX_LIST]
-		db[COLLECTION_NAME].update({'$and': uniqueCondition}, geneset, upsert=True)
+	headers, rowIterator = stream_file(fileLoc)
+	with closing(rowIterator):
+		fingerprintSeed = make_fingerprint_seed(headers, vars(args))
 		
+		# Make search index for accepted and meta-tags
+		search_dict, hasCoeff, coeffType = make_col_search_dict(headers, args.gf)
+		
+		# Find the constant elements of the geneset collection
+		default_json = make_default_json(args, hasCoeff, coeffType)
+
+		return load_rows(rowIterator, search_dict, default_json, fingerprintSeed, chunkSize=chunkSize,
+						ordered=ordered, verbose=verbose, delta=delta, prune=prune, seen=seen)
+
 		
+def api_load(headers, rawList, params, progress=None):
+	"""
+	Upload rows received by the REST-API ('api_insert' without capturing the error messages)
+	
+	:param headers: List<String>
+	:param rawList: List<List<String>>
+	:param params: Dict - see 'api_insert'
+	:param progress: Callable or None - see 'loadToMongo'
+	:return: Dict - see 'load_rows'
+	"""
+	assert all(s in params for s in ['gf', 'so', 'ti', 'us'])
+	# As '/api/remove': Public genesets are not deleted through the API
+	assert not (params.get('prune', False) and params['us'] == 'Public')
+	
+	# Make search index for accepted and meta-tags
+	geneFormat = params['gf']
+	assert geneFormat in [0, 1, 2, 3]
+	fingerprintSeed = make_fingerprint_seed(headers, params)
+	search_dict, hasCoeff, coeffType = make_col_search_dict(headers, geneFormat)
+	
+	# Find the constant elements of the geneset collection
+	default_json = make_api_default_json(params, hasCoeff, coeffType)
+	
+	# Extract, merge and load data
+	return load_rows(rawList, search_dict, default_json, fingerprintSeed,
+					delta=params.get('delta', False), prune=params.get('prune', False), progress=progress)
+
+
 def api_insert(headers, rawList, params):
 	"""
 	Functional duplicate to ''main': inserts via REST-API
 	
 	Returns standard output error messages as a list of strings.
+	Optional boolean params 'delta' and 'prune' behave as the '--dl' and '--pr' CLI flags.
 	
 	Example:
 		>>> from upload import api_insert
@@ -54,29 +292,9 @@ def api_insert(headers, rawList, params):
 	:param params: Dict
 	:return: List<String>
 	"""
-	assert all(s in params for s in ['gf', 'so', 'ti', 'us'])
-	
-	# Command-line error logging
-	ogSys = sys.stdout
-	s = StringIO()
-	sys.stdout = s
-	
-	# Make search index for accepted and meta-tags
-	geneFormat = params['gf']
-	assert geneFormat in [0, 1, 2, 3]
-	search_dict, hasCoeff, coeffType = make_col_search_dict(headers, geneFormat)
-	
-	# Find the constant elements of the geneset collection
-	default_json = make_api_default_json(params, hasCoeff, coeffType)
-
-	# Extract and merge
-	mongo_input = make_batch_input(rawList, search_dict, default_json)
-	
-	# Load data
-	loadToMongo(mongo_input)
-	
-	# Restore sys.stdout and get error messages
-	sys.stdout = ogSys
+	# Command-line error logging (of this thread only: the API serves requests concurrently)
+	with captureStdout() as s:
+		api_load(headers, rawList, params)
 	errorMsgs = s.getvalue().splitlines()
 	
 	return errorMsgs
@@ -95,6 +313,11 @@ def main():
 	parser.add_argument('--st', type=str, default='', help='Subtype: database sub-category (e.g. C7)')
 	parser.add_argument('--do', type=str, default='', help='Domain: functional meta-category (e.g. pathway)')
 	
+	parser.add_argument('--cs', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size: genesets per bulk write')
+	parser.add_argument('--or', dest='ordered', action='store_true', help='Ordered bulk writes: stop a chunk at the first failing geneset')
+	parser.add_argument('--dl', dest='delta', action='store_true', help='Delta mode: only map and write new or changed genesets')
+	parser.add_argument('--pr', dest='prune', action='store_true', help='Delta mode: delete genesets of this source/subtype/user/taxId/domain missing from the file')
+	
 
 	# Input parameter constraints
 	args = parser.parse_args()
@@ -103,28 +326,18 @@ def main():
 	assert args.so is not None
 	assert args.ti is not None
 	assert args.us is not None
+	assert args.cs > 0
+	assert args.delta or not args.prune
 
-	# Parse file
-	fileLoc = args.fl
-	headers, rawList = parse_file(fileLoc)
-	
-	# Make search index for accepted and meta-tags
-	geneFormat = args.gf
-	search_dict, hasCoeff, coeffType = make_col_search_dict(headers, geneFormat)
-	
-	# Find the constant elements of the geneset collection
-	default_json = make_default_json(args, hasCoeff, coeffType)
-
-	# Extract and merge
-	mongo_input = make_batch_input(rawList, search_dict, default_json)
-	
 	# Create collection
 	if COLLECTION_NAME not in db.collection_names():
 		create_collection(db, COLLECTION_NAME, FIELD_CONSTRAINTS, INDEX_LIST)
 	
-	# Load data
-	loadToMongo(mongo_input)
-
+	# Stream, map and load data
+	totals = upload_file(args.fl, args, chunkSize=args.cs, ordered=args.ordered, verbose=True,
+						delta=args.delta, prune=args.prune)
+	print("Total: {} inserted, {} matched, {} failed, {} unchanged, {} deleted".format(
+		totals['inserted'], totals['matched'], totals['failed'], totals['skipped'], totals['deleted']))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,28 @@
 '''
 run.py - Load gene mappings into a MongoDB collection
+
+NCBI gene_info (plain or gzipped) and HomoloGene data are streamed: rows are
+parsed, optionally filtered by taxId, and inserted in bounded chunks (by one
+or several threads) into staging collections. Once a staging collection is
+complete and indexed for the queries of src/api/map_utils.py, it is renamed
+over the live collection in one step, so mapping queries never see a
+missing or half-loaded collection. A failed load leaves the live
+collections untouched.
+
+Example:
+	[\\GeMS\\src\\ncbi_gene_mapper\\] python run.py --gi gene_info.gz --hg homologene.data --ti 9606 10090 10116 --np 4
 '''
 
+import argparse
+import gzip
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby, islice
+
+import pymongo
+from pymongo import MongoClient
 
 MONGODB_USERNAME=os.environ['MONGODB_USERNAME']
 MONGODB_PASSWORD=os.environ['MONGODB_PASSWORD']
@@ -10,113 +30,219 @@ MONGODB_HOST=os.environ['MONGODB_HOST']
 MONGODB_PORT=os.environ['MONGODB_PORT']
 MONGODB_DB=os.environ['MONGODB_DB']
 
-GENE_COL = 'GeMS_gene_info'
-MAPPING_COL = 'GeMS_homologene_map'
+# Read by src/api/map_utils.py (db_config.GENE_COL and MAPPING_COL)
+GENE_COL = 'ncbi_gene_info'
+MAPPING_COL = 'ncbi_homologene'
+# Collection versions (db_config.META_COL): a new version makes the API processes clear their mapping caches
+META_COL = 'GeMS_meta'
+# Genesets (db_config.COLLECTION_NAME): those of schema v2 take their gene symbols from GENE_COL
+GENESET_COL = 'GeMS_genesets'
+STAGING_SUFFIX = '_staging'
 
 
 # File Configuration
 
-GENE_INFO_FILE = 'gene_info.txt'
+GENE_INFO_FILE = 'gene_info.gz'
 HOMOLOGENE_FILE = 'homologene.data'
 
+DEFAULT_CHUNK_SIZE = 10000
+
+
+# Indexes of the lookups in map_utils (created on the staging collections, before the swap)
+GENE_INDEXES = [([('geneId', pymongo.ASCENDING)], {'unique': True}),
+				([('Symbol', pymongo.ASCENDING), ('taxId', pymongo.ASCENDING)], {}),
+				([('Symbol_official', pymongo.ASCENDING), ('taxId', pymongo.ASCENDING)], {}),
+				([('Synonyms', pymongo.ASCENDING), ('taxId', pymongo.ASCENDING)], {})]
+MAPPING_INDEXES = [([('members.geneId', pymongo.ASCENDING)], {})]
+
 
 # Helper Functions
 
-def mapIdToSymbol(fileLoc):
+def openText(fileLoc):
 	"""
-	Outputs a dictionary with key, value:
-		KEY: <Int> - Gene ID
-		VALUE: Dict with keys:
-			- taxId: <Int>
-			- geneSymbol: <String>
-	
+	:param fileLoc: String - '.gz' files are decompressed on the fly
+	:return: File object (text)
+	"""
+	if fileLoc.endswith('.gz'):
+		return gzip.open(fileLoc, 'rt', encoding='utf-8')
+	return open(fileLoc, 'r', encoding='utf-8')
+
+
+def iterGeneInfo(fileLoc, taxIds=None):
+	"""
+	Yields one document per gene of NCBI gene_info:
+		- geneId: <Int>
+		- taxId: <Int>
+		- Symbol: <String>
+		- Symbol_official: <String> (if the nomenclature authority gives one)
+		- Synonyms: List<String> (if any)
+
 	:param fileLoc: String - File location of NCBI Entrez Gene ID information
-	:return infoDict: Dict
+	:param taxIds: Set<Int> or None - only yield genes of these taxa
+	:return: Generator<Dict>
 	"""
 	# Define column indexes
 	taxIdCol = 0
 	geneIdCol = 1
 	geneSymbolCol = 2
 	synonymCol = 4
-	
-	# Initialise data store
-	infoDict = dict()
-	
-	# Read file and store info
-	with open(fileLoc, 'r') as f:
-		f.readline()
+	officialSymbolCol = 10
+
+	with openText(fileLoc) as f:
 		for l in f:
-			l = l.split('\t')
-			geneId = int(l[geneIdCol])
-			assert geneId not in infoDict
-			
-			geneJson = {'taxId': int(l[taxIdCol]),
+			if l.startswith('#'):
+				continue
+			# The taxId is checked before the rest of the row is split
+			taxId = int(l[:l.index('\t')])
+			if taxIds is not None and taxId not in taxIds:
+				continue
+
+			l = l.rstrip('\n').split('\t')
+			geneJson = {'geneId': int(l[geneIdCol]),
+						'taxId': taxId,
 						'Symbol': l[geneSymbolCol]}
-			infoDict[geneId] = geneJson
-			
+			if len(l) > officialSymbolCol and l[officialSymbolCol] != '-':
+				geneJson['Symbol_official'] = l[officialSymbolCol]
+
 			# Synonyms
 			rawSynonyms = l[synonymCol]
 			if rawSynonyms != '-':
-				infoDict[geneId]['Synonyms'] = rawSynonyms.split('|')
-
-	return infoDict
+				geneJson['Synonyms'] = rawSynonyms.split('|')
+			yield geneJson
 
 
-def homologyMapping(fileLoc):
+def iterHomologene(fileLoc, taxIds=None):
 	"""
-	Outputs a dictionary with key, value:
-		KEY: <Int> - HomoloGene ID
-		VALUE: List<Dict> - Dict with keys:
+	Yields one document per HomoloGene group:
+		- homId: <Int>
+		- members: List<Dict> - Dict with keys:
 			- taxId: <Int>
 			- geneId: <Int>
-		
+
+	The rows of a group are consecutive in homologene.data (sorted by HomoloGene ID).
+
 	:param fileLoc: String - File location of HomoloGene data
-	:return orthoDict: Dict<List>
+	:param taxIds: Set<Int> or None - only keep members of these taxa (groups left empty are skipped)
+	:return: Generator<Dict>
 	"""
 	# Define column indexes
 	homIdCol = 0
 	taxIdCol = 1
 	geneIdCol = 2
-	
-	# Initialise data store
-	orthoDict = dict()
-	
-	# Read file and store info
-	with open(fileLoc, 'r') as f:
-		for l in f:
-			l = l.split('\t')
-			homId = int(l[homIdCol])
-			taxId = int(l[taxIdCol])
-			geneId = int(l[geneIdCol])
-			
-			member = {'taxId': taxId, 'geneId': geneId}
-			if homId not in orthoDict:
-				orthoDict[homId] = list()
-			orthoDict[homId].append(member)
-			
-	return orthoDict
+
+	with openText(fileLoc) as f:
+		rows = (l.split('\t') for l in f if l.strip() != '')
+		for homId, group in groupby(rows, key=lambda l: int(l[homIdCol])):
+			members = [{'taxId': int(l[taxIdCol]), 'geneId': int(l[geneIdCol])} for l in group]
+			if taxIds is not None:
+				members = [m for m in members if m['taxId'] in taxIds]
+			if len(members) > 0:
+				yield {'homId': homId, 'members': members}
+
+
+def iterChunks(iterable, chunkSize):
+	"""
+	:param iterable: Iterable
+	:param chunkSize: Int
+	:return: Generator<List>
+	"""
+	it = iter(iterable)
+	chunk = list(islice(it, chunkSize))
+	while chunk:
+		yield chunk
+		chunk = list(islice(it, chunkSize))
+
+
+def insertChunks(collection, docs, chunkSize=DEFAULT_CHUNK_SIZE, workers=1):
+	"""
+	Insert documents in chunks; with several workers, at most 2 chunks per
+	worker are in memory at a time
+
+	:param collection: <class 'pymongo.collection.Collection'>
+	:param docs: Iterable<Dict>
+	:param chunkSize: Int
+	:param workers: Int - insert threads
+	:return: Int - number of inserted documents
+	"""
+	insert = lambda chunk: len(collection.insert_many(chunk, ordered=False).inserted_ids)
+	if workers == 1:
+		return sum(insert(chunk) for chunk in iterChunks(docs, chunkSize))
+
+	inserted = 0
+	pending = set()
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for chunk in iterChunks(docs, chunkSize):
+			if len(pending) >= 2 * workers:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				inserted += sum(future.result() for future in done)
+			pending.add(pool.submit(insert, chunk))
+		inserted += sum(future.result() for future in pending)
+	return inserted
+
+
+def loadCollection(db, name, docs, indexes, chunkSize=DEFAULT_CHUNK_SIZE, workers=1):
+	"""
+	Load into '<name>_staging', index it, then rename it over 'name' (dropping the old collection)
+	and bump the version of 'name'
+
+	:param db: <class 'pymongo.database.Database'>
+	:param name: String - live collection
+	:param docs: Iterable<Dict>
+	:param indexes: List<Tuple<List, Dict>> - (keys, options) per index
+	:param chunkSize: Int
+	:param workers: Int
+	:return: Int - number of documents
+	"""
+	staging = name + STAGING_SUFFIX
+	db[staging].drop()
+	db.create_collection(staging)
+
+	count = insertChunks(db[staging], docs, chunkSize, workers)
+	if count == 0:
+		db[staging].drop()
+		raise ValueError('No documents to load: ' + name + ' left unchanged')
+	for keys, options in indexes:
+		db[staging].create_index(keys, **options)
+	db[staging].rename(name, dropTarget=True)
+	db[META_COL].update_one({'_id': name}, {'$inc': {'version': 1}}, upsert=True)
+	return count
 
 
 def main():
-	# File scrape
-	print('Scraping files...')
-	id2sym = mapIdToSymbol(GENE_INFO_FILE)
-	homMap = homologyMapping(HOMOLOGENE_FILE)
-	
-	# Format (and merge raw data dictionaries)
-	print('Formatting into JSON objects...')
-	geneInfoJSON = [{'geneId': k, **v} for k, v in id2sym.items()]
-	homInfoJSON = [{'homId': k, 'members': v} for k, v in homMap.items()]
-	
-	# Upload to Mongo collection
-	print('Uploading to MongoDB...')
-	db[GENE_COL].drop()
-	db.create_collection(GENE_COL)
-	db[GENE_COL].insert_many(geneInfoJSON)
-	
-	db[MAPPING_COL].drop()
-	db.create_collection(MAPPING_COL)
-	db[MAPPING_COL].insert_many(homInfoJSON)
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--gi', type=str, default=GENE_INFO_FILE, help='NCBI gene_info file (plain or .gz)')
+	parser.add_argument('--hg', type=str, default=HOMOLOGENE_FILE, help='HomoloGene data file (plain or .gz)')
+	parser.add_argument('--ti', type=int, nargs='+', default=None, help='NCBI Taxonomic IDs to load (default: all)')
+	parser.add_argument('--gc', type=str, default=GENE_COL, help='Gene collection')
+	parser.add_argument('--hc', type=str, default=MAPPING_COL, help='Homology collection')
+	parser.add_argument('--cs', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size: documents per insert')
+	parser.add_argument('--np', type=int, default=1, help='Number of insert threads')
+	parser.add_argument('--fv', dest='force', action='store_true', help='Load even if genesets are stored with integer-encoded genes (schema v2)')
+
+	# Input parameter constraints
+	args = parser.parse_args()
+	assert args.cs > 0 and args.np > 0
+	taxIds = set(args.ti) if args.ti is not None else None
+
+	client = MongoClient('mongodb://{}:{}@{}:{}/{}'.format(
+		MONGODB_USERNAME, MONGODB_PASSWORD, MONGODB_HOST, MONGODB_PORT, MONGODB_DB))
+	db = client[MONGODB_DB]
+
+	# Changed symbols would change the output of v2 genesets: convert them back first (src/api/migrate.py --op v1)
+	if not args.force and db[GENESET_COL].find_one({'nativeGeneIds': {'$exists': True}}, {'_id': 1}) is not None:
+		sys.exit('{} has genesets with integer-encoded genes (schema v2), whose symbols are read from {}. '
+				'Run "python migrate.py --op v1" in src/api first, or pass --fv to load anyway.'.format(GENESET_COL, args.gc))
+
+	# Stream, upload, index and swap in
+	start = time.time()
+	print('Loading genes...')
+	nGenes = loadCollection(db, args.gc, iterGeneInfo(args.gi, taxIds), GENE_INDEXES, args.cs, args.np)
+	print('{} genes loaded into {} ({:.1f} s)'.format(nGenes, args.gc, time.time() - start))
+
+	print('Loading homology groups...')
+	nGroups = loadCollection(db, args.hc, iterHomologene(args.hg, taxIds), MAPPING_INDEXES, args.cs, args.np)
+	print('{} homology groups loaded into {} ({:.1f} s)'.format(nGroups, args.hc, time.time() - start))
 
 
 if __name__ == '__main__':
@@ -6,17 +6,34 @@ __contact__ = 'swk30.cam@gmail.com'
 __date__ = '19.11.2018'
 __status__ = 'MVP Complete'
 
+The CREEDS dump (a JSON array of signatures) is read incrementally: each
+signature is decoded, converted to its up/down rows and written to the
+open .gmtx file of its organism, so memory does not grow with the dump.
+With --np > 1, blocks of the file are decoded and converted by worker
+processes and written back in input order (the output is the same as with
+one process).
+
 """
 
 import json
 import argparse
+import multiprocessing
 import os
+import re
+from collections import deque
+from itertools import chain
 
 ACCEPT_KEYS = ['up_genes', 'down_genes']
 ACCEPT_TYPES = ["<class 'str'>", "<class 'int'>"]
 GENESET_ID_KEY = 'id'
 ORGANISM_KEY = 'organism'
 
+READ_SIZE = 1 << 20
+DEFAULT_BLOCK_SIZE = 1 << 22
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+BLOCK_CUT = re.compile(r'\}[ \t\n\r]*,')
+
 
 def getGmtxHeaders(d):
 	"""
@@ -39,63 +56,292 @@ def valGenesetToString(l):
 	:return: List<String>
 	"""
 	return [x[0] + ' | ' + str(x[1]) for x in l]
-	
+
+
+class JsonArrayReader(object):
+	"""
+	Iterates over the elements of a JSON array file, decoding one element at a time.
+	Only the current element (and at most one read ahead) is held in memory.
+	"""
+	def __init__(self, f, readSize=READ_SIZE):
+		"""
+		:param f: File object (text)
+		:param readSize: Int - characters per read
+		"""
+		self.f = f
+		self.readSize = readSize
+		self.decoder = json.JSONDecoder()
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+
+
+	def _fill(self, size):
+		"""
+		Drop the consumed part of the buffer and append the next read
+
+		:param size: Int
+		:return: VOID
+		"""
+		data = self.f.read(size)
+		self.eof = data == ''
+		self.buf = self.buf[self.pos:] + data
+		self.pos = 0
+
+
+	def _next(self):
+		"""
+		Skip whitespace, reading more input as needed
+
+		:return: String - next character ('' at the end of the file)
+		"""
+		while True:
+			self.pos = WHITESPACE.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf) or self.eof:
+				return self.buf[self.pos:self.pos + 1]
+			self._fill(self.readSize)
+
+
+	def __iter__(self):
+		if self._next() != '[':
+			raise ValueError('Expected a JSON array')
+		self.pos += 1
+
+		first = True
+		while True:
+			c = self._next()
+			if c == ']':
+				return
+			if not first:
+				if c != ',':
+					raise ValueError('Expected \',\' or \']\' at character {}'.format(self.pos))
+				self.pos += 1
+				self._next()
+			first = False
+
+			# Decode the element; an incomplete one (or one ending the buffer, e.g. a number) reads more first
+			while True:
+				try:
+					value, end = self.decoder.raw_decode(self.buf, self.pos)
+					if end < len(self.buf) or self.eof:
+						break
+				except json.JSONDecodeError:
+					if self.eof:
+						raise
+				# Grow reads with the element, so large elements are decoded a bounded number of times
+				self._fill(max(self.readSize, len(self.buf) - self.pos))
+			self.pos = end
+			yield value
+
+
+def iterSignatures(fileLoc):
+	"""
+	:param fileLoc: String - CREEDS .json file (a list of signatures)
+	:return: Generator<Dict>
+	"""
+	with open(fileLoc, 'r') as f:
+		yield from JsonArrayReader(f)
+
+
+def genesetLines(d, allHeaders, gmtxMetaHeaders):
+	"""
+	Convert one signature into its .gmtx rows ('<id>_UP' and '<id>_DN')
+
+	:param d: Dict - CREEDS signature
+	:param allHeaders: List<String> - keys taken from every signature
+	:param gmtxMetaHeaders: List<String> - metadata columns
+	:return: List<Tuple<String (organism), String (row)>>
+	"""
+	genesetDict = {x: d[x] for x in allHeaders}
+	meta = [str(genesetDict[k]).replace('\t', ' ').replace('\n', ' ') for k in gmtxMetaHeaders]
+	organism = meta[gmtxMetaHeaders.index(ORGANISM_KEY)]
+	lines = []
+	if 'up_genes' in genesetDict:
+		_up = [genesetDict['id'] + '_UP'] + meta + valGenesetToString(genesetDict['up_genes'])
+		lines.append((organism, '\t'.join(_up)))
+	if 'down_genes' in genesetDict:
+		_dn = [genesetDict['id'] + '_DN'] + meta + valGenesetToString(genesetDict['down_genes'])
+		lines.append((organism, '\t'.join(_dn)))
+	return lines
+
+
+def iterBlocks(fileLoc, blockSize):
+	"""
+	Split the body of the JSON array into blocks of about 'blockSize' characters, each cut
+	before a ',' that follows a '}'. A cut inside a string or a nested object leaves its block
+	unbalanced, so such a block fails to decode (see 'convertParallel').
+
+	:param fileLoc: String - CREEDS .json file
+	:param blockSize: Int - characters
+	:return: Generator<String> - array body text; joined with ',' the blocks give back the whole body
+	"""
+	with open(fileLoc, 'r') as f:
+		buf = f.read(blockSize).lstrip()
+		if not buf.startswith('['):
+			raise ValueError('Expected a JSON array')
+		buf = buf[1:]
+		while True:
+			data = f.read(blockSize)
+			if data == '':
+				buf = buf.rstrip()
+				if not buf.endswith(']'):
+					raise ValueError('Expected a JSON array')
+				if buf[:-1].strip() != '':
+					yield buf[:-1]
+				return
+
+			buf += data
+			cut = None
+			for cut in BLOCK_CUT.finditer(buf, max(0, len(buf) - blockSize)):
+				pass
+			if cut is not None:
+				yield buf[:cut.end() - 1]
+				buf = buf[cut.end():]
+
+
+_headers = None
+
+
+def _initWorker(allHeaders, gmtxMetaHeaders):
+	"""
+	Pool initializer: install the headers taken from the first signature
+
+	:param allHeaders: List<String>
+	:param gmtxMetaHeaders: List<String>
+	:return: VOID
+	"""
+	global _headers
+	_headers = (allHeaders, gmtxMetaHeaders)
+
+
+def _convertBlock(block):
+	"""
+	Pool task: decode and convert a block of signatures
+
+	:param block: String - see 'iterBlocks'
+	:return: List<Tuple<String, String>> or None - (organism, row) in input order; None if the block does not decode
+	"""
+	try:
+		signatures = json.loads('[' + block + ']')
+	except json.JSONDecodeError:
+		return None
+	return [line for d in signatures for line in genesetLines(d, *_headers)]
+
+
+def convertParallel(fileLoc, allHeaders, gmtxMetaHeaders, blockSize, workers):
+	"""
+	Decode and convert blocks of the file in worker processes. At most 2 blocks per
+	worker are pending, and results are taken in submission order. A block that does
+	not decode is joined with the next ones and converted here, until they decode.
+
+	:param fileLoc: String
+	:param allHeaders: List<String>
+	:param gmtxMetaHeaders: List<String>
+	:param blockSize: Int - characters per task
+	:param workers: Int - processes
+	:return: Generator<Tuple<String, String>> - (organism, row), in input order
+	"""
+	ctx = multiprocessing.get_context('spawn')
+	with ctx.Pool(processes=workers, initializer=_initWorker, initargs=(allHeaders, gmtxMetaHeaders)) as pool:
+		pending = deque()
+
+		def results():
+			for block in iterBlocks(fileLoc, blockSize):
+				if len(pending) >= 2 * workers:
+					yield pending.popleft()
+				pending.append((block, pool.apply_async(_convertBlock, (block,))))
+			while pending:
+				yield pending.popleft()
+
+		carry = None
+		for block, result in results():
+			if carry is None:
+				lines = result.get()
+				if lines is not None:
+					yield from lines
+					continue
+				carry = block
+			else:
+				carry += ',' + block
+			try:
+				signatures = json.loads('[' + carry + ']')
+			except json.JSONDecodeError:
+				continue
+			carry = None
+			for d in signatures:
+				yield from genesetLines(d, allHeaders, gmtxMetaHeaders)
+
+		if carry is not None:
+			# Raises the decoding error of the end of the file
+			json.loads('[' + carry + ']')
+
+
+class GmtxWriters(object):
+	"""
+	One open .gmtx file per organism ('<organism>_<outFileLoc>'), created with its header on its first row
+	"""
+	def __init__(self, outFileLoc, gmtxHeaders):
+		"""
+		:param outFileLoc: String
+		:param gmtxHeaders: List<String>
+		"""
+		self.outFileLoc = outFileLoc
+		self.header = '\t'.join(gmtxHeaders) + '\n'
+		self.files = dict()
+
+
+	def write(self, organism, line):
+		f = self.files.get(organism)
+		if f is None:
+			f = open(organism + '_' + self.outFileLoc, 'w', encoding='utf-8')
+			f.write(self.header)
+			self.files[organism] = f
+		f.write(line + '\n')
+
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+
 
 def main():
 	# Command-line input
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--f', type=str, help='File location')
+	parser.add_argument('--np', type=int, default=1, help='Number of worker processes')
+	parser.add_argument('--bs', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size: characters of the file per worker task')
 	args = parser.parse_args()
 	assert os.path.isfile(args.f)
+	assert args.np > 0 and args.bs > 0
 	inFileLoc = args.f
 	outFileLoc = '.'.join(inFileLoc.split('.')[:-1]) + '.gmtx'
 
-	# Get the CREEDS <LIST> of GENESET SIGNATURES (UP AND DOWN)
-	with open(inFileLoc, 'r') as f:
-		rawLoad = json.load(f)
-	assert isinstance(rawLoad, list)
-	allHeaders = getGmtxHeaders(rawLoad[0])
+	# Stream the CREEDS <LIST> of GENESET SIGNATURES (UP AND DOWN); headers come from the first one
+	signatures = iterSignatures(inFileLoc)
+	first = next(signatures, None)
+	assert isinstance(first, dict)
+	allHeaders = getGmtxHeaders(first)
 	assert GENESET_ID_KEY in allHeaders
 	assert any(x in allHeaders for x in ACCEPT_KEYS)
-	
+
 	# Get headers
-	gmtxMetaHeaders = [x for x in allHeaders if x not in ACCEPT_KEYS + [GENESET_ID_KEY]]	
+	gmtxMetaHeaders = [x for x in allHeaders if x not in ACCEPT_KEYS + [GENESET_ID_KEY]]
 	gmtxHeaders = ['setName'] + gmtxMetaHeaders + ['genes | CD']
-	rawWriteOut = []
-	
-	# Geneset extraction logic
-	for d in rawLoad:
-		genesetDict = {x: d[x] for x in allHeaders}
-		if 'up_genes' in genesetDict:
-			_upMeta = [str(genesetDict[k]).replace('\t', ' ').replace('\n', ' ') for k in gmtxMetaHeaders]
-			_upId = [genesetDict['id'] + '_UP']
-			_upGenes = valGenesetToString(genesetDict['up_genes'])
-			_up = _upId + _upMeta + _upGenes
-			rawWriteOut.append(_up)
-		if 'down_genes' in genesetDict:
-			_dnMeta = [str(genesetDict[k]).replace('\t', ' ').replace('\n', ' ') for k in gmtxMetaHeaders]
-			_dnId = [genesetDict['id'] + '_DN']
-			_dnGenes = valGenesetToString(genesetDict['down_genes'])
-			_dn = _dnId + _dnMeta + _dnGenes
-			rawWriteOut.append(_dn)
-	
-	# Separate by organism
-	orgIndex = gmtxHeaders.index(ORGANISM_KEY)
-	orgSepGeneDict = dict()
-	for l in rawWriteOut:
-		organism = l[orgIndex]
-		if organism not in orgSepGeneDict:
-			orgSepGeneDict[organism] = []
-		orgSepGeneDict[organism].append(l)
-	
-	# Write out
-	for k, v in orgSepGeneDict.items():
-		newOutfile = k + '_' + outFileLoc
-		with open(newOutfile, 'w', encoding='utf-8') as g:
-			g.write('\t'.join(gmtxHeaders) + '\n')
-			for x in v:
-				g.write('\t'.join(x) + '\n')
+	assert ORGANISM_KEY in gmtxMetaHeaders
+
+	# Geneset extraction logic, written out by organism
+	if args.np == 1:
+		lines = (line for d in chain([first], signatures) for line in genesetLines(d, allHeaders, gmtxMetaHeaders))
+	else:
+		signatures.close()
+		lines = convertParallel(inFileLoc, allHeaders, gmtxMetaHeaders, args.bs, args.np)
+	writers = GmtxWriters(outFileLoc, gmtxHeaders)
+	try:
+		for organism, line in lines:
+			writers.write(organism, line)
+	finally:
+		writers.close()
 
 
 if __name__ == '__main__':
-    main()
+	main()
@@ -0,0 +1,55 @@
+"""
+creeds_to_gmtx.py must write the same .gmtx files with worker processes as
+with one, however the blocks cut the file (including inside strings and
+nested objects that contain brackets, braces and escapes)
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'creeds_to_gmtx.py')
+
+SIGNATURES = [
+	{'id': 'gene:1', 'organism': 'human', 'cell_type': 'HeLa', 'pert_ids': ['a', 'b'], 'geo_id': 'GSE1', 'version': 1,
+	'up_genes': [['TP53', 1.5], ['BRCA1', 0.25]], 'down_genes': [['MYC', -2.0]]},
+	{'id': 'dz:2', 'organism': 'mouse', 'cell_type': 'ends with },', 'pert_ids': [], 'geo_id': '{"x": [1, 2]}', 'version': 2,
+	'up_genes': [['Trp53', 0.5]], 'down_genes': []},
+	{'id': 'drug:3', 'organism': 'human', 'cell_type': 'quote \\" and backslash \\\\ }, {', 'pert_ids': [{'k': '},'}],
+	'geo_id': 'tab\tand\nnewline', 'version': 3, 'up_genes': [], 'down_genes': [['A', 1e-05], ['B', 3]]},
+	{'id': 'gene:4', 'organism': 'rat', 'cell_type': 'ünïcödé ]', 'pert_ids': [[']', '[']], 'geo_id': '}}},,,{{{', 'version': 4,
+	'up_genes': [['Tubb2a', 2.0]], 'down_genes': [['Actb', -0.5]]},
+]
+
+
+def convert(directory, text, args):
+	"""
+	:param directory: py.path.local - working directory of the run
+	:param text: String - CREEDS JSON
+	:param args: List<String> - extra arguments
+	:return: Dict - {file name: content} of the .gmtx files written
+	"""
+	directory.mkdir()
+	with open(os.path.join(str(directory), 'creeds.json'), 'w', encoding='utf-8') as f:
+		f.write(text)
+	subprocess.run([sys.executable, SCRIPT, '--f', 'creeds.json'] + args, cwd=str(directory), check=True)
+	out = dict()
+	for name in sorted(os.listdir(str(directory))):
+		if name.endswith('.gmtx'):
+			with open(os.path.join(str(directory), name), 'rb') as f:
+				out[name] = f.read()
+	return out
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_parallel_matches_serial(tmpdir, indent):
+	text = json.dumps(SIGNATURES, indent=indent, ensure_ascii=False)
+	serial = convert(tmpdir.join('serial'), text, [])
+	assert sorted(serial) == ['human_creeds.gmtx', 'mouse_creeds.gmtx', 'rat_creeds.gmtx']
+	assert serial['human_creeds.gmtx'].count(b'\n') == 5
+	for workers, blockSize in [(2, 7), (2, 40), (3, 100), (2, 1 << 20)]:
+		parallel = convert(tmpdir.join('np{}_bs{}'.format(workers, blockSize)), text, ['--np', str(workers), '--bs', str(blockSize)])
+		assert parallel == serial
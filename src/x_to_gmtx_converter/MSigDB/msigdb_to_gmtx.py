@@ -1,4 +1,5 @@
-import xmltodict
+import argparse
+import xml.etree.ElementTree as ET
 
 FILE_LOC = './feed.xml'
 
@@ -6,6 +7,7 @@ SPLIT_BY_PARAMS = ['@CATEGORY_CODE', '@SUB_CATEGORY_CODE', '@ORGANISM']
 ADD_REMOVE_TAGS = ['@MEMBERS', '@MEMBERS_SYMBOLIZED', '@MEMBERS_MAPPING']
 SET_NAME_TAG = '@STANDARD_NAME'
 GENES_TAG = '@MEMBERS_EZID'
+GENESET_ELEMENT = 'GENESET'
 
 
 def parseXml(file_loc):
@@ -15,6 +17,8 @@ def parseXml(file_loc):
     :param file_loc: String
     :return: OrderedDict
     """
+    import xmltodict
+
     try:
         with open(file_loc, "rb") as f:
             d = xmltodict.parse(f, xml_attribs=True)
@@ -29,40 +33,76 @@ def parseXml(file_loc):
         raise
 
 
-def main():
-	parsed = parseXml('./feed.xml')
-
-	# Separate genesets into categories (Cat-Subcat-Organism)
-	uniqueGMTXDict = dict()
-	for geneset in parsed:
-		keyList = [geneset[param] for param in SPLIT_BY_PARAMS]
-		key = '_'.join(keyList)
-		if key not in uniqueGMTXDict:
-			uniqueGMTXDict[key] = [geneset]
-		else:
-			uniqueGMTXDict[key].append(geneset)
-
-	removeKeys = SPLIT_BY_PARAMS + ADD_REMOVE_TAGS + [SET_NAME_TAG, GENES_TAG]
-	extractKeys = [key for key in parsed[0].keys() if key not in removeKeys]
-	header = ['setName'] + extractKeys + ['genes']
-
-	for k, v in uniqueGMTXDict.items():
-		# Generate write out list
-		writeOut = []
-		for gs in v:
-			name = gs[SET_NAME_TAG]
-			values = [gs[s] for s in extractKeys]
-			genes = gs[GENES_TAG].split(',')
-			gsOut = [name] + values + genes
-			writeOut.append(gsOut)
-		
-		# Write out
-		outFileName = k + '.gmtx'
-		with open(outFileName, 'w', encoding='utf-8') as f:
+def iterGenesets(file_loc):
+	"""
+	Parse the MSigDB .xml file one GENESET element at a time: each element is
+	cleared once its attributes are taken, so memory does not grow with the file
+
+	:param file_loc: String
+	:return: Generator<Dict> - attributes of each geneset, '@'-prefixed (as 'parseXml')
+	"""
+	context = ET.iterparse(file_loc, events=('start', 'end'))
+	_, root = next(context)
+	for event, elem in context:
+		if event == 'end' and elem.tag == GENESET_ELEMENT:
+			yield {'@' + k: v for k, v in elem.attrib.items()}
+			elem.clear()
+			# Drop the reference the root keeps to every parsed child
+			root.clear()
+
+
+class GmtxWriters(object):
+	"""
+	One open GMTx file per category (Cat-Subcat-Organism), created on its first geneset.
+	The columns follow the attributes of the first geneset of the feed.
+	"""
+	def __init__(self):
+		self.files = dict()
+		self.extractKeys = None
+
+
+	def write(self, geneset):
+		if self.extractKeys is None:
+			removeKeys = SPLIT_BY_PARAMS + ADD_REMOVE_TAGS + [SET_NAME_TAG, GENES_TAG]
+			self.extractKeys = [key for key in geneset.keys() if key not in removeKeys]
+
+		key = '_'.join([geneset[param] for param in SPLIT_BY_PARAMS])
+		f = self.files.get(key)
+		if f is None:
+			f = open(key + '.gmtx', 'w', encoding='utf-8')
+			header = ['setName'] + self.extractKeys + ['genes']
 			f.write('\t'.join(header) + '\n')
-			for l in writeOut:
-				f.write('\t'.join(l) + '\n')
-				
+			self.files[key] = f
+
+		name = geneset[SET_NAME_TAG]
+		values = [geneset[s] for s in self.extractKeys]
+		genes = geneset[GENES_TAG].split(',')
+		f.write('\t'.join([name] + values + genes) + '\n')
+
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+
+
+def main():
+	# Command line input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--f', type=str, default=FILE_LOC, help='MSigDB .xml file')
+	parser.add_argument('--pa', type=str, default='iterparse', help='Parser: iterparse (streaming) or xmltodict (whole file in memory)')
+	args = parser.parse_args()
+	assert args.pa in ['iterparse', 'xmltodict']
+
+	genesets = iterGenesets(args.f) if args.pa == 'iterparse' else parseXml(args.f)
+
+	# Write each geneset to the file of its category (Cat-Subcat-Organism)
+	writers = GmtxWriters()
+	try:
+		for geneset in genesets:
+			writers.write(geneset)
+	finally:
+		writers.close()
+
 
 if __name__ == "__main__":
 	main()